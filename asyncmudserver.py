@@ -0,0 +1,376 @@
+"""Asyncio-based MUD server module for creating text-based Multi-User
+Dungeon (MUD) games inside an asyncio program.
+
+Contains one class, AsyncMudServer, which offers the same player and
+command API as MudServer but runs on an asyncio event loop, with one
+reader task per connected player. Because it only uses the standard
+asyncio API it also runs unchanged on alternative event loops such as
+uvloop - just call 'uvloop.install()' before starting the loop.
+
+Timers, the job pool, signals and recording work as they do with
+MudServer, using the event loop. Handing over to a new process and
+metrics are only offered by MudServer.
+
+Requires Python 3.7 or later.
+
+author: Mark Frimston - mfrimston@gmail.com
+"""
+
+
+import asyncio
+from itertools import count
+from collections import deque
+
+# import the MUD server class, whose Telnet handling and event lists we reuse
+from mudserver import MudServer, _monotonic
+
+
+class AsyncMudServer(MudServer):
+    """A server for text-based Multi-User Dungeon (MUD) games which runs
+    on an asyncio event loop.
+
+    Once started with 'start', the server will listen for players
+    connecting using Telnet. The events it produces can be read either
+    by awaiting 'update' in a loop and then calling 'get_new_players',
+    'get_disconnected_players' and 'get_commands' exactly as with
+    MudServer, or by iterating over 'events' with 'async for'. The two
+    styles should not be mixed.
+
+    Idle players cost nothing per update - each connection has its own
+    reader task which sleeps until the player sends something.
+
+    Functions arranged with 'call_later' and 'call_every', and those
+    registered with 'on_signal', are called by the event loop while the
+    game is waiting. The job pool watches a socket for finished jobs,
+    which on Windows needs asyncio's SelectorEventLoop.
+    """
+
+    # the asyncio server object accepting new clients
+    _server = None
+    # asyncio event which is set whenever a new occurence is added
+    _wakeup = None
+    # the reader tasks of the connected clients
+    _tasks = set()
+    # whether a call to 'flush' has been scheduled on the event loop
+    _flush_scheduled = False
+
+    def __init__(self, host="0.0.0.0", port=1234, backlog=100):
+        """Constructs the AsyncMudServer object. The server doesn't
+        start listening for new players until 'start' is awaited.
+        """
+
+        # note that we don't call MudServer's constructor, as that creates a
+        # listening socket of its own. We just set up the same info on clients
+        # and events that it does
+        self._clients = {}
+        self._nextid = 0
+        self._watched = {}
+        self._init_events()
+        self._dirty = set()
+        self._live_calls = set()
+        self._call_counter = count()
+
+        self._tasks = set()
+
+        self._host = host
+        self._port = port
+        self._backlog = backlog
+
+    async def start(self):
+        """Starts listening for new players. A reader task is started for
+        each player that connects.
+        """
+        self._wakeup = asyncio.Event()
+        self._server = await asyncio.start_server(
+            self._handle_connection, self._host, self._port,
+            backlog=self._backlog)
+
+    async def update(self, timeout=0):
+        """Waits until something has happened, or until 'timeout' seconds
+        have passed, then makes the new occurences available through
+        'get_new_players', 'get_disconnected_players' and 'get_commands'.
+        A timeout of None waits indefinitely. Even with a timeout of 0,
+        the event loop gets a turn, so that the players' reader tasks
+        and new connections are looked after.
+        """
+
+        # wait for a new occurence unless there's one waiting already. If
+        # we're not to wait at all, we still give control back to the event
+        # loop for a moment, or a game calling this in a loop would stop
+        # everything else from running
+        if timeout == 0 or self._has_pending_events():
+            await asyncio.sleep(0)
+        else:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        # make the new occurences available, as MudServer does
+        self._move_pending_events()
+        self._wakeup.clear()
+
+    async def tick(self, interval):
+        """Does the same job as 'update', but runs the game at a steady
+        rate of one tick every 'interval' seconds, as MudServer's 'tick'
+        does. Returns how many seconds late the tick started, which is 0
+        unless the game took too long handling the previous tick.
+        """
+        now = _monotonic()
+
+        # the first tick is due one interval from now
+        if self._next_tick is None:
+            self._next_tick = now + interval
+
+        # if the game has used up the whole tick, we're late. Skip any ticks
+        # which have been missed completely, as MudServer does
+        late = max(0.0, now - self._next_tick)
+        if late:
+            self._next_tick += interval * int(late / interval)
+
+        # the reader tasks handle the players' data while we sleep, so all we
+        # have to do is wait until the tick is due
+        await asyncio.sleep(max(0.0, self._next_tick - _monotonic()))
+        self._next_tick += interval
+
+        # make the tick's occurences available
+        self._move_pending_events()
+        self._wakeup.clear()
+        return late
+
+    async def events(self):
+        """An asynchronous iterator over every occurence, waiting for new
+        ones as needed. Each item is a tuple like those produced by
+        'drain_events'.
+        """
+        while True:
+            # take all the waiting occurences and hand them out one at a time
+            self._move_pending_events()
+            self._wakeup.clear()
+            for ev in self.drain_events():
+                yield ev
+            # wait until more occurences arrive
+            if not self._has_pending_events():
+                await self._wakeup.wait()
+
+    def on_signal(self, signum, callback):
+        """Registers a function to be called with no arguments when the
+        program receives the signal 'signum' (e.g. signal.SIGHUP). The
+        function is called by the event loop, where it's safe to use the
+        server. Must be called from the program's main thread, and isn't
+        available on Windows.
+        """
+        if self._signal_callbacks is None:
+            self._signal_callbacks = {}
+        self._signal_callbacks[signum] = callback
+        asyncio.get_event_loop().add_signal_handler(signum, callback)
+
+    def serve_metrics(self, address):
+        """Not supported by AsyncMudServer - raises RuntimeError."""
+        raise RuntimeError("serve_metrics is not supported by "
+                           "AsyncMudServer")
+
+    def on_slow_tick(self, callback, threshold=0.05, profile_every=0):
+        """Not supported by AsyncMudServer - raises RuntimeError."""
+        raise RuntimeError("on_slow_tick is not supported by "
+                           "AsyncMudServer")
+
+    def hand_over(self, command, state=None, timeout=30.0):
+        """Not supported by AsyncMudServer - raises RuntimeError."""
+        raise RuntimeError("hand_over is not supported by AsyncMudServer")
+
+    async def send_message(self, to, message):
+        """Sends the text in the 'message' parameter to the player with
+        the id number given in the 'to' parameter, waiting until the
+        data has been handed over to the operating system if the
+        player's connection is backed up.
+        """
+        # we make sure to put a newline on the end so the client receives the
+        # message on its own line
+        self._attempt_send(to, message+"\n\r")
+        self.flush()
+
+        # wait for the connection's outgoing buffer to drain. This is what
+        # stops a slow client from making us use up more and more memory
+        cl = self._clients.get(to)
+        if cl is None:
+            return
+        try:
+            await cl.socket.drain()
+        except ConnectionError:
+            self._handle_disconnect(to, "error")
+
+    def flush(self):
+        """Hands all the queued messages over to the players' connections.
+        This happens automatically once the code currently running gives
+        control back to the event loop, so it only needs calling directly
+        if messages must go out before then.
+        """
+        self._flush_scheduled = False
+        dirty = self._dirty
+        self._dirty = set()
+        for id in dirty:
+            cl = self._clients.get(id)
+            if cl is None or not cl.outqueue:
+                continue
+            # give the stream writer all of the client's waiting messages at
+            # once, so that they go out together
+            cl.socket.writelines(cl.outqueue)
+            cl.outqueue = None
+            cl.outbytes = 0
+
+    async def shutdown(self):
+        """Closes down the server, disconnecting all clients and
+        closing the listen socket.
+        """
+        # let the game do anything it needs to before we close down
+        if self._shutdown_callback is not None:
+            self._shutdown_callback()
+
+        # finish recording, if we are
+        self.stop_recording()
+
+        # stop listening for signals
+        if self._signal_callbacks is not None:
+            loop = asyncio.get_event_loop()
+            for signum in self._signal_callbacks:
+                loop.remove_signal_handler(signum)
+
+        # stop the job pool, without waiting for running jobs to finish
+        if self._job_executor is not None:
+            self._job_executor.shutdown(wait=False)
+            self._unwatch_socket(self._job_wakeup_read)
+            self._job_wakeup_read.close()
+            self._job_wakeup_write.close()
+
+        # stop accepting new clients
+        self._server.close()
+        # close each client's connection and wait for their reader tasks to
+        # finish
+        for cl in list(self._clients.values()):
+            cl.socket.close()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # wait for the listen socket to close
+        await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+
+        # this runs as a separate task for each connected client. Start by
+        # giving the new client a unique id number and storing its info. The
+        # stream writer takes the place of the socket object
+        clid = self._nextid
+        self._nextid += 1
+        addr = writer.get_extra_info("peername")
+        cl = MudServer._Client(writer, addr[0] if addr else "", bytearray(),
+                               _monotonic())
+        self._clients[clid] = cl
+        if self._recorder is not None:
+            self._recorder.connect(clid, cl.address)
+        self._add_new_player(clid)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+
+        try:
+            while True:
+                # wait until the client sends some data, using a max length of
+                # 4096. An empty result means the client has disconnected
+                data = await reader.read(4096)
+                if not data:
+                    break
+                if self._recorder is not None:
+                    self._recorder.data(clid, data)
+
+                # handle the data as MudServer does
+                self._handle_data(clid, cl, data)
+
+        # if there's a problem with the connection the client has gone
+        except ConnectionError:
+            pass
+
+        self._tasks.discard(task)
+        self._handle_disconnect(clid)
+
+    def _has_pending_events(self):
+
+        # whether any of the queues of new occurences has something in it
+        return bool(self._pending_new_players or self._pending_left_players
+                    or self._pending_commands or self._pending_job_results)
+
+    def _add_new_player(self, clid):
+
+        # add the occurence as MudServer does, then wake up anything that is
+        # waiting for one. The same goes for the other types of occurence
+        MudServer._add_new_player(self, clid)
+        self._wakeup.set()
+
+    def _add_player_left(self, clid):
+        MudServer._add_player_left(self, clid)
+        self._wakeup.set()
+
+    def _add_command(self, clid, command, params):
+        MudServer._add_command(self, clid, command, params)
+        self._wakeup.set()
+
+    def _add_job_result(self, clid, number, result, error):
+        MudServer._add_job_result(self, clid, number, result, error)
+        self._wakeup.set()
+
+    def _call_at(self, when, callback, *args):
+
+        # the event loop keeps our timers for us. 'when' is measured by the
+        # monotonic clock, so work out how long that is from now
+        asyncio.get_event_loop().call_later(max(0.0, when - _monotonic()),
+                                            callback, *args)
+
+    def _watch_socket(self, sock, callback, write=False):
+
+        # the event loop watches other sockets for us too, such as the one
+        # the job pool uses to say a job has finished
+        self._watched[sock] = write
+        if write:
+            asyncio.get_event_loop().add_writer(sock, callback)
+        else:
+            asyncio.get_event_loop().add_reader(sock, callback)
+
+    def _unwatch_socket(self, sock):
+
+        # stop watching a socket added with _watch_socket
+        if self._watched.pop(sock):
+            asyncio.get_event_loop().remove_writer(sock)
+        else:
+            asyncio.get_event_loop().remove_reader(sock)
+
+    def _queue_data(self, clid, data):
+
+        # look up the client and add the data to its queue, creating the queue
+        # if needed
+        cl = self._clients.get(clid)
+        if cl is None:
+            return
+        if cl.outqueue is None:
+            cl.outqueue = deque()
+        cl.outqueue.append(data)
+        cl.outbytes += len(data)
+        self._dirty.add(clid)
+
+        # the queued messages are handed to the stream writers together once
+        # the current code gives control back to the event loop
+        if not self._flush_scheduled:
+            asyncio.get_event_loop().call_soon(self.flush)
+            self._flush_scheduled = True
+
+    def _handle_disconnect(self, clid, reason="closed"):
+
+        # if the client has already been removed there's nothing to do
+        if clid not in self._clients:
+            return
+
+        # remove the client from the clients map and close its connection
+        cl = self._clients.pop(clid)
+        cl.socket.close()
+
+        # note the disconnection in the recording, if we're making one, and
+        # add a 'player left' occurence
+        if self._recorder is not None:
+            self._recorder.disconnect(clid, reason)
+        self._add_player_left(clid)
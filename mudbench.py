@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+
+"""Load testing tool for MUD Pi servers. Connects lots of simulated
+players to a running server (by default the 'simplemud.py' example
+game), has them log in, move between rooms, talk and look around at a
+set rate, and reports how well the server kept up.
+
+The report covers how quickly players were let in, how long commands
+took to be answered (as percentiles), how many messages per second
+players received and how many bytes that took, and, if the server's
+process id is known, how much CPU time and memory it used, including
+the memory used for each logged in player. It's printed as JSON so
+that results can be saved and compared between versions, e.g:
+
+    python mudbench.py --spawn --clients 1000 --duration 30 > before.json
+
+Some of the simulated players can be made 'slow readers', which read
+what the server sends them only very slowly, to check that they don't
+hold up everyone else. With '--compress' the players accept the
+server's offer to compress the data it sends them, if it makes one.
+
+Requires Python 3.7 or later. Measuring the server's CPU time and
+memory only works on Linux. Running thousands of players may need the
+open file limit raising first, e.g. with 'ulimit -n 20000'.
+
+author: Mark Frimston - mfrimston@gmail.com
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import asyncio
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+# the exits which lead out of each room in the 'simplemud.py' game. The
+# simulated players use these to move around
+EXITS = {
+    "Tavern": "outside",
+    "Outside": "inside",
+}
+
+
+class Results(object):
+    """Collects the measurements made by all of the simulated players"""
+
+    def __init__(self):
+        # how long each player took to connect and receive the name prompt
+        self.connect_times = []
+        # how long each command took to be answered, by command
+        self.latencies = {"say": [], "look": [], "go": []}
+        # the number of lines received from the server, and the number of bytes
+        # that took (which is less if compressed)
+        self.messages = 0
+        self.wire_bytes = 0
+        # the number of players whose data was compressed
+        self.compressed = 0
+        # the number of players which failed to connect or were disconnected
+        self.errors = 0
+
+
+class Player(object):
+    """A simulated player connected to the server"""
+
+    def __init__(self, name, results, slow, compress):
+        self.name = name
+        self.results = results
+        self.slow = slow
+        self.compress = compress
+        # data received but not yet read as lines, any incomplete Telnet
+        # command at the end of the data, and the decompressor once the server
+        # has started compressing
+        self.buffer = bytearray()
+        self.pending = b""
+        self.decompressor = None
+        self.room = "Tavern"
+        # a function which tells whether a line from the server answers the
+        # command we're waiting on, and the future to complete when it does
+        self.waiting_for = None
+        self.answered = None
+
+    async def connect(self, host, port):
+        """Connects to the server and waits for the name prompt"""
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        await self.expect(lambda line: line.startswith("What is your name"))
+        self.results.connect_times.append(time.perf_counter() - start)
+
+    async def expect(self, check):
+        """Reads lines from the server until one passes the given check"""
+        while True:
+            line = await self.read_line()
+            if check(line):
+                return line
+
+    async def read_line(self):
+        # read from the server until we have a whole line
+        end = self.buffer.find(b"\n")
+        while end == -1:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("disconnected")
+            self.results.wire_bytes += len(data)
+            self.receive(data)
+            end = self.buffer.find(b"\n")
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end + 1]
+
+        # lines from the server end with "\n\r", and may contain the invisible
+        # characters the server sends to check we're still connected
+        self.results.messages += 1
+        return line.decode("latin1").replace("\x00", "").strip("\r\n")
+
+    def receive(self, data):
+        """Handles data from the server, decompressing it if compression
+        has started, and answering any Telnet option negotiation.
+        """
+        if self.decompressor is not None:
+            self.buffer += self.decompressor.decompress(data)
+            # the server can end compression, e.g. when handing over to a new
+            # process. Anything after the end of the compressed data is sent
+            # as normal
+            if not self.decompressor.eof:
+                return
+            data = self.decompressor.unused_data
+            self.decompressor = None
+        data = self.pending + data
+        self.pending = b""
+        while True:
+            # pass on everything up to the next Telnet command
+            i = data.find(b"\xff")
+            if i == -1:
+                self.buffer += data
+                return
+            self.buffer += data[:i]
+            if len(data) < i + 3:
+                self.pending = data[i:]
+                return
+            command, option = data[i + 1], data[i + 2]
+
+            # accept compression if we've been told to, and turn down
+            # everything else the server offers ('will') or asks for ('do')
+            if command == 251:
+                answer = 253 if option == 86 and self.compress else 254
+                self.writer.write(bytes([255, answer, option]))
+            elif command == 253:
+                self.writer.write(bytes([255, 252, option]))
+
+            # the start of compression. Everything after it is compressed
+            elif command == 250 and option == 86:
+                if len(data) < i + 5:
+                    self.pending = data[i:]
+                    return
+                self.decompressor = zlib.decompressobj()
+                self.results.compressed += 1
+                self.receive(data[i + 5:])
+                return
+            data = data[i + 3:]
+
+    async def log_in(self):
+        """Enters the player's name and waits for the welcome message"""
+        self.send(self.name)
+        await self.expect(lambda line: line.startswith("Welcome to the game"))
+
+    def send(self, line):
+        self.writer.write(line.encode("latin1") + b"\r\n")
+
+    async def listen(self):
+        """Reads everything the server sends, checking for answers to
+        the command we're waiting on. Slow readers pause between reads.
+        """
+        while True:
+            line = await self.read_line()
+            if self.waiting_for is not None and self.waiting_for(line):
+                self.waiting_for = None
+                self.answered.set_result(line)
+            if self.slow:
+                await asyncio.sleep(0.5)
+
+    async def command(self, kind, line, check):
+        """Sends a command and waits for the answer, recording how long
+        it took.
+        """
+        self.answered = asyncio.get_event_loop().create_future()
+        self.waiting_for = check
+        start = time.perf_counter()
+        self.send(line)
+        answer = await self.answered
+        self.results.latencies[kind].append(time.perf_counter() - start)
+        return answer
+
+    async def play(self, rate, mix, end):
+        """Sends random commands at the given average rate per second
+        until the end time.
+        """
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        while True:
+            # wait a random time so that the players don't all act at once,
+            # stopping if that takes us past the end time
+            wait = random.expovariate(rate)
+            if time.perf_counter() + wait >= end:
+                await asyncio.sleep(max(0, end - time.perf_counter()))
+                return
+            await asyncio.sleep(wait)
+            kind = random.choices(kinds, weights)[0]
+
+            # say something, then wait to hear it said back
+            if kind == "say":
+                token = "{}-{}".format(self.name, random.getrandbits(32))
+                await self.command("say", "say " + token,
+                                   lambda line: line.endswith(token))
+
+            # look around, the last line of which is the list of exits
+            elif kind == "look":
+                await self.command("look", "look",
+                                   lambda line: line.startswith("Exits are"))
+
+            # go through the exit out of the current room
+            elif kind == "go":
+                answer = await self.command(
+                    "go", "go " + EXITS[self.room],
+                    lambda line: line.startswith("You arrive at"))
+                self.room = answer.split("'")[1]
+
+    def close(self):
+        self.writer.close()
+
+
+async def run_player(number, args, results, start_gate, end):
+    # the life of one simulated player: connect, log in, then play until the
+    # end time. Slow readers only log in and then read slowly. The game saves
+    # players between sessions, so each run uses new names to make sure the
+    # players all start in the same room
+    player = Player("{}x{}".format(args.run_name, number), results,
+                    number < args.clients * args.slow, args.compress)
+    try:
+        # connect at the chosen rate, rather than all at once
+        if args.connect_rate > 0:
+            await asyncio.sleep(number / args.connect_rate)
+        await player.connect(args.host, args.port)
+        await player.log_in()
+        await start_gate.wait()
+        listener = asyncio.ensure_future(player.listen())
+        try:
+            if player.slow:
+                await asyncio.sleep(max(0, end[0] - time.perf_counter()))
+            else:
+                await asyncio.wait_for(
+                    player.play(args.rate, args.mix, end[0]),
+                    end[0] - time.perf_counter() + 5)
+        finally:
+            listener.cancel()
+            player.close()
+    except (ConnectionError, OSError, asyncio.TimeoutError):
+        results.errors += 1
+
+
+def percentiles(values):
+    # the 50th, 99th and 99.9th percentile of the given times, in milliseconds
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(fraction):
+        return round(values[min(len(values) - 1,
+                                int(fraction * len(values)))] * 1000, 3)
+    return {"count": len(values), "p50_ms": pick(0.5), "p99_ms": pick(0.99),
+            "p999_ms": pick(0.999), "max_ms": round(values[-1] * 1000, 3)}
+
+
+def process_usage(pid):
+    # the total CPU time in seconds and the current memory use in kilobytes
+    # of the given process, read from the Linux /proc filesystem. None if it
+    # can't be read
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/{}/status".format(pid)) as f:
+            rss = [line.split()[1] for line in f if line.startswith("VmRSS")]
+    except (IOError, OSError, IndexError):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+    return cpu, int(rss[0]) if rss else 0
+
+
+async def benchmark(args, server_pid):
+    results = Results()
+    start_gate = asyncio.Event()
+    # the end time isn't known until all the players are in, so it's kept in
+    # a list which the players share
+    end = [0]
+
+    # measure the server's memory use before any players connect, so that we
+    # can work out how much each player uses
+    usage_empty = process_usage(server_pid) if server_pid else None
+
+    # connect all the players, and time how long it takes for them all to be
+    # let in
+    connect_start = time.perf_counter()
+    tasks = [asyncio.ensure_future(run_player(i, args, results, start_gate,
+                                              end))
+             for i in range(args.clients)]
+    while (len(results.connect_times) + results.errors < args.clients
+           and time.perf_counter() - connect_start < args.connect_timeout):
+        await asyncio.sleep(0.01)
+    connect_duration = time.perf_counter() - connect_start
+
+    # let the players loose, measuring the server's CPU time and memory at
+    # the start and end, and its peak memory use in between
+    usage_start = process_usage(server_pid) if server_pid else None
+    peak_rss = usage_start[1] if usage_start else 0
+    messages_start = results.messages
+    wire_bytes_start = results.wire_bytes
+    end[0] = time.perf_counter() + args.duration
+    start_gate.set()
+    while time.perf_counter() < end[0]:
+        await asyncio.sleep(0.5)
+        usage = process_usage(server_pid) if server_pid else None
+        if usage:
+            peak_rss = max(peak_rss, usage[1])
+    usage_end = process_usage(server_pid) if server_pid else None
+    messages = results.messages - messages_start
+    wire_bytes = results.wire_bytes - wire_bytes_start
+    await asyncio.gather(*tasks)
+
+    # put together the report
+    report = {
+        "clients": args.clients,
+        "slow_clients": int(args.clients * args.slow),
+        "duration_s": args.duration,
+        "command_rate": args.rate,
+        "errors": results.errors,
+        "accept": {
+            "admitted": len(results.connect_times),
+            "seconds": round(connect_duration, 3),
+            "per_second": round(len(results.connect_times)
+                                / connect_duration, 1),
+            "latency": percentiles(results.connect_times),
+        },
+        "latency": dict((kind, percentiles(values))
+                        for kind, values in results.latencies.items()),
+        "messages_per_second": round(messages / float(args.duration), 1),
+        "wire_bytes_per_second": round(wire_bytes / float(args.duration), 1),
+        "wire_bytes_per_message": round(wire_bytes / float(max(1, messages)),
+                                        1),
+        "compressed_clients": results.compressed,
+    }
+    report["latency"]["all"] = percentiles(
+        sum(results.latencies.values(), []))
+    if usage_empty and usage_start and usage_end:
+        admitted = max(1, len(results.connect_times))
+        report["server"] = {
+            "rss_kb_idle": usage_empty[1],
+            "rss_bytes_per_client": int((usage_start[1] - usage_empty[1])
+                                        * 1024 / admitted),
+            "cpu_seconds": round(usage_end[0] - usage_start[0], 3),
+            "cpu_percent": round((usage_end[0] - usage_start[0])
+                                 / args.duration * 100, 1),
+            "rss_kb": usage_end[1],
+            "peak_rss_kb": peak_rss,
+        }
+    return report
+
+
+def wait_for_port(host, port, timeout):
+    # wait until the server is accepting connections
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a MUD server")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address of the server (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=1234,
+                        help="port of the server (default 1234)")
+    parser.add_argument("--clients", type=int, default=100,
+                        help="number of simulated players (default 100)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to run for once all players are in "
+                             "(default 10)")
+    parser.add_argument("--rate", type=float, default=1,
+                        help="commands per second sent by each player "
+                             "(default 1)")
+    parser.add_argument("--say", type=float, default=1,
+                        help="relative share of 'say' commands (default 1)")
+    parser.add_argument("--look", type=float, default=1,
+                        help="relative share of 'look' commands (default 1)")
+    parser.add_argument("--go", type=float, default=1,
+                        help="relative share of 'go' commands (default 1)")
+    parser.add_argument("--slow", type=float, default=0,
+                        help="fraction of players which are slow readers "
+                             "(default 0)")
+    parser.add_argument("--compress", action="store_true",
+                        help="accept the server's offer to compress data")
+    parser.add_argument("--connect-rate", type=float, default=1000,
+                        help="players connecting per second, or 0 for all "
+                             "at once (default 1000)")
+    parser.add_argument("--connect-timeout", type=float, default=60,
+                        help="seconds to wait for all players to get in "
+                             "(default 60)")
+    parser.add_argument("--server-pid", type=int,
+                        help="process id of the server, to measure its CPU "
+                             "time and memory")
+    parser.add_argument("--spawn", action="store_true",
+                        help="start 'simplemud.py' for the test and stop it "
+                             "afterwards")
+    parser.add_argument("--output",
+                        help="file to write the JSON report to (default: "
+                             "print it)")
+    args = parser.parse_args()
+    args.mix = {"say": args.say, "look": args.look, "go": args.go}
+    args.run_name = "bot{:06x}".format(random.getrandbits(24))
+
+    # start the example game if asked to. It runs in a temporary directory
+    # with its own store of saved players, so that the simulated players
+    # aren't added to the real game's players
+    server = None
+    server_pid = args.server_pid
+    workdir = None
+    if args.spawn:
+        workdir = tempfile.mkdtemp(prefix="mudbench-")
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(
+                os.path.abspath(__file__)), "simplemud.py"),
+             "--players", os.path.join(workdir, "players.db")],
+            cwd=workdir)
+        server_pid = server.pid
+        if not wait_for_port(args.host, args.port, 10):
+            server.kill()
+            shutil.rmtree(workdir, ignore_errors=True)
+            sys.exit("The server didn't start")
+
+    try:
+        report = asyncio.get_event_loop().run_until_complete(
+            benchmark(args, server_pid))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # write out the report
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+
+"""Record and replay module for measuring how quickly a text-based
+Multi-User Dungeon (MUD) game runs, without needing any real players.
+
+Contains two classes. Recorder writes everything players send to a
+MudServer, and when they connect and disconnect, to a recording file -
+it's used by MudServer's 'start_recording' method. ReplayServer is a
+MudServer which, instead of listening for real players, plays a
+recording back to the game. Each recorded player gets an in-memory
+connection in place of a socket, so all of the server's own code runs
+as normal, but the network doesn't make the results vary from one run
+to the next.
+
+Running this module plays a recording back to a game script (by default
+'simplemud.py', which makes recordings when run with '--record') and
+reports how quickly the game handled it, e.g:
+
+    python simplemud.py --record players.rec
+    python mudreplay.py players.rec
+    python mudreplay.py players.rec --speed 1 --profile
+
+By default the recording is played as fast as the game can handle it.
+Run it with '--help' to see all of the options.
+
+author: Mark Frimston - mfrimston@gmail.com
+"""
+
+
+import os
+import sys
+import time
+import errno
+import runpy
+import shutil
+import socket
+import struct
+import tempfile
+import argparse
+from collections import deque
+
+# import the MUD server module. We replace its MudServer class with
+# ReplayServer when playing a recording to a game script
+import mudserver
+from mudserver import MudServer, _monotonic
+
+
+# Types of record in a recording: a player connecting (the record's data is
+# their address), sending data (the data they sent) or disconnecting (the
+# reason they left). See 'read_recording' function
+RECORD_CONNECT = 1
+RECORD_DATA = 2
+RECORD_DISCONNECT = 3
+
+# the bytes at the start of every recording file, saying what it is
+_MAGIC = b"MUDREC1\n"
+
+# Layout of the header at the start of each record: the number of seconds
+# since the recording started, the player's id number, the type of record and
+# the length of the data which follows the header
+_HEADER = struct.Struct("<dIBI")
+
+
+class ReplayFinished(Exception):
+    """Raised by ReplayServer's 'update' and 'tick' methods once the
+    whole recording has been played and the game has had a chance to
+    handle it. The server is available as the 'server' attribute.
+    """
+
+    def __init__(self, server):
+        Exception.__init__(self, "The recording has finished")
+        self.server = server
+
+
+class Recorder(object):
+    """Writes what players send to a MudServer to a recording file.
+    Each record is a short header followed by the player's address, the
+    raw data they sent (including any Telnet commands) or the reason they
+    left. The file is written through a buffer, so recording costs the
+    game very little. Usually created by MudServer's 'start_recording'
+    method rather than directly.
+    """
+
+    def __init__(self, path, append=False):
+        """Creates the recording file at 'path', replacing any file
+        already there. If 'append' is True and there is a recording at
+        'path' already, it is carried on instead, with the new records
+        timed on from its last one.
+        """
+        end = _find_recording_end(path) if append else None
+        if end is None:
+            self._file = open(path, "wb")
+            self._file.write(_MAGIC)
+            self._started = _monotonic()
+        else:
+            # write after the last whole record, throwing away any partly
+            # written one, and carry on the timing from there
+            offset, last = end
+            self._file = open(path, "r+b")
+            self._file.truncate(offset)
+            self._file.seek(offset)
+            self._started = _monotonic() - last
+
+    def connect(self, id, address):
+        """Records that the player with the given id number connected
+        from the given address.
+        """
+        self._write(RECORD_CONNECT, id, address.encode("utf-8"))
+
+    def data(self, id, data):
+        """Records the raw bytes sent by the player with the given id
+        number.
+        """
+        self._write(RECORD_DATA, id, data)
+
+    def disconnect(self, id, reason):
+        """Records that the player with the given id number left, and
+        why.
+        """
+        self._write(RECORD_DISCONNECT, id, reason.encode("utf-8"))
+
+    def flush(self):
+        """Writes out everything recorded so far, without closing the
+        file.
+        """
+        self._file.flush()
+
+    def close(self):
+        """Finishes writing the recording and closes the file."""
+        self._file.close()
+
+    def _write(self, kind, id, data):
+
+        # write the record's header, giving when it happened, followed by its
+        # data
+        self._file.write(_HEADER.pack(_monotonic() - self._started, id, kind,
+                                      len(data)))
+        self._file.write(data)
+
+
+def read_recording(path):
+    """Iterates over the records in the recording file at 'path', giving
+    a (time, type, id, data) tuple for each, where 'time' is the number
+    of seconds since the recording started and 'type' is one of
+    RECORD_CONNECT, RECORD_DATA or RECORD_DISCONNECT.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("{} is not a recording".format(path))
+        while True:
+
+            # read the next header and the data after it. If the server was
+            # stopped suddenly, the last record may only be partly written,
+            # in which case we stop at the one before
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            when, id, kind, length = _HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            yield when, kind, id, data
+
+
+def _find_recording_end(path):
+
+    # find where the last whole record in the recording file at 'path' ends,
+    # and when it happened, by reading each record's header and skipping over
+    # its data. Returns None if there's no recording there
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return None
+    with f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            return None
+        offset, last = f.tell(), 0.0
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            when, id, kind, length = _HEADER.unpack(header)
+            if offset + _HEADER.size + length > size:
+                break
+            offset += _HEADER.size + length
+            last = when
+            f.seek(offset)
+        return offset, last
+
+
+class _MemorySocket(object):
+    """Stands in for the socket of a recorded player"""
+
+    __slots__ = ("clid", "incoming", "ended", "ready", "closed", "bytes_out")
+
+    def __init__(self):
+        # the id number the server gave the player, once it has accepted them
+        self.clid = None
+        # data the player has sent which the server hasn't read yet, and
+        # whether the player has disconnected after sending it
+        self.incoming = deque()
+        self.ended = False
+        # whether the socket is in the server's list of sockets to read
+        self.ready = False
+        # whether the server has closed the socket
+        self.closed = False
+        # the number of bytes the server has sent to the player
+        self.bytes_out = 0
+
+    def recv(self, size):
+        # hand over the next piece of data the player sent, or nothing if
+        # they've disconnected. If the server asks for less than the whole
+        # piece, the rest is kept for next time
+        if not self.incoming:
+            return b""
+        data = self.incoming.popleft()
+        if len(data) > size:
+            self.incoming.appendleft(data[size:])
+            data = data[:size]
+        return data
+
+    def send(self, data):
+        # the player takes everything sent to them straight away
+        self.bytes_out += len(data)
+        return len(data)
+
+    def sendmsg(self, buffers):
+        sent = sum(len(data) for data in buffers)
+        self.bytes_out += sent
+        return sent
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class _MemoryListener(object):
+    """Stands in for the server's listen socket"""
+
+    def __init__(self):
+        # recorded players waiting to be accepted, as (socket, address) pairs
+        self.waiting = deque()
+
+    def accept(self):
+        # hand over the next waiting player, with an error if there isn't one,
+        # just like a real non-blocking socket
+        if not self.waiting:
+            raise socket.error(errno.EAGAIN, "No players waiting")
+        sock, address = self.waiting.popleft()
+        return sock, (address, 0)
+
+    def close(self):
+        pass
+
+
+class ReplayServer(MudServer):
+    """A MudServer which plays a recording made with MudServer's
+    'start_recording' method back to the game, instead of listening for
+    real players. The game sees the recorded players connect, send their
+    commands and disconnect just as they did when recorded, and messages
+    sent to them are counted and thrown away.
+
+    Once the whole recording has been played and the game has had a
+    chance to handle it, 'update' and 'tick' raise ReplayFinished.
+    """
+
+    # the recording to play, and how fast, for when they aren't passed to the
+    # constructor. See the 'main' function
+    recording = None
+    speed = None
+
+    def __init__(self, recording=None, speed=None, **kwargs):
+        """Constructs the ReplayServer object, reading the whole of the
+        recording at the path 'recording' into memory first so that
+        reading the file doesn't slow the game down. If 'speed' is None,
+        the recording is played as fast as the game can handle it,
+        otherwise at 'speed' times the speed it was recorded at (e.g. 1
+        for real time). Any other arguments are passed on to MudServer,
+        apart from the network address, which isn't needed.
+        """
+        self._records = deque(read_recording(recording or self.recording))
+        self._speed = speed if speed is not None else self.speed
+        # the in-memory socket of each recorded player, mapping the id number
+        # they had in the recording to their socket, and the sockets which
+        # have something for the server to read, in the order they got it
+        self._sockets = {}
+        self._ready = []
+        # when playing started and finished, as measured by the monotonic
+        # clock, and whether every record has been played
+        self.started = None
+        self.finished = None
+        self._played_all = False
+        # the number of times the server has checked for activity, and the
+        # number of commands and bytes the recorded players have sent
+        self.polls = 0
+        self.command_count = 0
+        self.bytes_in = 0
+        MudServer.__init__(self, **kwargs)
+
+    def update(self, timeout=0):
+        """Works like MudServer's 'update', playing the records which are
+        due. Raises ReplayFinished once the recording has finished.
+        """
+        self._check_finished()
+        MudServer.update(self, timeout)
+
+    def tick(self, interval):
+        """Works like MudServer's 'tick', playing the records which are
+        due. When playing as fast as possible there's no point waiting
+        for the next tick, so each tick just plays the next lot of
+        records. Raises ReplayFinished once the recording has finished.
+        """
+        self._check_finished()
+        if self._speed is None:
+            MudServer.update(self, 0)
+            return 0.0
+        return MudServer.tick(self, interval)
+
+    def get_bytes_out(self):
+        """Returns the number of bytes the server has sent to the
+        recorded players so far.
+        """
+        return sum(sock.bytes_out for sock in self._sockets.values())
+
+    def _check_finished(self):
+
+        # once every record has been played, the game has handled the last of
+        # them by the time it asks for the next update, so we stop it there
+        if self._played_all:
+            self.flush()
+            if self.finished is None:
+                self.finished = _monotonic()
+            raise ReplayFinished(self)
+
+    def _start_listening(self, host, port, backlog, reuse_port):
+
+        # instead of a real listen socket, recorded players arrive through an
+        # in-memory one. Without a selector, the server asks _poll about every
+        # socket, which we replace below
+        self._listen_socket = _MemoryListener()
+        self._selector = None
+
+    def _poll(self, timeout):
+
+        # when playing at the recorded speed, wait until the next record is
+        # due, unless the server needs to do something sooner
+        now = _monotonic()
+        if self.started is None:
+            self.started = now
+        if self._speed is not None and self._records:
+            wait = self._records[0][0] / self._speed - (now - self.started)
+            if timeout is not None:
+                wait = min(wait, timeout)
+            if wait > 0:
+                time.sleep(wait)
+        self.polls += 1
+
+        # hand the records which are due to the players' sockets, then tell
+        # the server which sockets have something for it. Our sockets take
+        # everything sent to them straight away, so none are ever waiting to
+        # be written to
+        self._play_records()
+        ready = []
+        for sock in self._ready:
+            if not sock.closed and (sock.incoming or sock.ended):
+                ready.append(sock)
+            else:
+                sock.ready = False
+        self._ready = ready
+        return (bool(self._listen_socket.waiting),
+                [sock.clid for sock in self._ready], [], [])
+
+    def _play_records(self):
+
+        # play the records in order, up to the current point in the recording
+        # when playing at the recorded speed, or as far as we can otherwise.
+        # A real player's data is read at most once per update, so we stop at
+        # a second record for the same player, or at a record for a player the
+        # server hasn't accepted yet, leaving the rest for the next update
+        if self._speed is not None:
+            upto = (_monotonic() - self.started) * self._speed
+        played = set()
+        while self._records:
+            when, kind, id, data = self._records[0]
+            if self._speed is not None and when > upto:
+                break
+
+            if kind == RECORD_CONNECT:
+                sock = self._sockets[id] = _MemorySocket()
+                self._listen_socket.waiting.append(
+                    (sock, data.decode("utf-8")))
+            else:
+                sock = self._sockets.get(id)
+                # skip records for players who were connected before the
+                # recording started, or who the server has disconnected
+                if sock is not None and not sock.closed:
+                    if sock.clid is None or id in played:
+                        break
+                    played.add(id)
+                    if kind == RECORD_DATA:
+                        sock.incoming.append(data)
+                        self.bytes_in += len(data)
+                    else:
+                        sock.ended = True
+                    if not sock.ready:
+                        sock.ready = True
+                        self._ready.append(sock)
+            self._records.popleft()
+
+        if not self._records:
+            self._played_all = True
+
+    def _accept_connection(self):
+
+        # accept the player as normal, then note the id number the server
+        # gave them on their socket, so that _poll can tell the server which
+        # player has sent something
+        clid = self._nextid
+        if not MudServer._accept_connection(self):
+            return False
+        cl = self._clients.get(clid)
+        if cl is not None:
+            cl.socket.clid = clid
+        return True
+
+    def _add_command(self, clid, command, params):
+        self.command_count += 1
+        MudServer._add_command(self, clid, command, params)
+
+
+def main():
+
+    # read the command line options
+    parser = argparse.ArgumentParser(
+        description="Plays a recording made with MudServer's "
+                    "'start_recording' method back to a MUD game, and reports "
+                    "how quickly the game handled it.")
+    parser.add_argument("recording", help="the recording file to play")
+    parser.add_argument("--game", default=os.path.join(
+                            os.path.dirname(os.path.abspath(__file__)),
+                            "simplemud.py"),
+                        help="the game script to run (default: simplemud.py)")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="play the recording at this many times the "
+                             "speed it was recorded at, e.g. 1 for real time "
+                             "(default: as fast as possible)")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the game while it runs, and show the "
+                             "functions it spent the most time in")
+    args = parser.parse_args()
+
+    # make the game create a ReplayServer when it thinks it's creating a
+    # MudServer
+    ReplayServer.recording = os.path.abspath(args.recording)
+    ReplayServer.speed = args.speed
+    mudserver.MudServer = ReplayServer
+
+    # run the game in a temporary directory, so that it doesn't change any
+    # files the real game uses, such as its saved players. The example game
+    # keeps its players next to its script unless told otherwise
+    game = os.path.abspath(args.game)
+    workdir = tempfile.mkdtemp(prefix="mudreplay-")
+    olddir = os.getcwd()
+    os.chdir(workdir)
+    sys.argv = [game]
+    if os.path.basename(game) == "simplemud.py":
+        sys.argv += ["--players", os.path.join(workdir, "players.db")]
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        runpy.run_path(game, run_name="__main__")
+        sys.exit("The game stopped before the recording finished")
+    except ReplayFinished as e:
+        server = e.server
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        os.chdir(olddir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # report how it went
+    elapsed = server.finished - server.started
+    print("Played {} players, {} commands and {} bytes in {:.3f} seconds "
+          "({} updates)".format(len(server._sockets), server.command_count,
+                                server.bytes_in, elapsed, server.polls))
+    print("Commands per second: {:.0f}".format(
+        server.command_count / elapsed if elapsed else 0))
+    print("Bytes sent to players: {}".format(server.get_bytes_out()))
+    if profiler is not None:
+        import pstats
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+
+if __name__ == "__main__":
+    main()
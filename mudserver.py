@@ -8,10 +8,47 @@ author: Mark Frimston - mfrimston@gmail.com
 """
 
 
+import os
 import socket
 import select
 import time
 import sys
+import errno
+import heapq
+import json
+import zlib
+import bisect
+import signal
+import struct
+import functools
+from array import array
+from itertools import islice, count
+from collections import deque
+
+# the 'selectors' module (Python 3.4+) lets us ask the operating system which
+# of many sockets are ready using a single call, using the most efficient
+# mechanism available (e.g. epoll on Linux). On older Pythons we fall back to
+# a single plain 'select' call over all the sockets instead
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+# the 'concurrent.futures' module (Python 3.2+, or the 'futures' package on
+# Python 2) provides the pools of worker threads and processes used to run
+# jobs. See 'start_job_pool' method
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None
+
+# a monotonic clock only ever goes forwards, even if the computer's clock is
+# changed, which makes it the right thing to use for measuring time intervals.
+# Python 2 doesn't have one, so there we make do with the normal clock
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    _monotonic = time.time
 
 
 class MudServer(object):
@@ -31,31 +68,246 @@ class MudServer(object):
     class _Client(object):
         """Holds information about a connected player"""
 
-        # the socket object used to communicate with this client
-        socket = None
-        # the ip address of this client
-        address = ""
-        # holds data send from the client until a full message is received
-        buffer = ""
-        # the last time we checked if the client was still connected
-        lastcheck = 0
+        # the names of the info we store. Listing them in '__slots__' means
+        # each _Client object keeps them in a small fixed-size table instead
+        # of a dictionary, which saves memory when lots of players are
+        # connected
+        __slots__ = ("socket", "address", "buffer", "read_state",
+                     "telnet_command", "lastcheck", "lastactive", "outqueue",
+                     "outbytes", "prepared", "dropped", "paused", "interest",
+                     "compressor", "compress_in", "compress_out",
+                     "overlong", "held", "throttled", "command_tokens",
+                     "byte_tokens", "tokens_time")
 
         def __init__(self, socket, address, buffer, lastcheck):
+            # the socket object used to communicate with this client
             self.socket = socket
+            # the ip address of this client
             self.address = address
+            # holds data send from the client until a full message is received
             self.buffer = buffer
+            # the Telnet state we were in at the end of the last data
+            # received. See _process_sent_data function
+            self.read_state = MudServer._READ_STATE_NORMAL
+            # the Telnet command ('will', 'wont', 'do' or 'dont') whose option
+            # code we're waiting for, when in the 'option' state
+            self.telnet_command = None
+            # the last time we checked if the client was still connected
             self.lastcheck = lastcheck
-
-    # Used to store different types of occurences
-    _EVENT_NEW_PLAYER = 1
-    _EVENT_PLAYER_LEFT = 2
-    _EVENT_COMMAND = 3
+            # the last time we received data from the client
+            self.lastactive = lastcheck
+            # queue of data waiting to be sent to the client, and its total
+            # size. Most of the time there's nothing waiting, so the queue is
+            # only created when needed and is None the rest of the time
+            self.outqueue = None
+            self.outbytes = 0
+            # how many items at the front of the queue are ready to be sent
+            # as they are. When compressing, these are the items which have
+            # already been compressed, which mustn't be changed or thrown away
+            self.prepared = 0
+            # the number of bytes discarded because the client wasn't keeping
+            # up
+            self.dropped = 0
+            # whether we've stopped reading from the client until it catches up
+            self.paused = False
+            # which socket events we're currently asking the selector about
+            self.interest = 0
+            # the zlib compressor for data sent to the client, if it has agreed
+            # to compression, and the number of bytes given to it and produced
+            # by it. See _handle_telnet_option function
+            self.compressor = None
+            self.compress_in = 0
+            self.compress_out = 0
+            # whether the line being received has gone over the length limit,
+            # so that the rest of it is being ignored
+            self.overlong = False
+            # commands received beyond the rate limit, waiting until the
+            # client is allowed more. Like the output queue, this is None
+            # until needed
+            self.held = None
+            # whether we've stopped reading from the client because it has
+            # gone over a rate limit
+            self.throttled = False
+            # how many more commands and bytes the client may send right now,
+            # and when these allowances were last topped up. See
+            # _refill_tokens function
+            self.command_tokens = 0
+            self.byte_tokens = 0
+            self.tokens_time = lastcheck
+
+    # An inner class which is instantiated to hold the measurements of how the
+    # server is running, if they've been switched on. See 'get_metrics' method
+
+    class _Metrics(object):
+        """Holds measurements of how the server is running"""
+
+        # the upper limits, in seconds, of the ranges that tick durations are
+        # counted in
+        TICK_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                        0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+        # the parts of each tick which are timed separately. See 'update'
+        # method
+        PHASES = ("game", "wait", "send", "accept", "read", "watched",
+                  "timers")
+
+        def __init__(self, now):
+            # when the measurements started
+            self.started = now
+            # the number of ticks, their total and longest durations, and how
+            # many fell into each of the ranges above (plus one for longer)
+            self.ticks = 0
+            self.tick_total = 0.0
+            self.tick_max = 0.0
+            self.tick_counts = [0] * (len(self.TICK_BUCKETS) + 1)
+            # the number of fixed-rate ticks which started late. See 'tick'
+            # method
+            self.overruns = 0
+            # the total time spent in each part of the tick, and the time spent
+            # in each part of the latest tick
+            self.phase_totals = dict((phase, 0.0) for phase in self.PHASES)
+            self.last_phases = dict(self.phase_totals)
+            # data and messages received from and sent to clients
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.messages_in = 0
+            self.messages_out = 0
+            self.dropped_bytes = 0
+            # the number of times clients have gone over each input limit
+            self.input_limited = {}
+            # data before and after compression, for compressed clients
+            self.compress_in = 0
+            self.compress_out = 0
+            # the number of clients connected, and disconnected for each reason
+            self.connections = 0
+            self.disconnects = {}
+            # when the current part of the tick started, and when the last
+            # 'update' call finished
+            self.mark = now
+            self.last_end = None
+            # function to call when a tick takes longer than the threshold, how
+            # often to profile a tick, and the profiler running, if any
+            self.slow_callback = None
+            self.slow_threshold = 0
+            self.profile_every = 0
+            self.profiler = None
+
+        def start_tick(self):
+            # the time since the last update finished was spent in the game's
+            # own code
+            now = _monotonic()
+            for phase in self.PHASES:
+                self.last_phases[phase] = 0.0
+            if self.last_end is not None:
+                self.last_phases["game"] = now - self.last_end
+            self.mark = now
+
+        def end_phase(self, phase):
+            # add the time since the last mark to the given part of the tick
+            now = _monotonic()
+            self.last_phases[phase] += now - self.mark
+            self.mark = now
+
+        def end_tick(self):
+            # the tick's duration is all the time spent working, i.e. not
+            # counting the time spent waiting for something to happen
+            self.last_end = self.mark
+            duration = 0.0
+            for phase, elapsed in self.last_phases.items():
+                self.phase_totals[phase] += elapsed
+                if phase != "wait":
+                    duration += elapsed
+            self.ticks += 1
+            self.tick_total += duration
+            self.tick_max = max(self.tick_max, duration)
+            self.tick_counts[bisect.bisect_left(self.TICK_BUCKETS,
+                                                duration)] += 1
+
+            # stop profiling, if we were, and pass the results to the slow tick
+            # function if this tick was slow
+            profile = self.profiler
+            self.profiler = None
+            if profile is not None:
+                profile.disable()
+            if (self.slow_callback is not None
+                    and duration > self.slow_threshold):
+                if profile is not None:
+                    import pstats
+                    profile = pstats.Stats(profile)
+                self.slow_callback(duration, dict(self.last_phases), profile)
+
+            # start profiling the next tick if it's one of those to be sampled.
+            # This covers the game's code as well as the next update
+            if self.profile_every and self.ticks % self.profile_every == 0:
+                import cProfile
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+
+    # An inner class which is instantiated for each job submitted to the job
+    # pool, to store info about it. See 'submit_job' method
+
+    class _Job(object):
+        """Holds information about a job"""
+
+        __slots__ = ("number", "player", "function", "args", "timeout",
+                     "future", "done")
+
+        def __init__(self, number, player, function, args, timeout):
+            # the job's number, and the id number of the player it's for
+            self.number = number
+            self.player = player
+            # the function to run, the arguments to pass to it, and how many
+            # seconds it may take
+            self.function = function
+            self.args = args
+            self.timeout = timeout
+            # the 'future' object which tracks the job while it runs
+            self.future = None
+            # whether the job's result has been handed over to the game
+            self.done = False
+
+    # The different types of occurences. See 'drain_events' method
+    EVENT_NEW_PLAYER = 1
+    EVENT_PLAYER_LEFT = 2
+    EVENT_COMMAND = 3
+    EVENT_JOB_DONE = 4
+
+    # Policies for clients which aren't reading their data fast enough. See
+    # _apply_slow_client_policy function
+    SLOW_CLIENT_DROP_OLDEST = "drop_oldest"
+    SLOW_CLIENT_DISCONNECT = "disconnect"
+    SLOW_CLIENT_PAUSE = "pause"
+
+    # Policies for clients which send more than they're allowed to. See
+    # _apply_input_policy function
+    INPUT_TRUNCATE = "truncate"
+    INPUT_DROP = "drop"
+    INPUT_DISCONNECT = "disconnect"
+
+    # Flags for the socket events we're interested in for each client. These
+    # are the same values as selectors.EVENT_READ and selectors.EVENT_WRITE
+    _WANT_READ = 1
+    _WANT_WRITE = 2
+
+    # the most separate pieces of data we'll hand to 'sendmsg' in one go. Most
+    # systems won't accept more than 1024
+    _MAX_SEND_BUFFERS = 1024
+
+    # how long a connection to the metrics socket may take to send its
+    # request and receive the answer before we close it, in seconds. See
+    # 'serve_metrics' method
+    _METRICS_REQUEST_TIMEOUT = 5.0
+
+    # the longest we'll spend sending clients their last messages when the
+    # server is shut down, in seconds. See 'shutdown' method
+    _SHUTDOWN_FLUSH_TIMEOUT = 1.0
 
     # Different states we can be in while reading data from client
     # See _process_sent_data function
     _READ_STATE_NORMAL = 1
     _READ_STATE_COMMAND = 2
     _READ_STATE_SUBNEG = 3
+    _READ_STATE_OPTION = 4
 
     # Command codes used by Telnet protocol
     # See _process_sent_data function
@@ -68,113 +320,559 @@ class MudServer(object):
     _TN_SUBNEGOTIATION_START = 250
     _TN_SUBNEGOTIATION_END = 240
 
+    # Telnet option codes. See _handle_telnet_option function
+    _TN_COMPRESS2 = 86
+
+    # Layout of the length sent before the server's details when handing
+    # over to a new process, and the most sockets passed over in a single
+    # message (Linux won't take more than 253). See 'hand_over' method
+    _HANDOVER_LENGTH = struct.Struct("!I")
+    _HANDOVER_SOCKETS_PER_MESSAGE = 200
+
     # socket used to listen for new clients
     _listen_socket = None
+    # selector object used to wait for activity on all of our sockets at once.
+    # None if the 'selectors' module isn't available
+    _selector = None
     # holds info on clients. Maps client id to _Client object
     _clients = {}
-    # counter for assigning each client a new id
+    # counter for assigning each client a new id, and how much to add to it
+    # each time
     _nextid = 0
-    # list of occurences waiting to be handled by the code
-    _events = []
-    # list of newly-added occurences
-    _new_events = []
-
-    def __init__(self):
+    _id_step = 1
+    # other sockets we're watching, such as those used to talk to other
+    # programs. Maps each socket to the function to call when it's readable.
+    # See _watch_socket function
+    _watched = {}
+    # queues of occurences waiting to be handled by the code, one for each
+    # type: new player ids, disconnected player ids and (id, command, params)
+    # tuples
+    _new_players = None
+    _left_players = None
+    _commands = None
+    # queues of newly-added occurences, which become the above on 'update'
+    _pending_new_players = None
+    _pending_left_players = None
+    _pending_commands = None
+    # queues of finished jobs, as (id, job number, result, error) tuples, like
+    # the queues above
+    _job_results = None
+    _pending_job_results = None
+    # functions to call as soon as each type of occurence happens, instead of
+    # queueing it. See 'on_connect', 'on_disconnect' and 'on_command' methods
+    _connect_callback = None
+    _disconnect_callback = None
+    _command_callback = None
+    _job_callback = None
+    # function to call when the server is shut down. See 'on_shutdown' method
+    _shutdown_callback = None
+    # functions to call when the program receives each signal, mapping the
+    # signal number to the function, the signals received but not yet
+    # handled, and the pair of connected sockets used to wake up 'update' when
+    # a signal arrives. See 'on_signal' method
+    _signal_callbacks = None
+    _pending_signals = None
+    _signal_wakeup_read = None
+    _signal_wakeup_write = None
+    # the game's details passed over from the process which handed over to
+    # this one. See 'hand_over' method
+    _handover_state = None
+    # the most data we'll hold for a client before treating it as too slow
+    _max_output_buffer = 0
+    # what to do with clients which go over the above limit
+    _slow_client_policy = SLOW_CLIENT_DISCONNECT
+    # the longest line of text we'll accept from a client, how many commands
+    # and bytes a client may send per second (None for no limit), and what to
+    # do with clients which go over these limits
+    _max_line_length = 4096
+    _max_commands_per_second = None
+    _max_bytes_per_second = None
+    _input_policy = INPUT_TRUNCATE
+    # ids of clients which have had data queued since the last flush
+    _dirty = set()
+    # the most new clients we'll accept during a single update
+    _max_accepts_per_update = 0
+    # how often, in seconds, to check that an idle client is still connected
+    _keepalive_interval = None
+    # how long, in seconds, a client can go without sending anything before
+    # we disconnect it. None means forever
+    _idle_timeout = None
+    # whether the operating system checks that clients are still connected,
+    # rather than us
+    _tcp_keepalive = False
+    # things scheduled to happen at a later time, kept as a heap. See _call_at
+    # function
+    _timers = []
+    # counter used to keep timers scheduled for the same time in order
+    _timer_counter = None
+    # numbers of the calls scheduled by the game with 'call_later' and
+    # 'call_every' which haven't run or been cancelled yet, and the counter
+    # used to number them
+    _live_calls = None
+    _call_counter = None
+    # when the next tick is due, as measured by the monotonic clock. See
+    # 'tick' method
+    _next_tick = None
+    # whether to offer to compress the data sent to clients
+    _compression = False
+    # pool of worker threads or processes which run jobs, or None if it hasn't
+    # been started. See 'start_job_pool' method
+    _job_executor = None
+    # the most jobs which can be waiting or running at once, in total and for a
+    # single player
+    _max_jobs = 0
+    _max_jobs_per_player = 0
+    # the number of jobs waiting or running, the counter used to number them,
+    # and the unfinished jobs of each player in the order they were submitted.
+    # Maps player id to a queue of _Job objects
+    _job_count = 0
+    _job_counter = None
+    _player_jobs = None
+    # jobs which the workers have finished, waiting to be handed to the game
+    _finished_jobs = None
+    # pair of connected sockets used by the workers to wake up 'update' when
+    # they finish a job
+    _job_wakeup_read = None
+    _job_wakeup_write = None
+    # object writing everything players send to a file, or None if we're not
+    # recording. See 'start_recording' method
+    _recorder = None
+    # measurements of how the server is running. None if they're switched off
+    _metrics = None
+    # socket listening for requests for the above, and the requests being
+    # received on it, mapping each connection to the data received so far,
+    # or once the request is complete, the part of the answer still to be
+    # sent. See 'serve_metrics' method
+    _metrics_socket = None
+    _metrics_requests = None
+    # the sockets of other kinds being watched which we're waiting to write to
+    # rather than read from. See _watch_socket function
+    _watched_for_write = None
+
+    def __init__(self, host="0.0.0.0", port=1234, backlog=128,
+                 max_accepts_per_update=256, max_output_buffer=256 * 1024,
+                 slow_client_policy=SLOW_CLIENT_DISCONNECT,
+                 keepalive_interval=5.0, idle_timeout=None,
+                 tcp_keepalive=False, reuse_port=False, metrics=False,
+                 compression=False, max_line_length=4096,
+                 max_commands_per_second=None, max_bytes_per_second=None,
+                 input_policy=INPUT_TRUNCATE, resume_from=None):
         """Constructs the MudServer object and starts listening for
         new players.
+
+        The server listens on the network address given by 'host' and
+        'port'. Up to 'backlog' players can be waiting to connect at
+        once, and up to 'max_accepts_per_update' of them are let in
+        during each call to 'update', so that lots of players arriving
+        at the same time (e.g. after a restart) get in quickly without
+        holding up everyone else.
+
+        Data sent to a player is queued and written to their connection
+        as fast as they can receive it. 'max_output_buffer' is how many
+        bytes may be waiting for a single player before they're treated
+        as too slow, in which case 'slow_client_policy' decides what
+        happens:
+
+            SLOW_CLIENT_DISCONNECT  - the player is disconnected
+            SLOW_CLIENT_DROP_OLDEST - the oldest waiting messages are
+                                      thrown away
+            SLOW_CLIENT_PAUSE       - commands from the player are not
+                                      read until their data has been sent
+
+        Every 'keepalive_interval' seconds that a player goes without
+        sending anything, the server checks they're still connected by
+        sending them an invisible character. If 'tcp_keepalive' is True
+        the operating system's own TCP keepalive checks are used instead,
+        which don't send anything the player's terminal can see. Players
+        who send nothing for 'idle_timeout' seconds are disconnected,
+        unless it is None.
+
+        If 'reuse_port' is True, several servers (e.g. in different
+        processes) can listen on the same port at once, with the
+        operating system sharing new players out between them. This is
+        only available on some systems, such as Linux.
+
+        If 'metrics' is True, the server measures how long each update
+        takes, how much data it handles and so on. See 'get_metrics'.
+        Measuring makes each update a little slower, so it's off by
+        default.
+
+        If 'compression' is True, the server offers to compress the data
+        it sends to players using MCCP (the MUD Client Compression
+        Protocol, version 2), which most MUD clients support. Text
+        compresses well, so this greatly reduces the amount of data sent.
+        Players whose clients don't support it are sent data as normal.
+
+        To stop one player flooding the server and slowing the game down
+        for everyone else, lines longer than 'max_line_length' bytes
+        aren't accepted. If 'max_commands_per_second' or
+        'max_bytes_per_second' is given, each player may only send that
+        many commands or bytes per second on average, with short bursts
+        of up to a second's worth allowed. Players who send too much are
+        dealt with according to 'input_policy':
+
+            INPUT_TRUNCATE   - long lines are cut short, and commands
+                               beyond the rate limit are held back (and
+                               the player's data not read) until the
+                               player is allowed more
+            INPUT_DROP       - long lines and commands beyond the rate
+                               limit are thrown away
+            INPUT_DISCONNECT - the player is disconnected
+
+        Going over the bytes per second limit never loses data - the
+        server just stops reading from the player for a while.
+
+        If 'resume_from' is given, instead of listening for players from
+        scratch, the server takes over the listen socket and players of
+        another server which is handing over to this one. See
+        'hand_over'.
         """
 
         self._clients = {}
         self._nextid = 0
-        self._events = []
-        self._new_events = []
-
-        # create a new tcp socket which will be used to listen for new clients
-        self._listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # set a special option on the socket which allows the port to be
-        # immediately without having to wait
-        self._listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
-                                       1)
-
-        # bind the socket to an ip address and port. Port 23 is the standard
-        # telnet port which telnet clients will use, however on some platforms
-        # this requires root permissions, so we use a higher arbitrary port
-        # number instead: 1234. Address 0.0.0.0 means that we will bind to all
-        # of the available network interfaces
-        self._listen_socket.bind(("0.0.0.0", 1234))
-
-        # set to non-blocking mode. This means that when we call 'accept', it
-        # will return immediately without waiting for a connection
-        self._listen_socket.setblocking(False)
-
-        # start listening for connections on the socket
-        self._listen_socket.listen(1)
-
-    def update(self):
+        self._watched = {}
+        self._watched_for_write = set()
+        self._init_events()
+        self._max_output_buffer = max_output_buffer
+        self._slow_client_policy = slow_client_policy
+        self._dirty = set()
+        self._max_accepts_per_update = max_accepts_per_update
+        self._keepalive_interval = keepalive_interval
+        self._idle_timeout = idle_timeout
+        self._tcp_keepalive = tcp_keepalive
+        self._timers = []
+        self._timer_counter = count()
+        self._live_calls = set()
+        self._call_counter = count()
+        self._compression = compression
+        self._max_line_length = max_line_length
+        self._max_commands_per_second = max_commands_per_second
+        self._max_bytes_per_second = max_bytes_per_second
+        self._input_policy = input_policy
+        if metrics:
+            self._enable_metrics()
+
+        # start listening for new clients, or take over from another server
+        if resume_from is not None:
+            self._resume(resume_from)
+        else:
+            self._start_listening(host, port, backlog, reuse_port)
+
+    def update(self, timeout=0):
         """Checks for new players, disconnected players, and new
         messages sent from players. This method must be called before
         up-to-date info can be obtained from the 'get_new_players',
         'get_disconnected_players' and 'get_commands' methods.
         It should be called in a loop to keep the game running.
+
+        The optional 'timeout' parameter is the maximum number of seconds
+        to wait for something to happen. The method returns as soon as a
+        player connects or sends data, or once the timeout has passed. The
+        default of 0 returns immediately, and None waits indefinitely. It
+        also returns when the server next needs to check on a player, so
+        there's no need to use a short timeout for the server's sake.
+
+        Messages sent since the last call are sent at the start of the
+        call, before waiting.
         """
 
-        # check for new stuff
-        self._check_for_new_connections()
-        self._check_for_disconnected()
-        self._check_for_messages()
+        # if metrics are switched on, note the time at the start of the tick
+        # and after each part of it
+        m = self._metrics
+        if m is not None:
+            m.start_tick()
+
+        # handle everything that happens within the timeout
+        self._handle_activity(timeout)
+
+        # make the new events available through 'get_new_players',
+        # 'get_disconnected_players', 'get_commands' and 'drain_events'. The
+        # previous events are discarded
+        self._move_pending_events()
+        if m is not None:
+            m.end_phase("send")
+            m.end_tick()
+
+    def tick(self, interval):
+        """Does the same job as 'update', but runs the game at a steady
+        rate of one tick every 'interval' seconds. Rather than returning
+        as soon as something happens, it keeps handling players' data
+        until the next tick is due, then makes everything that happened
+        since the last call available through 'get_new_players',
+        'get_disconnected_players', 'get_commands' etc. It should be
+        called in a loop to keep the game running.
+
+        Ticks are timed from the first call, not from the end of the
+        last one, so the time the game spends handling each tick doesn't
+        make the ticks drift further apart. If the game takes longer than
+        'interval' to handle a tick, the next tick starts straight away,
+        and any ticks missed altogether are skipped.
+
+        Returns how many seconds late the tick started, which is 0 unless
+        the game took too long handling the previous tick.
+        """
+        m = self._metrics
+        if m is not None:
+            m.start_tick()
+        now = _monotonic()
+
+        # the first tick is due one interval from now
+        if self._next_tick is None:
+            self._next_tick = now + interval
+
+        # if the game has used up the whole tick, we're late. Work out by how
+        # much, and skip any ticks which have been missed completely, so the
+        # game doesn't have to rush through them to catch up
+        late = max(0.0, now - self._next_tick)
+        if late:
+            if m is not None:
+                m.overruns += 1
+            self._next_tick += interval * int(late / interval)
+
+        # handle everything that happens before the tick is due. Each call
+        # returns when something happens, so keep going until time is up
+        while True:
+            self._handle_activity(max(0.0, self._next_tick - _monotonic()))
+            if _monotonic() >= self._next_tick:
+                break
+        self._next_tick += interval
+
+        # make the tick's events available, as 'update' does
+        self._move_pending_events()
+        if m is not None:
+            m.end_phase("send")
+            m.end_tick()
+        return late
+
+    def call_later(self, delay, function, *args):
+        """Arranges for 'function' to be called with the arguments 'args'
+        after 'delay' seconds, e.g. to make a monster attack a few seconds
+        after a player arrives. The function is called during 'update' (or
+        'tick'), so it can use the server's methods as normal. Returns a
+        number which can be passed to 'cancel_call'.
+
+        Scheduled calls are kept sorted by time, so having lots of them
+        doesn't slow the game down - only those which are due are looked
+        at.
+        """
+        number = next(self._call_counter)
+        self._live_calls.add(number)
+        self._call_at(_monotonic() + delay, self._run_call, number, function,
+                      args)
+        return number
+
+    def call_every(self, interval, function, *args):
+        """Arranges for 'function' to be called with the arguments 'args'
+        every 'interval' seconds, e.g. to let players' health recover or
+        to save the game, until cancelled with 'cancel_call'. The first
+        call is after 'interval' seconds. Returns a number which can be
+        passed to 'cancel_call'.
+
+        The calls are timed from when this method was called, so they
+        don't drift later however long the function takes. If the game
+        falls so far behind that calls are missed, they're skipped rather
+        than made all at once.
+        """
+        number = next(self._call_counter)
+        self._live_calls.add(number)
+        when = _monotonic() + interval
+        self._call_at(when, self._run_repeating_call, number, when, interval,
+                      function, args)
+        return number
+
+    def cancel_call(self, number):
+        """Cancels a call arranged with 'call_later' or 'call_every',
+        given the number they returned. Does nothing if the call has
+        already been made or cancelled.
+        """
+        self._live_calls.discard(number)
+
+    def _handle_activity(self, timeout):
+
+        # this does the work of 'update' and 'tick': sending, receiving and
+        # running timers, after waiting up to 'timeout' seconds for something
+        # to happen. The new events are left for the caller to make available
+        m = self._metrics
+
+        # send the messages queued up since the last update, before we go to
+        # sleep waiting for something to happen
+        self.flush()
+        if m is not None:
+            m.end_phase("send")
+
+        # don't wait beyond the time the next timer is due
+        if self._timers:
+            due = max(0, self._timers[0][0] - _monotonic())
+            if timeout is None or due < timeout:
+                timeout = due
+
+        # find out which sockets have something for us to read or are ready
+        # to be written to, waiting up to 'timeout' seconds for one to become
+        # ready. This is done with a single call no matter how many clients
+        # are connected
+        listen_ready, readable_ids, writable_ids, callbacks = \
+            self._poll(timeout)
+        if m is not None:
+            m.end_phase("wait")
+
+        # send any waiting data to clients which can now accept more
+        self._send_queued_data(writable_ids)
+        if m is not None:
+            m.end_phase("send")
 
-        # move the new events into the main events list so that they can be
-        # obtained with 'get_new_players', 'get_disconnected_players' and
-        # 'get_commands'. The previous events are discarded
-        self._events = list(self._new_events)
-        self._new_events = []
+        # check for new stuff
+        if listen_ready:
+            self._check_for_new_connections()
+        if m is not None:
+            m.end_phase("accept")
+        self._check_for_messages(readable_ids)
+        if m is not None:
+            m.end_phase("read")
+
+        # let anything else we're watching handle its data
+        for callback in callbacks:
+            callback()
+        if m is not None:
+            m.end_phase("watched")
+
+        # run anything scheduled for now, such as checking that idle clients
+        # are still connected
+        self._run_timers()
+        if m is not None:
+            m.end_phase("timers")
+
+        # send anything queued up while checking
+        self.flush()
 
     def get_new_players(self):
-        """Returns a list containing info on any new players that have
-        entered the game since the last call to 'update'. Each item in
-        the list is a player id number.
-        """
-        retval = []
-        # go through all the events in the main list
-        for ev in self._events:
-            # if the event is a new player occurence, add the info to the list
-            if ev[0] == self._EVENT_NEW_PLAYER:
-                retval.append(ev[1])
-        # return the info list
-        return retval
+        """Returns a sequence containing info on any new players that
+        have entered the game since the last call to 'update'. Each item
+        in the sequence is a player id number. The sequence is only
+        valid until the next call to 'update'.
+        """
+        return self._new_players
 
     def get_disconnected_players(self):
-        """Returns a list containing info on any players that have left
-        the game since the last call to 'update'. Each item in the list
-        is a player id number.
-        """
-        retval = []
-        # go through all the events in the main list
-        for ev in self._events:
-            # if the event is a player disconnect occurence, add the info to
-            # the list
-            if ev[0] == self._EVENT_PLAYER_LEFT:
-                retval.append(ev[1])
-        # return the info list
-        return retval
+        """Returns a sequence containing info on any players that have
+        left the game since the last call to 'update'. Each item in the
+        sequence is a player id number. The sequence is only valid until
+        the next call to 'update'.
+        """
+        return self._left_players
 
     def get_commands(self):
-        """Returns a list containing any commands sent from players
-        since the last call to 'update'. Each item in the list is a
+        """Returns a sequence containing any commands sent from players
+        since the last call to 'update'. Each item in the sequence is a
         3-tuple containing the id number of the sending player, a
         string containing the command (i.e. the first word of what
         they typed), and another string containing the text after the
-        command
+        command. The sequence is only valid until the next call to
+        'update'.
+        """
+        return self._commands
+
+    def get_job_results(self):
+        """Returns a sequence containing any jobs which have finished
+        since the last call to 'update' (see 'submit_job'). Each item in
+        the sequence is a 4-tuple containing the id number of the player
+        the job was submitted for, the job number, the value returned by
+        the job's function, and the exception it raised (or None if it
+        didn't raise one). The sequence is only valid until the next call
+        to 'update'.
+        """
+        return self._job_results
+
+    def drain_events(self):
+        """Iterates over, and removes, every occurence since the last call
+        to 'update': first new players, then disconnected players, then
+        commands, then finished jobs. Each item is a tuple whose first
+        item is one of EVENT_NEW_PLAYER, EVENT_PLAYER_LEFT, EVENT_COMMAND
+        or EVENT_JOB_DONE, followed by the id number of the player, and
+        for commands, the command and its parameters, or for jobs, the
+        job number, result and exception. This can be used instead of
+        the 'get_' methods to handle every type of occurence in a single
+        loop.
+        """
+        while self._new_players:
+            yield self.EVENT_NEW_PLAYER, self._new_players.popleft()
+        while self._left_players:
+            yield self.EVENT_PLAYER_LEFT, self._left_players.popleft()
+        while self._commands:
+            yield (self.EVENT_COMMAND,) + self._commands.popleft()
+        while self._job_results:
+            yield (self.EVENT_JOB_DONE,) + self._job_results.popleft()
+
+    def on_connect(self, callback):
+        """Registers a function to be called with the id number of each
+        new player as soon as they connect, instead of them appearing in
+        'get_new_players'. Returns the function, so this can be used as
+        a decorator. Pass None to go back to the normal behaviour.
+        """
+        self._connect_callback = callback
+        return callback
+
+    def on_disconnect(self, callback):
+        """Registers a function to be called with the id number of each
+        player that leaves as soon as they disconnect, instead of them
+        appearing in 'get_disconnected_players'. Returns the function, so
+        this can be used as a decorator. Pass None to go back to the
+        normal behaviour.
         """
-        retval = []
-        # go through all the events in the main list
-        for ev in self._events:
-            # if the event is a command occurence, add the info to the list
-            if ev[0] == self._EVENT_COMMAND:
-                retval.append((ev[1], ev[2], ev[3]))
-        # return the info list
-        return retval
+        self._disconnect_callback = callback
+        return callback
+
+    def on_command(self, callback):
+        """Registers a function to be called with the player id number,
+        command and parameters of each command as soon as it's received,
+        instead of it appearing in 'get_commands'. Returns the function,
+        so this can be used as a decorator. Pass None to go back to the
+        normal behaviour.
+        """
+        self._command_callback = callback
+        return callback
+
+    def on_job_done(self, callback):
+        """Registers a function to be called with the player id number,
+        job number, result and exception of each job as soon as it
+        finishes, instead of it appearing in 'get_job_results'. Returns the
+        function, so this can be used as a decorator. Pass None to go back
+        to the normal behaviour.
+        """
+        self._job_callback = callback
+        return callback
+
+    def on_shutdown(self, callback):
+        """Registers a function to be called with no arguments when
+        'shutdown' is called, before any players are disconnected, e.g.
+        to make sure the players' details are saved. Returns the function,
+        so this can be used as a decorator. Pass None to stop calling it.
+        """
+        self._shutdown_callback = callback
+        return callback
+
+    def on_signal(self, signum, callback):
+        """Registers a function to be called with no arguments when the
+        program receives the signal 'signum' (e.g. signal.SIGHUP, sent
+        with the 'kill' command). Unlike a normal signal handler, the
+        function is called during 'update', where it's safe to use the
+        server, and 'update' returns straight away rather than waiting
+        out its timeout. Must be called from the program's main thread.
+        """
+        # the first time, create a pair of connected sockets and ask Python
+        # to write to one of them whenever a signal arrives. We watch the
+        # other, so that waiting in 'update' ends as soon as there's a signal
+        if self._signal_callbacks is None:
+            self._signal_callbacks = {}
+            self._pending_signals = deque()
+            self._signal_wakeup_read, self._signal_wakeup_write = \
+                socket.socketpair()
+            self._signal_wakeup_read.setblocking(False)
+            self._signal_wakeup_write.setblocking(False)
+            signal.set_wakeup_fd(self._signal_wakeup_write.fileno())
+            self._watch_socket(self._signal_wakeup_read,
+                               self._check_for_signals)
+        self._signal_callbacks[signum] = callback
+        signal.signal(signum, self._handle_signal)
 
     def send_message(self, to, message):
         """Sends the text in the 'message' parameter to the player with
@@ -185,10 +883,494 @@ class MudServer(object):
         # message on its own line
         self._attempt_send(to, message+"\n\r")
 
+    def send_to_many(self, ids, message):
+        """Sends the text in the 'message' parameter to every player
+        whose id number is in 'ids'. This does the same as calling
+        'send_message' for each player, but the message is only
+        prepared once and the same copy is shared by all of them.
+        """
+        # convert the message to bytes once, then add the same bytes object to
+        # each player's queue
+        data = self._encode(message+"\n\r")
+        for id in ids:
+            self._queue_data(id, data)
+
+    def encode_message(self, message):
+        """Converts the text in the 'message' parameter into the bytes
+        that 'send_message' would send, ready to be passed to
+        'send_encoded'. Text which is sent often but rarely changes, such
+        as room descriptions, can be converted once and the result kept,
+        instead of being converted again every time it's sent.
+        """
+        return self._encode(message+"\n\r")
+
+    def send_encoded(self, to, data):
+        """Sends bytes produced by 'encode_message' to the player with
+        the id number given in the 'to' parameter. The same bytes are
+        queued for the player as they are, without being copied, so this
+        is the quickest way to send the same text over and over.
+        """
+        self._queue_data(to, data)
+
+    def broadcast(self, message, exclude=()):
+        """Sends the text in the 'message' parameter to every connected
+        player, apart from any whose id numbers are in 'exclude'.
+        """
+        data = self._encode(message+"\n\r")
+        for id in self._clients:
+            if id not in exclude:
+                self._queue_data(id, data)
+
+    def flush(self):
+        """Sends all the messages queued up by 'send_message' since the
+        last flush. Messages are queued so that everything sent to a
+        player during one update goes out together, and this is called
+        automatically by 'update', so it only needs calling directly if
+        messages must go out before the next update.
+        """
+        # go through each client which has had data queued, and send it
+        dirty = self._dirty
+        self._dirty = set()
+        for id in dirty:
+            cl = self._clients.get(id)
+            if cl is not None:
+                self._send_client_data(id, cl)
+
+    def get_compression(self, id):
+        """Returns a tuple giving how much compression has saved for the
+        player with the given id number: the number of bytes sent to them
+        before compression, the number after, and the ratio of the two
+        (e.g. 0.2 if the data was compressed to a fifth of its size).
+        Returns None if the player isn't using compression.
+        """
+        cl = self._clients.get(id)
+        if cl is None or cl.compressor is None:
+            return None
+        ratio = float(cl.compress_out) / cl.compress_in if cl.compress_in \
+            else 1.0
+        return cl.compress_in, cl.compress_out, ratio
+
+    def get_metrics(self):
+        """Returns a dictionary of measurements of how the server is
+        running, or None if metrics aren't switched on (see the 'metrics'
+        parameter of the constructor). The measurements are:
+
+            uptime_seconds       - seconds since measuring started
+            ticks                - the number of calls to 'update' (or
+                                   'tick')
+            tick_overruns        - the number of calls to 'tick' which
+                                   came too late to keep to the tick rate
+            tick_seconds         - how long the ticks took: 'sum', 'max',
+                                   'last', and 'buckets', a list of
+                                   [limit, count] pairs giving how many
+                                   ticks took up to 'limit' seconds
+            phase_seconds        - the total time spent in each part of
+                                   the ticks (see below)
+            last_tick_phases     - the time spent in each part of the
+                                   latest tick
+            bytes_in, bytes_out  - data received from and sent to players
+            messages_in          - commands received from players
+            messages_out         - messages queued to be sent to players
+            dropped_bytes        - data thrown away for slow players
+            input_limited        - the number of times players went over
+                                   each input limit: 'line_length',
+                                   'command_rate' or 'byte_rate'
+            compression          - 'bytes_in' given to and 'bytes_out'
+                                   produced by compression, and the
+                                   number of 'clients' using it
+            connections          - the number of players who have connected
+            disconnects          - the number of players who have left, by
+                                   reason: 'closed', 'error', 'idle',
+                                   'slow' or 'flood'
+            clients              - the number of players connected now
+            event_queues         - the number of new players, disconnected
+                                   players and commands from the latest
+                                   update
+            outbound             - data waiting to be sent: 'bytes' in
+                                   total, 'max_client_bytes' for a single
+                                   player, and 'clients' with data waiting
+
+        A tick is one call to 'update' plus the time the game's code spent
+        before the next call. Its parts are 'game' (the game's code),
+        'wait' (waiting for something to happen, which doesn't count
+        towards the tick's duration), 'send', 'accept' (new players),
+        'read' (data from players), 'watched' (other sockets) and 'timers'
+        (e.g. checking for disconnected players).
+        """
+        m = self._metrics
+        if m is None:
+            return None
+
+        # measure the data waiting to be sent to each client
+        queued = [cl.outbytes for cl in self._clients.values()]
+
+        buckets = []
+        total = 0
+        for limit, n in zip(m.TICK_BUCKETS + ("+Inf",), m.tick_counts):
+            total += n
+            buckets.append([limit, total])
+        return {
+            "uptime_seconds": _monotonic() - m.started,
+            "ticks": m.ticks,
+            "tick_overruns": m.overruns,
+            "tick_seconds": {
+                "sum": m.tick_total,
+                "max": m.tick_max,
+                "last": sum(elapsed for phase, elapsed
+                            in m.last_phases.items() if phase != "wait"),
+                "buckets": buckets,
+            },
+            "phase_seconds": dict(m.phase_totals),
+            "last_tick_phases": dict(m.last_phases),
+            "bytes_in": m.bytes_in,
+            "bytes_out": m.bytes_out,
+            "messages_in": m.messages_in,
+            "messages_out": m.messages_out,
+            "dropped_bytes": m.dropped_bytes,
+            "input_limited": dict(m.input_limited),
+            "compression": {
+                "bytes_in": m.compress_in,
+                "bytes_out": m.compress_out,
+                "clients": len([cl for cl in self._clients.values()
+                                if cl.compressor is not None]),
+            },
+            "connections": m.connections,
+            "disconnects": dict(m.disconnects),
+            "clients": len(self._clients),
+            "event_queues": {
+                "new_players": len(self._new_players),
+                "left_players": len(self._left_players),
+                "commands": len(self._commands),
+            },
+            "outbound": {
+                "bytes": sum(queued),
+                "max_client_bytes": max(queued) if queued else 0,
+                "clients": len([b for b in queued if b]),
+            },
+        }
+
+    def get_metrics_text(self):
+        """Returns the measurements from 'get_metrics' as text in the
+        format read by the Prometheus monitoring system, or None if
+        metrics aren't switched on.
+        """
+        metrics = self.get_metrics()
+        if metrics is None:
+            return None
+
+        # each measurement has a line giving its type, followed by a line for
+        # its value. Some have several values told apart by labels, e.g. the
+        # time spent in each phase
+        lines = []
+
+        def add(name, kind, values):
+            lines.append("# TYPE mudpi_{} {}".format(name, kind))
+            for labels, value in values:
+                lines.append("mudpi_{}{} {}".format(name, labels, value))
+
+        ticks = metrics["tick_seconds"]
+        add("uptime_seconds", "gauge", [("", metrics["uptime_seconds"])])
+        add("tick_seconds", "histogram",
+            [('_bucket{{le="{}"}}'.format(limit), n)
+             for limit, n in ticks["buckets"]]
+            + [("_sum", ticks["sum"]), ("_count", metrics["ticks"])])
+        add("tick_overruns_total", "counter",
+            [("", metrics["tick_overruns"])])
+        add("phase_seconds_total", "counter",
+            [('{{phase="{}"}}'.format(phase), elapsed)
+             for phase, elapsed in sorted(metrics["phase_seconds"].items())])
+        for name in ("bytes_in", "bytes_out", "messages_in", "messages_out",
+                     "dropped_bytes", "connections"):
+            add(name + "_total", "counter", [("", metrics[name])])
+        add("disconnects_total", "counter",
+            [('{{reason="{}"}}'.format(reason), n)
+             for reason, n in sorted(metrics["disconnects"].items())])
+        add("input_limited_total", "counter",
+            [('{{limit="{}"}}'.format(limit), n)
+             for limit, n in sorted(metrics["input_limited"].items())])
+        add("clients", "gauge", [("", metrics["clients"])])
+        add("event_queue_length", "gauge",
+            [('{{queue="{}"}}'.format(queue), n)
+             for queue, n in sorted(metrics["event_queues"].items())])
+        for name, n in sorted(metrics["outbound"].items()):
+            add("outbound_" + name, "gauge", [("", n)])
+        add("compression_bytes_in_total", "counter",
+            [("", metrics["compression"]["bytes_in"])])
+        add("compression_bytes_out_total", "counter",
+            [("", metrics["compression"]["bytes_out"])])
+        add("compression_clients", "gauge",
+            [("", metrics["compression"]["clients"])])
+        return "\n".join(lines) + "\n"
+
+    def serve_metrics(self, address):
+        """Starts answering requests for the server's measurements on a
+        separate address, for use by monitoring tools. This switches
+        metrics on if they aren't already. 'address' is either a
+        (host, port) tuple, e.g. ("127.0.0.1", 9100), or the path of a
+        Unix socket to create. Don't use an address which can be reached
+        from the internet.
+
+        An HTTP request for '/metrics' (as made by Prometheus) is answered
+        using 'get_metrics_text', and any other request with the result
+        of 'get_metrics' as JSON. Plain requests without HTTP work too,
+        e.g. 'echo metrics | nc localhost 9100'.
+        """
+        self._enable_metrics()
+        self._metrics_requests = {}
+
+        # create the listening socket, either a network socket or a Unix one
+        if isinstance(address, tuple):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+        sock.setblocking(False)
+        sock.listen(5)
+
+        # requests are handled during 'update', along with everything else
+        self._metrics_socket = sock
+        self._watch_socket(sock, self._accept_metrics_request)
+
+    def on_slow_tick(self, callback, threshold=0.05, profile_every=0):
+        """Registers a function to be called whenever a tick (see
+        'get_metrics') takes longer than 'threshold' seconds. This
+        switches metrics on if they aren't already. The function is called
+        with the tick's duration, a dictionary of the time spent in each
+        part of it, and a profile of the tick or None.
+
+        If 'profile_every' is more than 0, every tick with a number that
+        is a multiple of it is run under Python's profiler, and if it's
+        slow the results are passed to the function as a 'pstats.Stats'
+        object, e.g. to print with 'profile.sort_stats("cumtime")
+        .print_stats(10)'. Profiling makes ticks much slower, so only
+        profile occasional ticks. Returns the function, so this can be
+        used as a decorator. Pass None to stop calling it.
+        """
+        self._enable_metrics()
+        self._metrics.slow_callback = callback
+        self._metrics.slow_threshold = threshold
+        self._metrics.profile_every = profile_every
+        return callback
+
+    def start_job_pool(self, workers=4, processes=False, max_jobs=1000,
+                       max_jobs_per_player=10):
+        """Starts a pool of 'workers' threads, or processes if 'processes'
+        is True, for running jobs submitted with 'submit_job'. Up to
+        'max_jobs' jobs can be waiting or running at once, and up to
+        'max_jobs_per_player' for any one player. Requires Python 3.2 or
+        later, or the 'futures' package on Python 2.
+        """
+        if concurrent is None:
+            raise RuntimeError("The job pool needs the concurrent.futures "
+                               "module")
+        if processes:
+            self._job_executor = concurrent.futures.ProcessPoolExecutor(
+                workers)
+        else:
+            self._job_executor = concurrent.futures.ThreadPoolExecutor(
+                workers)
+        self._max_jobs = max_jobs
+        self._max_jobs_per_player = max_jobs_per_player
+        self._job_counter = count()
+        self._player_jobs = {}
+        self._finished_jobs = deque()
+
+        # create a connected pair of sockets. The workers write to one when
+        # they finish a job, and we watch the other one, so that 'update'
+        # wakes up as soon as a job finishes
+        self._job_wakeup_read, self._job_wakeup_write = socket.socketpair()
+        self._job_wakeup_read.setblocking(False)
+        self._job_wakeup_write.setblocking(False)
+        self._watch_socket(self._job_wakeup_read,
+                           self._check_for_finished_jobs)
+
+    def submit_job(self, id, function, args=(), timeout=None):
+        """Runs 'function' with the arguments in 'args' on the job pool
+        (see 'start_job_pool'), so that slow work such as searching a
+        database doesn't hold up the game. The job is run for the player
+        with the given id number - each player's jobs are run one at a
+        time, in the order they were submitted, and their results come
+        back in that order too.
+
+        The function runs outside the game's main loop, so it mustn't
+        change the game's data or call the server's methods. Instead, it
+        should return a result, which is made available along with the
+        job's number once the job finishes - see 'get_job_results'. If
+        'timeout' is given and the job takes longer than that many
+        seconds, it finishes with a TimeoutError instead. Results still
+        arrive for players who have left, so check the player is still
+        around before using one.
+
+        Returns the job's number, or None if there are already too many
+        jobs waiting, in which case the job isn't run.
+        """
+        if self._job_executor is None:
+            raise RuntimeError("start_job_pool must be called first")
+
+        # turn the job down if there are too many waiting already
+        queue = self._player_jobs.get(id)
+        if (self._job_count >= self._max_jobs or
+                (queue is not None
+                 and len(queue) >= self._max_jobs_per_player)):
+            return None
+
+        # add the job to the player's queue, and start it straight away if
+        # the player has no other jobs waiting
+        job = MudServer._Job(next(self._job_counter), id, function,
+                             tuple(args), timeout)
+        self._job_count += 1
+        if queue is None:
+            queue = self._player_jobs[id] = deque()
+        queue.append(job)
+        if len(queue) == 1:
+            self._start_job(job)
+        return job.number
+
+    def hand_over(self, command, state=None, timeout=30.0):
+        """Hands the game over to a new process without disconnecting any
+        players, e.g. to restart it with changed code. Should be called
+        between calls to 'update', once the game has handled the latest
+        occurences.
+
+        The new process is started by running 'command', a list of the
+        program and its arguments, with the path of a Unix socket added
+        to the end. The new process must pass that path to MudServer as
+        'resume_from'. While it starts up, the game carries on as normal,
+        with anything that happens being passed on to the new process.
+        Then the listen socket, every player's connection and everything
+        the server knows about them (half-typed commands, Telnet state,
+        unsent messages) are passed to the new process. 'state' can be
+        any data that can be stored as JSON, such as the players' details
+        - the new process gets it from 'get_handover_state'.
+
+        Returns True once the new process has taken over, after which
+        this server no longer has any players and the program should
+        finish (calling 'shutdown' is fine). Returns False, with the game
+        carrying on as before, if the new process didn't take over within
+        'timeout' seconds, or straight away if this version of Python
+        can't pass sockets to another process (this needs Python 3 and
+        Unix sockets).
+
+        If the server is recording, the new process can carry on with the
+        same recording by passing 'append=True' to 'start_recording'.
+        """
+        # passing sockets to another process needs 'sendmsg', which Python 2
+        # and Windows don't have
+        if not hasattr(socket.socket, "sendmsg"):
+            return False
+
+        import shutil
+        import tempfile
+        import subprocess
+
+        # create a Unix socket in a new private directory, for the new
+        # process to connect to
+        directory = tempfile.mkdtemp(prefix="mudpi-handover-")
+        path = os.path.join(directory, "handover")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn = None
+        try:
+            listener.bind(path)
+            listener.listen(1)
+            listener.setblocking(False)
+
+            # start the new process, and keep the game running while it
+            # starts up, until it connects to us. If it fails to start, or
+            # takes too long, give up on it
+            process = subprocess.Popen(list(command) + [path])
+            connected = []
+            self._watch_socket(listener,
+                               functools.partial(connected.append, True))
+            deadline = _monotonic() + timeout
+            while (not connected and process.poll() is None
+                   and _monotonic() < deadline):
+                self._handle_activity(min(0.1, deadline - _monotonic()))
+            self._unwatch_socket(listener)
+            if not connected:
+                if process.poll() is None:
+                    process.kill()
+                return False
+
+            conn, addr = listener.accept()
+            conn.setblocking(True)
+            conn.settimeout(timeout)
+            return self._send_handover(conn, state)
+        finally:
+            listener.close()
+            if conn is not None:
+                conn.close()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def get_handover_state(self):
+        """Returns the 'state' passed to 'hand_over' by the process which
+        handed over to this one, or None if it wasn't started that way.
+        """
+        return self._handover_state
+
+    def start_recording(self, path, append=False):
+        """Starts writing everything players send to the server, along
+        with when they connect and disconnect, to a file at 'path'. The
+        recording can be played back to the game without any real
+        players using 'mudreplay.py', e.g. to measure how quickly the
+        game handles it. Players who are already connected are left out.
+
+        Any file already at 'path' is replaced, unless 'append' is True,
+        in which case a recording already there is carried on - e.g. by a
+        server which has been handed over to (see 'hand_over'), whose
+        players were recorded connecting by the previous one.
+        """
+        # the recorder lives in its own module, as it's only needed here
+        from mudreplay import Recorder
+        self.stop_recording()
+        self._recorder = Recorder(path, append)
+
+    def stop_recording(self):
+        """Stops the recording started by 'start_recording', if any, and
+        closes its file.
+        """
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+
     def shutdown(self):
         """Closes down the server, disconnecting all clients and
         closing the listen socket.
         """
+        # let the game do anything it needs to before we close down
+        if self._shutdown_callback is not None:
+            self._shutdown_callback()
+
+        # send the clients whatever is still waiting to go to them, such as a
+        # goodbye message sent by the shutdown callback
+        self._flush_before_closing(self._SHUTDOWN_FLUSH_TIMEOUT)
+
+        # stop answering requests for metrics
+        if self._metrics_socket is not None:
+            for conn in list(self._metrics_requests):
+                conn.close()
+            if self._metrics_socket.family != socket.AF_INET:
+                try:
+                    os.unlink(self._metrics_socket.getsockname())
+                except OSError:
+                    pass
+            self._metrics_socket.close()
+
+        # finish recording, if we are
+        self.stop_recording()
+
+        # stop listening for signals
+        if self._signal_callbacks is not None:
+            signal.set_wakeup_fd(-1)
+            self._signal_wakeup_read.close()
+            self._signal_wakeup_write.close()
+
+        # stop the job pool, without waiting for running jobs to finish
+        if self._job_executor is not None:
+            self._job_executor.shutdown(wait=False)
+            self._job_wakeup_read.close()
+            self._job_wakeup_write.close()
+
         # for each client
         for cl in self._clients.values():
             # close the socket, disconnecting the client
@@ -196,179 +1378,1057 @@ class MudServer(object):
             cl.socket.close()
         # stop listening for new clients
         self._listen_socket.close()
+        if self._selector is not None:
+            self._selector.close()
 
     def _attempt_send(self, clid, data):
+        # convert the text to bytes and queue it to be sent
+        self._queue_data(clid, self._encode(data))
+
+    def _encode(self, data):
         # python 2/3 compatability fix - convert non-unicode string to unicode
         if sys.version < '3' and type(data) != unicode:
             data = unicode(data, "latin1")
+        # convert the text into the bytes to be sent over the network
+        return data.encode("latin1")
+
+    def _queue_data(self, clid, data):
+
+        # look up the client in the client map. If there is no client with the
+        # given id there's nothing to do
+        cl = self._clients.get(clid)
+        if cl is None:
+            return
+
+        # add the data to the end of the client's queue, creating the queue if
+        # needed, and note that the client has data to send at the next flush.
+        # The data is never changed once queued, so the same bytes object can
+        # safely sit in many queues
+        if cl.outqueue is None:
+            cl.outqueue = deque()
+        cl.outqueue.append(data)
+        cl.outbytes += len(data)
+        self._dirty.add(clid)
+        if self._metrics is not None:
+            self._metrics.messages_out += 1
+
+    def _send_client_data(self, clid, cl):
+
+        # send data from the front of the client's queue until either the queue
+        # is empty or the socket won't take any more for now. The socket is
+        # non-blocking, so sending never waits - it returns how many bytes it
+        # managed to send, which may be less than we gave it
+        while cl.outqueue:
+
+            # if the client is using compression, compress the waiting data
+            # once everything compressed before has been sent. Only compressed
+            # data may be sent to the client from now on
+            if cl.compressor is not None:
+                if not cl.prepared:
+                    self._compress_queue(cl)
+                limit = cl.prepared
+            else:
+                limit = self._MAX_SEND_BUFFERS
+
+            try:
+                # where possible, use 'sendmsg' to hand over many queued
+                # messages in a single call without joining them together first
+                if hasattr(cl.socket, "sendmsg"):
+                    sent = cl.socket.sendmsg(
+                        list(islice(cl.outqueue, min(limit,
+                                                     self._MAX_SEND_BUFFERS))))
+                # otherwise join the whole queue into one piece of data and
+                # send that
+                else:
+                    if cl.compressor is None and len(cl.outqueue) > 1:
+                        data = b"".join(d if isinstance(d, bytes)
+                                        else d.tobytes()
+                                        for d in cl.outqueue)
+                        cl.outqueue.clear()
+                        cl.outqueue.append(data)
+                    sent = cl.socket.send(cl.outqueue[0])
+            except socket.error as e:
+                # this error means the socket's buffer is full. The client is
+                # still connected, we just need to try again later
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                # any other error is a connection problem with the client (e.g.
+                # they have disconnected)
+                self._handle_disconnect(clid, "error")
+                return
+            cl.outbytes -= sent
+            if self._metrics is not None:
+                self._metrics.bytes_out += sent
+            # remove the messages which were sent completely from the queue
+            while cl.outqueue and sent >= len(cl.outqueue[0]):
+                sent -= len(cl.outqueue.popleft())
+                if cl.prepared:
+                    cl.prepared -= 1
+            # if only part of a message was sent, keep the rest at the front of
+            # the queue, and stop as the socket won't take any more for now. A
+            # memoryview lets us do this without copying the data
+            if sent:
+                cl.outqueue[0] = memoryview(cl.outqueue[0])[sent:]
+                break
+
+        # once everything has been sent, let go of the empty queue to save
+        # memory
+        if not cl.outqueue:
+            cl.outqueue = None
+
+        # if the client has too much data waiting, deal with it according to
+        # the slow client policy. If it has caught up, we can read from it
+        # again
+        if cl.outbytes > self._max_output_buffer:
+            self._apply_slow_client_policy(clid, cl)
+            if clid not in self._clients:
+                return
+        elif cl.paused:
+            cl.paused = False
+
+        # make sure the selector tells us when we can write more data
+        self._update_interest(clid, cl)
+
+    def _apply_slow_client_policy(self, clid, cl):
+
+        # disconnect the client
+        if self._slow_client_policy == self.SLOW_CLIENT_DISCONNECT:
+            self._handle_disconnect(clid, "slow")
+
+        # throw away the oldest waiting messages until the queue is small
+        # enough. The message at the front may already be partly sent, so we
+        # leave that one alone. We also leave alone anything already
+        # compressed, as each piece of compressed data depends on what came
+        # before it
+        elif self._slow_client_policy == self.SLOW_CLIENT_DROP_OLDEST:
+            keep = max(1, cl.prepared)
+            while (cl.outbytes > self._max_output_buffer
+                    and len(cl.outqueue) > keep):
+                kept = [cl.outqueue.popleft() for i in range(keep)]
+                dropped = cl.outqueue.popleft()
+                cl.outqueue.extendleft(reversed(kept))
+                cl.outbytes -= len(dropped)
+                cl.dropped += len(dropped)
+                if self._metrics is not None:
+                    self._metrics.dropped_bytes += len(dropped)
+
+        # stop reading commands from the client until it has caught up
+        elif self._slow_client_policy == self.SLOW_CLIENT_PAUSE:
+            cl.paused = True
+
+    def _compress_queue(self, cl):
+
+        # compress all the data waiting in the client's queue into a single
+        # piece of data, which replaces it. The compressor carries on from
+        # where it left off, so data repeated from earlier (such as room
+        # descriptions) compresses really well. The 'sync flush' makes sure
+        # the client receives everything we've compressed so far, so it can
+        # show it straight away
+        size = cl.outbytes
+        data = b"".join([cl.compressor.compress(d) for d in cl.outqueue]
+                        + [cl.compressor.flush(zlib.Z_SYNC_FLUSH)])
+        cl.outqueue.clear()
+        cl.outqueue.append(data)
+        cl.outbytes = len(data)
+        cl.prepared = 1
+
+        # keep count of how much compression has saved
+        cl.compress_in += size
+        cl.compress_out += len(data)
+        if self._metrics is not None:
+            self._metrics.compress_in += size
+            self._metrics.compress_out += len(data)
+
+    def _update_interest(self, clid, cl):
+
+        # work out which events we want to hear about for this client: whether
+        # it has sent data, unless it's paused or throttled, and whether its
+        # socket can take more data, if there's some waiting to be sent
+        interest = 0
+        if not cl.paused and not cl.throttled:
+            interest |= self._WANT_READ
+        if cl.outqueue:
+            interest |= self._WANT_WRITE
+
+        # tell the selector, but only if something has changed
+        if interest != cl.interest and self._selector is not None:
+            self._selector.modify(cl.socket, interest, clid)
+        cl.interest = interest
+
+    def _flush_before_closing(self, timeout):
+
+        # stop reading from the clients, so that we only hear about sockets
+        # which can take more data
+        for clid, cl in self._clients.items():
+            cl.throttled = True
+            self._update_interest(clid, cl)
+
+        # send as much as we can straight away, then keep sending to the
+        # clients which still have data waiting as their sockets take more.
+        # Clients which don't take it all within 'timeout' seconds miss out,
+        # so that a stuck client can't stop the server from shutting down
+        self.flush()
+        deadline = _monotonic() + timeout
+        while any(cl.outqueue for cl in self._clients.values()):
+            remaining = deadline - _monotonic()
+            if remaining <= 0:
+                break
+            listen_ready, readable_ids, writable_ids, callbacks = \
+                self._poll(remaining)
+            self._send_queued_data(writable_ids)
+
+    def _send_queued_data(self, writable_ids):
+
+        # go through the clients whose sockets can take more data, and send
+        # them as much of their waiting data as we can
+        for id in writable_ids:
+            cl = self._clients.get(id)
+            if cl is not None:
+                self._send_client_data(id, cl)
+
+    def _init_events(self):
+
+        # create the empty queues of occurences
+        self._new_players = deque()
+        self._left_players = deque()
+        self._commands = deque()
+        self._pending_new_players = deque()
+        self._pending_left_players = deque()
+        self._pending_commands = deque()
+        self._job_results = deque()
+        self._pending_job_results = deque()
+
+    def _move_pending_events(self):
+
+        # swap the queues of new occurences with the ones the code reads from,
+        # then empty the new ones ready for the next update. Swapping means
+        # nothing has to be copied
+        self._new_players, self._pending_new_players = \
+            self._pending_new_players, self._new_players
+        self._left_players, self._pending_left_players = \
+            self._pending_left_players, self._left_players
+        self._commands, self._pending_commands = \
+            self._pending_commands, self._commands
+        self._job_results, self._pending_job_results = \
+            self._pending_job_results, self._job_results
+        self._pending_new_players.clear()
+        self._pending_left_players.clear()
+        self._pending_commands.clear()
+        self._pending_job_results.clear()
+
+    def _add_new_player(self, clid):
+
+        # pass the new player's id number to the registered function if there
+        # is one, otherwise queue it up
+        if self._connect_callback is not None:
+            self._connect_callback(clid)
+        else:
+            self._pending_new_players.append(clid)
+
+    def _add_player_left(self, clid):
+
+        # pass the disconnected player's id number to the registered function
+        # if there is one, otherwise queue it up
+        if self._disconnect_callback is not None:
+            self._disconnect_callback(clid)
+        else:
+            self._pending_left_players.append(clid)
+
+    def _add_command(self, clid, command, params):
+
+        # pass the command to the registered function if there is one,
+        # otherwise queue it up
+        if self._command_callback is not None:
+            self._command_callback(clid, command, params)
+        else:
+            self._pending_commands.append((clid, command, params))
+        if self._metrics is not None:
+            self._metrics.messages_in += 1
+
+    def _add_job_result(self, clid, number, result, error):
+
+        # pass the finished job to the registered function if there is one,
+        # otherwise queue it up
+        if self._job_callback is not None:
+            self._job_callback(clid, number, result, error)
+        else:
+            self._pending_job_results.append((clid, number, result, error))
+
+    def _start_job(self, job):
+
+        # hand the job to the pool, which runs it as soon as a worker is free.
+        # When it finishes, the pool calls _job_finished from the worker's
+        # thread
+        job.future = self._job_executor.submit(job.function, *job.args)
+        job.future.add_done_callback(
+            functools.partial(self._job_finished, job))
+
+        # if the job has a time limit, check on it once the time is up
+        if job.timeout is not None:
+            self._call_at(_monotonic() + job.timeout, self._job_timed_out,
+                          job)
+
+    def _job_finished(self, job, future):
+
+        # this is called from a worker's thread, so it mustn't touch anything
+        # else the game uses. Adding to a deque is safe from any thread, so we
+        # add the job to the finished jobs and wake up 'update' by writing to
+        # the wakeup socket. If the socket is full, 'update' has plenty of
+        # wakeups waiting already
+        self._finished_jobs.append(job)
         try:
-            # look up the client in the client map and use 'sendall' to send
-            # the message string on the socket. 'sendall' ensures that all of
-            # the data is sent in one go
-            self._clients[clid].socket.sendall(bytearray(data, "latin1"))
-        # KeyError will be raised if there is no client with the given id in
-        # the map
-        except KeyError:
+            self._job_wakeup_write.send(b"x")
+        except socket.error:
             pass
-        # If there is a connection problem with the client (e.g. they have
-        # disconnected) a socket error will be raised
+
+    def _check_for_finished_jobs(self):
+
+        # empty the wakeup socket, then hand over each finished job's result,
+        # or the exception it raised
+        try:
+            while self._job_wakeup_read.recv(4096):
+                pass
         except socket.error:
-            self._handle_disconnect(clid)
+            pass
+        while self._finished_jobs:
+            job = self._finished_jobs.popleft()
+            # a job which took too long has already been dealt with
+            if job.done:
+                continue
+            try:
+                result, error = job.future.result(), None
+            except Exception as e:
+                result, error = None, e
+            self._finish_job(job, result, error)
+
+    def _job_timed_out(self, job):
+
+        # called by a timer when a job's time is up. If it's still waiting or
+        # running, it finishes with an error. A job which has already started
+        # can't be stopped, but its result will be ignored
+        if not job.done:
+            job.future.cancel()
+            self._finish_job(job, None, concurrent.futures.TimeoutError(
+                "Job took longer than {} seconds".format(job.timeout)))
+
+    def _finish_job(self, job, result, error):
+
+        # take the job off the front of its player's queue, and start the
+        # player's next job, if there is one
+        job.done = True
+        self._job_count -= 1
+        queue = self._player_jobs[job.player]
+        queue.popleft()
+        if queue:
+            self._start_job(queue[0])
+        else:
+            del(self._player_jobs[job.player])
+
+        # add a 'job done' occurence
+        self._add_job_result(job.player, job.number, result, error)
+
+    def _call_at(self, when, callback, *args):
+
+        # schedule 'callback' to be called with 'args' at the time 'when', as
+        # measured by the monotonic clock. The timers are kept in a heap, which
+        # is a list arranged so that the earliest timer is always at the front
+        # and adding a timer is quick no matter how many there are. The counter
+        # keeps timers due at the same time in the order they were added
+        heapq.heappush(self._timers,
+                       (when, next(self._timer_counter), callback, args))
+
+    def _run_call(self, number, function, args):
+
+        # make a call scheduled by 'call_later', unless it has been cancelled
+        if number in self._live_calls:
+            self._live_calls.discard(number)
+            function(*args)
+
+    def _run_repeating_call(self, number, when, interval, function, args):
+
+        # make a call scheduled by 'call_every', unless it has been cancelled.
+        # The next call is scheduled first, so that the function can cancel
+        # it. It's due one interval after this one was due, not after now, so
+        # that the calls don't gradually drift later. If we're so late that
+        # we've missed some calls altogether, we skip them
+        if number not in self._live_calls:
+            return
+        when += interval
+        now = _monotonic()
+        if when <= now:
+            when += interval * (int((now - when) / interval) + 1)
+        self._call_at(when, self._run_repeating_call, number, when, interval,
+                      function, args)
+        function(*args)
+
+    def _run_timers(self):
+
+        # call each timer whose time has come, earliest first. We only look at
+        # the front of the heap, so timers which aren't due yet cost nothing
+        now = _monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            when, n, callback, args = heapq.heappop(self._timers)
+            callback(*args)
+
+    def _check_client_alive(self, clid):
+
+        # this is called by a timer for each client. If the client has since
+        # disconnected there's nothing to do
+        cl = self._clients.get(clid)
+        if cl is None:
+            return
+        now = _monotonic()
 
-    def _check_for_new_connections(self):
+        # if the client has been quiet for too long, disconnect it
+        if (self._idle_timeout is not None
+                and now - cl.lastactive >= self._idle_timeout):
+            self._handle_disconnect(clid, "idle")
+            return
+
+        nextcheck = None
+
+        # unless the operating system is checking for us, if we haven't heard
+        # from the client or checked on it recently, send the client an
+        # invisible character. It doesn't actually matter what we send, we're
+        # really just checking that data can still be written to the socket.
+        # If it can't, an error will be raised and we'll know that the client
+        # has disconnected.
+        if self._keepalive_interval is not None and not self._tcp_keepalive:
+            if (now - max(cl.lastactive, cl.lastcheck)
+                    >= self._keepalive_interval):
+                self._attempt_send(clid, "\x00")
+                cl.lastcheck = now
+            nextcheck = (max(cl.lastactive, cl.lastcheck)
+                         + self._keepalive_interval)
+
+        # we also need to check again when the client's idle time runs out
+        if self._idle_timeout is not None:
+            idletime = cl.lastactive + self._idle_timeout
+            if nextcheck is None or idletime < nextcheck:
+                nextcheck = idletime
+
+        # schedule the next check
+        if nextcheck is not None:
+            self._call_at(nextcheck, self._check_client_alive, clid)
+
+    def _enable_metrics(self):
+
+        # start measuring how the server is running, if we aren't already
+        if self._metrics is None:
+            self._metrics = MudServer._Metrics(_monotonic())
+
+    def _accept_metrics_request(self):
+
+        # accept each waiting connection to the metrics socket, and watch it
+        # for the request
+        while True:
+            try:
+                conn, addr = self._metrics_socket.accept()
+            except socket.error:
+                return
+            conn.setblocking(False)
+            self._metrics_requests[conn] = b""
+            self._watch_socket(conn, functools.partial(
+                self._read_metrics_request, conn))
+
+            # don't let a connection which never sends a request, or never
+            # reads the answer, hang around for ever
+            self._call_at(_monotonic() + self._METRICS_REQUEST_TIMEOUT,
+                          self._close_metrics_request, conn)
+
+    def _read_metrics_request(self, conn):
 
-        # 'select' is used to check whether there is data waiting to be read
-        # from the socket. We pass in 3 lists of sockets, the first being those
-        # to check for readability. It returns 3 lists, the first being
-        # the sockets that are readable. The last parameter is how long to wait
-        # - we pass in 0 so that it returns immediately without waiting
-        rlist, wlist, xlist = select.select([self._listen_socket], [], [], 0)
-
-        # if the socket wasn't in the readable list, there's no data available,
-        # meaning no clients waiting to connect, and so we can exit the method
-        # here
-        if self._listen_socket not in rlist:
+        # read what's arrived of the request
+        try:
+            data = conn.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b""
+        request = self._metrics_requests[conn] + data
+        self._metrics_requests[conn] = request
+
+        # wait for the end of the request: the first line, or for HTTP the
+        # blank line after the headers. We give up waiting if the connection
+        # is closed or the request gets too long
+        words = request.split(b"\n", 1)[0].split()
+        http = len(words) == 3 and words[2].startswith(b"HTTP/")
+        if data and len(request) < 8192:
+            if b"\n" not in request:
+                return
+            if http and b"\n\r\n" not in request and b"\n\n" not in request:
+                return
+
+        # send back the metrics in the format asked for, with HTTP headers if
+        # it was an HTTP request
+        path = words[1] if http else (words[0] if words else b"")
+        if path.strip(b"/") in (b"metrics", b"prometheus"):
+            body = self.get_metrics_text()
+            content_type = "text/plain; version=0.0.4"
+        else:
+            body = json.dumps(self.get_metrics(), sort_keys=True) + "\n"
+            content_type = "application/json"
+        body = body.encode("latin1")
+        if http:
+            body = ("HTTP/1.0 200 OK\r\nContent-Type: {}\r\n"
+                    "Content-Length: {}\r\nConnection: close\r\n\r\n"
+                    .format(content_type, len(body)).encode("latin1") + body)
+
+        # stop reading, and send back the answer. The answer is small, so
+        # usually it all goes straight away. If not, we send the rest once the
+        # socket can take more, rather than holding up the game waiting
+        self._unwatch_socket(conn)
+        self._metrics_requests[conn] = body
+        self._send_metrics_answer(conn)
+        if conn in self._metrics_requests:
+            self._watch_socket(conn, functools.partial(
+                self._send_metrics_answer, conn), write=True)
+
+    def _send_metrics_answer(self, conn):
+
+        # send as much of the answer as the socket will take. Once it's all
+        # gone, or if the connection has a problem, close the connection
+        data = self._metrics_requests[conn]
+        try:
+            sent = conn.send(data)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            sent = len(data)
+        if sent < len(data):
+            self._metrics_requests[conn] = data[sent:]
             return
+        self._close_metrics_request(conn)
 
-        # 'accept' returns a new socket and address info which can be used to
-        # communicate with the new client
-        joined_socket, addr = self._listen_socket.accept()
+    def _close_metrics_request(self, conn):
 
-        # set non-blocking mode on the new socket. This means that 'send' and
-        # 'recv' will return immediately without waiting
-        joined_socket.setblocking(False)
+        # close a connection to the metrics socket, unless it's already closed
+        if conn not in self._metrics_requests:
+            return
+        if conn in self._watched:
+            self._unwatch_socket(conn)
+        del(self._metrics_requests[conn])
+        conn.close()
 
-        # construct a new _Client object to hold info about the newly connected
-        # client. Use 'nextid' as the new client's id number
-        self._clients[self._nextid] = MudServer._Client(joined_socket, addr[0],
-                                                        "", time.time())
+    def _start_listening(self, host, port, backlog, reuse_port):
 
-        # add a new player occurence to the new events list with the player's
-        # id number
-        self._new_events.append((self._EVENT_NEW_PLAYER, self._nextid))
+        # create a new tcp socket which will be used to listen for new clients
+        self._listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-        # add 1 to 'nextid' so that the next client to connect will get a
-        # unique id number
-        self._nextid += 1
+        # set a special option on the socket which allows the port to be
+        # immediately without having to wait
+        self._listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                                       1)
 
-    def _check_for_disconnected(self):
+        # if asked to, set another option which allows other sockets to listen
+        # on the same port
+        if reuse_port:
+            self._listen_socket.setsockopt(socket.SOL_SOCKET,
+                                           socket.SO_REUSEPORT, 1)
 
-        # go through all the clients
-        for id, cl in list(self._clients.items()):
+        # bind the socket to an ip address and port. Port 23 is the standard
+        # telnet port which telnet clients will use, however on some platforms
+        # this requires root permissions, so by default we use a higher
+        # arbitrary port number instead: 1234. The default address 0.0.0.0
+        # means that we will bind to all of the available network interfaces
+        self._listen_socket.bind((host, port))
 
-            # if we last checked the client less than 5 seconds ago, skip this
-            # client and move on to the next one
-            if time.time() - cl.lastcheck < 5.0:
-                continue
+        # set to non-blocking mode. This means that when we call 'accept', it
+        # will return immediately without waiting for a connection
+        self._listen_socket.setblocking(False)
+
+        # start listening for connections on the socket. The backlog is how
+        # many clients the operating system will hold waiting for us to accept
+        # them - any more than that are turned away
+        self._listen_socket.listen(backlog)
+
+        self._create_selector()
+
+    def _create_selector(self):
+
+        # register the listen socket with the selector so that we're told
+        # when new clients are waiting to connect. Each registered socket
+        # carries a piece of data with it - for the listen socket this is None,
+        # for client sockets it will be the client's id number
+        if selectors is not None:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self._listen_socket, selectors.EVENT_READ,
+                                    None)
+
+    def _poll(self, timeout):
+
+        # if the selector is available, ask it for every registered socket
+        # which is ready to be read from or written to. The parameter is how
+        # long to wait - the operating system puts us to sleep until a socket
+        # is ready or the timeout passes, so no CPU time is used while we wait.
+        # It returns a list of (key, events) pairs, where 'key.data' is the
+        # value we stored when registering the socket: None for the listen
+        # socket, the client id for client sockets, or the function to call
+        # for other watched sockets
+        if self._selector is not None:
+            listen_ready = False
+            readable_ids = []
+            writable_ids = []
+            callbacks = []
+            try:
+                ready = self._selector.select(timeout)
+            except (select.error, OSError) as e:
+                # a signal arriving while we wait can interrupt the wait (see
+                # _interrupted). That just means nothing has happened yet
+                if not self._interrupted(e):
+                    raise
+                ready = []
+            for key, events in ready:
+                if key.data is None:
+                    listen_ready = True
+                    continue
+                if callable(key.data):
+                    callbacks.append(key.data)
+                    continue
+                if events & selectors.EVENT_READ:
+                    readable_ids.append(key.data)
+                if events & selectors.EVENT_WRITE:
+                    writable_ids.append(key.data)
+            return listen_ready, readable_ids, writable_ids, callbacks
+
+        # otherwise, use 'select' to check all the sockets at once. We pass in
+        # 3 lists of sockets, the first being those to check for readability
+        # and the second those to check for writability. It returns 3 lists,
+        # the first being the sockets that are readable and the second those
+        # that are writable. The last parameter is how long to wait, as above
+        socket_ids = dict((cl.socket, id) for id, cl in self._clients.items())
+        readers = [cl.socket for cl in self._clients.values()
+                   if cl.interest & self._WANT_READ]
+        writers = [cl.socket for cl in self._clients.values()
+                   if cl.interest & self._WANT_WRITE]
+        readers.extend(s for s in self._watched
+                       if s not in self._watched_for_write)
+        writers.extend(self._watched_for_write)
+        try:
+            rlist, wlist, xlist = select.select(
+                [self._listen_socket] + readers, writers, [], timeout)
+        except (select.error, OSError) as e:
+            if not self._interrupted(e):
+                raise
+            return False, [], [], []
+        listen_ready = self._listen_socket in rlist
+        readable_ids = [socket_ids[s] for s in rlist if s in socket_ids]
+        writable_ids = [socket_ids[s] for s in wlist if s in socket_ids]
+        callbacks = [self._watched[s] for s in rlist + wlist
+                     if s in self._watched]
+        return listen_ready, readable_ids, writable_ids, callbacks
+
+    def _interrupted(self, error):
+
+        # whether an error raised while waiting for sockets was caused by a
+        # signal arriving. Python 3 carries on waiting by itself, but Python 2
+        # gives up with an EINTR error. The signal is handled on the next
+        # update, through the wakeup socket (see 'on_signal')
+        return bool(error.args) and error.args[0] == errno.EINTR
+
+    def _watch_socket(self, sock, callback, write=False):
+
+        # start watching another socket, such as one used to talk to another
+        # program. 'callback' will be called during 'update' whenever the
+        # socket has data to be read, or if 'write' is True, whenever more
+        # data can be written to it
+        self._watched[sock] = callback
+        if write:
+            self._watched_for_write.add(sock)
+        if self._selector is not None:
+            self._selector.register(
+                sock, selectors.EVENT_WRITE if write else selectors.EVENT_READ,
+                callback)
+
+    def _unwatch_socket(self, sock):
+
+        # stop watching a socket added with _watch_socket
+        del(self._watched[sock])
+        self._watched_for_write.discard(sock)
+        if self._selector is not None:
+            self._selector.unregister(sock)
+
+    def _check_for_new_connections(self):
 
-            # send the client an invisible character. It doesn't actually
-            # matter what we send, we're really just checking that data can
-            # still be written to the socket. If it can't, an error will be
-            # raised and we'll know that the client has disconnected.
-            self._attempt_send(id, "\x00")
+        # accept clients until there are none left waiting, or we've reached
+        # the limit for this update. Any still waiting will be accepted on the
+        # next update
+        for i in range(self._max_accepts_per_update):
+            if not self._accept_connection():
+                break
 
-            # update the last check time
-            cl.lastcheck = time.time()
+    def _accept_connection(self):
 
-    def _check_for_messages(self):
+        # 'accept' returns a new socket and address info which can be used to
+        # communicate with the new client. The listen socket is non-blocking,
+        # so if there are no more clients waiting (or the client gave up
+        # before we got to it) a socket error is raised and we return False
+        try:
+            joined_socket, addr = self._listen_socket.accept()
+        except socket.error:
+            return False
+
+        # set non-blocking mode on the new socket. This means that 'send' and
+        # 'recv' will return immediately without waiting
+        joined_socket.setblocking(False)
+
+        # construct a new _Client object to hold info about the newly connected
+        # client. Use 'nextid' as the new client's id number
+        cl = MudServer._Client(joined_socket, addr[0], bytearray(),
+                               _monotonic())
+        cl.interest = self._WANT_READ
+        self._clients[self._nextid] = cl
 
-        # go through all the clients
-        for id, cl in list(self._clients.items()):
+        # the client starts off with a full allowance of commands and bytes
+        cl.command_tokens = max(1, self._max_commands_per_second or 0)
+        cl.byte_tokens = self._max_bytes_per_second or 0
 
-            # we use 'select' to test whether there is data waiting to be read
-            # from the client socket. The function takes 3 lists of sockets,
-            # the first being those to test for readability. It returns 3 list
-            # of sockets, the first being those that are actually readable.
-            rlist, wlist, xlist = select.select([cl.socket], [], [], 0)
+        # register the new socket with the selector so that we're told when
+        # the client sends us data, noting the client's id number with it
+        if self._selector is not None:
+            self._selector.register(joined_socket, cl.interest, self._nextid)
 
-            # if the client socket wasn't in the readable list, there is no
-            # new data from the client - we can skip it and move on to the next
+        # add 1 to 'nextid' so that the next client to connect will get a
+        # unique id number
+        clid = self._nextid
+        self._nextid += self._id_step
+
+        # ask the operating system to check that the client is still connected
+        # when it's been quiet for a while, if we've been told to
+        if self._tcp_keepalive:
+            self._enable_tcp_keepalive(joined_socket)
+
+        # start checking that the client is still connected
+        self._check_client_alive(clid)
+
+        # offer to compress the data we send the client, if we've been told
+        # to. The client says yes by replying 'do', or no with 'dont'. See
+        # _handle_telnet_option function
+        if self._compression:
+            self._queue_data(clid, bytes(bytearray([
+                self._TN_INTERPRET_AS_COMMAND, self._TN_WILL,
+                self._TN_COMPRESS2])))
+
+        # add a new player occurence with the player's id number
+        if self._metrics is not None:
+            self._metrics.connections += 1
+        if self._recorder is not None:
+            self._recorder.connect(clid, cl.address)
+        self._add_new_player(clid)
+        return True
+
+    def _enable_tcp_keepalive(self, sock):
+
+        # switch on TCP keepalive checks for the socket. Where the operating
+        # system allows it, we also set how long the connection has to be
+        # quiet before checking ('idle'), how long to wait between checks
+        # ('interval') and how many checks can fail before the connection is
+        # closed ('count')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        interval = int(self._keepalive_interval or 0)
+        if interval > 0:
+            for option, value in (("TCP_KEEPIDLE", interval),
+                                  ("TCP_KEEPINTVL", interval),
+                                  ("TCP_KEEPCNT", 3)):
+                if hasattr(socket, option):
+                    sock.setsockopt(socket.IPPROTO_TCP,
+                                    getattr(socket, option), value)
+
+    def _check_for_messages(self, ready_ids):
+
+        # go through the clients whose sockets have data waiting to be read
+        for id in ready_ids:
+
+            # the client may have been disconnected, paused or throttled since
+            # we polled, in which case we can skip it and move on to the next
             # one
-            if cl.socket not in rlist:
+            cl = self._clients.get(id)
+            if cl is None or cl.paused or cl.throttled:
                 continue
+            now = _monotonic()
+
+            # if the client is limited in how many bytes it may send, don't
+            # read more than it's allowed. If it has used up its allowance,
+            # stop reading from it until it has earned a tenth of a second's
+            # worth (or a full read's worth, if less), so that a client sending
+            # flat out doesn't wake us up too often. The data waits in the
+            # operating system's buffers, and once they're full the client has
+            # to wait too
+            size = 4096
+            if self._max_bytes_per_second is not None:
+                self._refill_tokens(cl, now)
+                if cl.byte_tokens < 1:
+                    rate = self._max_bytes_per_second
+                    self._throttle(id, cl, "byte_rate",
+                                   (min(size, max(1, rate / 10.0))
+                                    - cl.byte_tokens) / rate)
+                    continue
+                size = min(size, int(cl.byte_tokens))
 
             try:
                 # read data from the socket, using a max length of 4096
-                data = cl.socket.recv(4096).decode("latin1")
-
-                # process the data, stripping out any special Telnet commands
-                message = self._process_sent_data(cl, data)
+                data = cl.socket.recv(size)
+
+                # if the socket was readable but there was no data, the client
+                # has closed the connection
+                if not data:
+                    self._handle_disconnect(id, "closed")
+                    continue
+
+                # note that we've heard from the client, and take what it sent
+                # from its allowance
+                cl.lastactive = now
+                cl.byte_tokens -= len(data)
+                if self._metrics is not None:
+                    self._metrics.bytes_in += len(data)
+                if self._recorder is not None:
+                    self._recorder.data(id, data)
+
+                # handle the received data
+                self._handle_data(id, cl, data)
 
-                # if there was a message in the data
-                if message:
+            # if there is a problem reading from the socket (e.g. the client
+            # has disconnected) a socket error will be raised
+            except socket.error:
+                self._handle_disconnect(id, "error")
 
-                    # remove any spaces, tabs etc from the start and end of
-                    # the message
-                    message = message.strip()
+    def _handle_data(self, clid, client, data):
 
-                    # separate the message into the command (the first word)
-                    # and its parameters (the rest of the message)
-                    command, params = (message.split(" ", 1) + ["", ""])[:2]
+        # process the data, stripping out any special Telnet commands, and go
+        # through each complete message (i.e. line of text) it contained
+        for message in self._process_sent_data(clid, client, data):
 
-                    # add a command occurence to the new events list with the
-                    # player's id number, the command and its parameters
-                    self._new_events.append((self._EVENT_COMMAND, id,
-                                             command.lower(), params))
+            # skip empty lines
+            if not message:
+                continue
 
-            # if there is a problem reading from the socket (e.g. the client
-            # has disconnected) a socket error will be raised
-            except socket.error:
-                self._handle_disconnect(id)
+            # if the client is limited in how many commands it may send, take
+            # the command from its allowance. If it has run out, or has earlier
+            # commands still being held back, deal with it according to the
+            # input policy
+            if self._max_commands_per_second is not None:
+                if client.held is None:
+                    self._refill_tokens(client, client.lastactive)
+                if client.held is not None or client.command_tokens < 1:
+                    self._apply_input_policy(clid, client, "command_rate",
+                                             message)
+                    if clid not in self._clients:
+                        return
+                    continue
+                client.command_tokens -= 1
+
+            self._add_message(clid, message)
+
+        # if the line being received went over the length limit, deal with it
+        # according to the input policy. Disconnecting is done here, as soon
+        # as the limit is reached. Otherwise the line is cut short or thrown
+        # away once it's complete - see _end_line function
+        if (client.overlong and self._input_policy == self.INPUT_DISCONNECT
+                and clid in self._clients):
+            self._apply_input_policy(clid, client, "line_length")
+
+    def _add_message(self, clid, message):
+
+        # remove any spaces, tabs etc from the start and end of the message
+        message = message.strip()
+
+        # separate the message into the command (the first word) and its
+        # parameters (the rest of the message)
+        command, params = (message.split(" ", 1) + ["", ""])[:2]
+
+        # add a command occurence with the player's id number, the command
+        # and its parameters
+        self._add_command(clid, command.lower(), params)
+
+    def _apply_input_policy(self, clid, cl, limit, message=None):
+
+        # count the client going over the limit
+        if self._metrics is not None:
+            self._metrics.input_limited[limit] = \
+                self._metrics.input_limited.get(limit, 0) + 1
+
+        # disconnect the client
+        if self._input_policy == self.INPUT_DISCONNECT:
+            self._handle_disconnect(clid, "flood")
+
+        # hold back a command beyond the rate limit until the client is
+        # allowed another, and stop reading from the client in the meantime.
+        # Long lines have already been cut short
+        elif self._input_policy == self.INPUT_TRUNCATE:
+            if message is not None:
+                if cl.held is None:
+                    cl.held = deque()
+                    self._throttle(clid, cl, None,
+                                   (1 - cl.command_tokens)
+                                   / self._max_commands_per_second)
+                cl.held.append(message)
+
+        # otherwise the command or line is simply thrown away
+
+    def _refill_tokens(self, cl, now):
+
+        # the client's allowances work like buckets which are topped up at a
+        # steady rate (the limit per second) and hold up to a second's worth.
+        # Each command or byte received takes one out of its bucket, so a
+        # client can send a quick burst, but not keep sending faster than the
+        # limit. Rather than topping them up all the time, we work out how
+        # much to add whenever we look at them
+        elapsed = now - cl.tokens_time
+        cl.tokens_time = now
+        if self._max_commands_per_second is not None:
+            cl.command_tokens = min(
+                max(1, self._max_commands_per_second),
+                cl.command_tokens + elapsed * self._max_commands_per_second)
+        if self._max_bytes_per_second is not None:
+            cl.byte_tokens = min(
+                self._max_bytes_per_second,
+                cl.byte_tokens + elapsed * self._max_bytes_per_second)
+
+    def _throttle(self, clid, cl, limit, delay):
+
+        # stop reading from the client, and start again after 'delay' seconds
+        # when it has earned more allowance
+        if limit is not None and self._metrics is not None:
+            self._metrics.input_limited[limit] = \
+                self._metrics.input_limited.get(limit, 0) + 1
+        cl.throttled = True
+        self._update_interest(clid, cl)
+        self._call_at(_monotonic() + delay, self._unthrottle, clid)
+
+    def _unthrottle(self, clid):
+
+        # this is called by a timer once a throttled client has earned more
+        # allowance. If the client has since disconnected there's nothing to
+        # do
+        cl = self._clients.get(clid)
+        if cl is None:
+            return
+        cl.throttled = False
+
+        # hand over as many of the held back commands as the client is now
+        # allowed. If some are still left, wait a while longer
+        if cl.held is not None:
+            self._refill_tokens(cl, _monotonic())
+            while cl.held and cl.command_tokens >= 1:
+                cl.command_tokens -= 1
+                self._add_message(clid, cl.held.popleft())
+                if clid not in self._clients:
+                    return
+            if cl.held:
+                self._throttle(clid, cl, None,
+                               (1 - cl.command_tokens)
+                               / self._max_commands_per_second)
+                return
+            cl.held = None
+
+        # start reading from the client again
+        self._update_interest(clid, cl)
+
+    def _handle_disconnect(self, clid, reason="closed"):
+
+        # if the client has already been removed there's nothing to do
+        if clid not in self._clients:
+            return
 
-    def _handle_disconnect(self, clid):
+        # count the reason the client left: 'closed' if it closed the
+        # connection, 'error' for a connection problem, 'idle' if it was quiet
+        # for too long, 'slow' if it wasn't reading its data and 'flood' if it
+        # sent too much. If we're recording, note the reason in the recording
+        if self._metrics is not None:
+            self._metrics.disconnects[reason] = \
+                self._metrics.disconnects.get(reason, 0) + 1
+        if self._recorder is not None:
+            self._recorder.disconnect(clid, reason)
 
         # remove the client from the clients map
-        del(self._clients[clid])
+        cl = self._clients.pop(clid)
+
+        # stop watching the client's socket and close it
+        if self._selector is not None:
+            self._selector.unregister(cl.socket)
+        cl.socket.close()
 
-        # add a 'player left' occurence to the new events list, with the
-        # player's id number
-        self._new_events.append((self._EVENT_PLAYER_LEFT, clid))
+        # add a 'player left' occurence with the player's id number
+        self._add_player_left(clid)
 
-    def _process_sent_data(self, client, data):
+    def _process_sent_data(self, clid, client, data):
 
         # the Telnet protocol allows special command codes to be inserted into
-        # messages. For our very simple server we don't need to response to
-        # any of these codes, but we must at least detect and skip over them
-        # so that we don't interpret them as text data.
+        # messages. We must detect and skip over them so that we don't
+        # interpret them as text data, and reply to the ones which ask about
+        # the Telnet 'options' we support (see _handle_telnet_option).
         # More info on the Telnet protocol can be found here:
         # http://pcmicro.com/netfoss/telnet.html
 
-        # start with no message and in the normal state
-        message = None
-        state = self._READ_STATE_NORMAL
+        # 'data' is the raw bytes received from the client. We return a list
+        # of the complete messages (lines of text) found in it. Anything after
+        # the last newline is kept in the client's buffer to be completed by
+        # the next data received
+        messages = []
+
+        # most of the time the data is just typed text. If we're in the normal
+        # state and there are no Telnet command or backspace codes in the data
+        # we can skip going through it a byte at a time, and instead just
+        # search for the newlines that separate the messages
+        if (client.read_state == self._READ_STATE_NORMAL
+                and data.find(b"\xff") == -1 and data.find(b"\x08") == -1):
+            start = 0
+            end = data.find(b"\n")
+            while end != -1:
+                # the usual case is a short line which arrived all in one go,
+                # which can be decoded straight from the data. Otherwise it's
+                # added to the rest of the line in the buffer, and checked
+                # against the length limit
+                if (not client.buffer and not client.overlong
+                        and end - start <= self._max_line_length):
+                    messages.append(data[start:end].decode("latin1"))
+                else:
+                    self._add_to_line(client, data, start, end)
+                    self._end_line(client, messages)
+                start = end + 1
+                end = data.find(b"\n", start)
+            self._add_to_line(client, data, start, len(data))
+            return messages
 
-        # go through the data a character at a time
-        for c in data:
+        # otherwise, carry on from whatever state we were left in by the last
+        # data received
+        state = client.read_state
 
-            # handle the character differently depending on the state we're in:
+        # go through the data a byte at a time. Going through a bytearray
+        # gives us each byte as a number
+        for c in bytearray(data):
+
+            # handle the byte differently depending on the state we're in:
 
             # normal state
             if state == self._READ_STATE_NORMAL:
 
                 # if we received the special 'interpret as command' code,
                 # switch to 'command' state so that we handle the next
-                # character as a command code and not as regular text data
-                if ord(c) == self._TN_INTERPRET_AS_COMMAND:
+                # byte as a command code and not as regular text data
+                if c == self._TN_INTERPRET_AS_COMMAND:
                     state = self._READ_STATE_COMMAND
 
                 # if we get a newline character, this is the end of the
-                # message. Set 'message' to the contents of the buffer and
-                # clear the buffer
-                elif c == "\n":
-                    message = client.buffer
-                    client.buffer = ""
+                # message. Add the contents of the buffer to the list of
+                # messages and clear the buffer
+                elif c == 0x0a:
+                    self._end_line(client, messages)
 
                 # some telnet clients send the characters as soon as the user
                 # types them. So if we get a backspace character, this is where
                 # the user has deleted a character and we should delete the
                 # last character from the buffer.
-                elif c == "\x08":
-                    client.buffer = client.buffer[:-1]
+                elif c == 0x08:
+                    del client.buffer[-1:]
 
                 # otherwise it's just a regular character - add it to the
-                # buffer where we're building up the received message
+                # buffer where we're building up the received message, unless
+                # the message is already as long as we allow
+                elif len(client.buffer) < self._max_line_length:
+                    client.buffer.append(c)
                 else:
-                    client.buffer += c
+                    client.overlong = True
 
             # command state
             elif state == self._READ_STATE_COMMAND:
@@ -377,29 +2437,348 @@ class MudServer(object):
                 # that the following characters are a list of options until
                 # we're told otherwise. We switch into 'subnegotiation' state
                 # to handle this
-                if ord(c) == self._TN_SUBNEGOTIATION_START:
+                if c == self._TN_SUBNEGOTIATION_START:
                     state = self._READ_STATE_SUBNEG
 
                 # if the command code is one of the 'will', 'wont', 'do' or
-                # 'dont' commands, the following character will be an option
-                # code so we must remain in the 'command' state
-                elif ord(c) in (self._TN_WILL, self._TN_WONT, self._TN_DO,
-                                self._TN_DONT):
-                    state = self._READ_STATE_COMMAND
+                # 'dont' commands, the following byte will be an option
+                # code, which we handle in the 'option' state. We note which
+                # command it was
+                elif c in (self._TN_WILL, self._TN_WONT, self._TN_DO,
+                           self._TN_DONT):
+                    client.telnet_command = c
+                    state = self._READ_STATE_OPTION
 
                 # for all other command codes, there is no accompanying data so
                 # we can return to 'normal' state.
                 else:
                     state = self._READ_STATE_NORMAL
 
+            # option state
+            elif state == self._READ_STATE_OPTION:
+
+                # this byte is the option code following a 'will', 'wont', 'do'
+                # or 'dont' command. Handle the command, then return to
+                # 'normal' state
+                self._handle_telnet_option(clid, client,
+                                           client.telnet_command, c)
+                state = self._READ_STATE_NORMAL
+
             # subnegotiation state
             elif state == self._READ_STATE_SUBNEG:
 
                 # if we reach an 'end of subnegotiation' command, this ends the
                 # list of options and we can return to 'normal' state.
                 # Otherwise we must remain in this state
-                if ord(c) == self._TN_SUBNEGOTIATION_END:
+                if c == self._TN_SUBNEGOTIATION_END:
                     state = self._READ_STATE_NORMAL
 
-        # return the contents of 'message' which is either a string or None
-        return message
+        # remember the state we ended up in, ready for the next data received
+        client.read_state = state
+
+        # return the list of messages, which may be empty
+        return messages
+
+    def _add_to_line(self, client, data, start, end):
+
+        # add the part of 'data' from 'start' to 'end' to the line being built
+        # up in the client's buffer. Anything beyond the line length limit is
+        # left out, so a client sending lots of data without a newline can't
+        # make the buffer grow forever
+        room = self._max_line_length - len(client.buffer)
+        if end - start > room:
+            end = start + max(0, room)
+            client.overlong = True
+        client.buffer += data[start:end]
+
+    def _end_line(self, client, messages):
+
+        # the line in the client's buffer is complete. Add it to the list of
+        # messages and clear the buffer. If it went over the length limit, it
+        # has already been cut short, and is thrown away if the input policy
+        # says so. When disconnecting, the client is left marked, so that
+        # _handle_data disconnects it
+        if client.overlong:
+            if self._input_policy == self.INPUT_DISCONNECT:
+                client.buffer = bytearray()
+                return
+            client.overlong = False
+            if self._metrics is not None:
+                self._metrics.input_limited["line_length"] = \
+                    self._metrics.input_limited.get("line_length", 0) + 1
+            if self._input_policy == self.INPUT_DROP:
+                client.buffer = bytearray()
+                return
+        messages.append(client.buffer.decode("latin1"))
+        client.buffer = bytearray()
+
+    def _handle_telnet_option(self, clid, client, command, option):
+
+        # Telnet clients and servers agree which extra features ('options')
+        # to use by offering them with 'will' ("I'd like to do this") or
+        # asking for them with 'do' ("please do this"). The other side answers
+        # 'do' or 'dont' to a 'will', and 'will' or 'wont' to a 'do'.
+        # The only option we support is MCCP version 2 compression, which we
+        # offer with 'will' when the client connects. If the client answers
+        # 'do', we tell it compression is starting with an empty
+        # subnegotiation, and compress everything we send from then on. If it
+        # answers 'dont' we simply carry on without compression. A client
+        # sending 'will' is offering to compress what it sends us, which we
+        # don't support, so that's turned down below like any other option
+        if (option == self._TN_COMPRESS2 and self._compression
+                and command != self._TN_WILL):
+            if command == self._TN_DO and client.compressor is None:
+                self._start_compression(clid, client)
+            return
+
+        # turn down any other option the client offers or asks for. 'wont' and
+        # 'dont' don't need an answer
+        if command == self._TN_WILL:
+            answer = self._TN_DONT
+        elif command == self._TN_DO:
+            answer = self._TN_WONT
+        else:
+            return
+        self._queue_data(clid, bytes(bytearray([
+            self._TN_INTERPRET_AS_COMMAND, answer, option])))
+
+    def _start_compression(self, clid, client):
+
+        # tell the client compression is starting, then compress everything
+        # after that. Everything queued up to now, including the message
+        # telling the client, is sent as it is
+        self._queue_data(clid, bytes(bytearray([
+            self._TN_INTERPRET_AS_COMMAND,
+            self._TN_SUBNEGOTIATION_START, self._TN_COMPRESS2,
+            self._TN_INTERPRET_AS_COMMAND,
+            self._TN_SUBNEGOTIATION_END])))
+        client.prepared = len(client.outqueue)
+        client.compressor = zlib.compressobj()
+
+    def _handle_signal(self, signum, frame):
+
+        # this is the actual signal handler, which Python calls in between
+        # whatever the program was doing. All we do is note the signal, and
+        # deal with it in _check_for_signals, during 'update'
+        self._pending_signals.append(signum)
+
+    def _check_for_signals(self):
+
+        # empty the wakeup socket, then call the function registered for each
+        # signal received
+        try:
+            while self._signal_wakeup_read.recv(4096):
+                pass
+        except socket.error:
+            pass
+        while self._pending_signals:
+            callback = self._signal_callbacks.get(
+                self._pending_signals.popleft())
+            if callback is not None:
+                callback()
+
+    def _send_handover(self, conn, state):
+
+        # send everything we can before handing over, so that as little as
+        # possible is left to pass on. If we're recording, finish writing out
+        # what we've recorded, so that the new process can carry on after it
+        self.flush()
+        if self._recorder is not None:
+            self._recorder.flush()
+
+        # gather up what we know about each client
+        now = _monotonic()
+        clients = [self._describe_client(clid, cl, now)
+                   for clid, cl in self._clients.items()]
+        compressing = [c["id"] for c in clients if c["compressing"]]
+
+        # the occurences since the last update are passed on too, so that the
+        # new process's game sees them
+        data = json.dumps({
+            "nextid": self._nextid,
+            "clients": clients,
+            "new_players": list(self._pending_new_players),
+            "left_players": list(self._pending_left_players),
+            "commands": [list(c) for c in self._pending_commands],
+            "state": state,
+        }).encode("utf-8")
+
+        try:
+            # send the details, then the sockets themselves, which go as
+            # 'ancillary data' alongside a byte of normal data. The operating
+            # system gives the new process its own copy of each socket. The
+            # listen socket comes first, then the clients' in the same order as
+            # their details
+            conn.sendall(self._HANDOVER_LENGTH.pack(len(data)) + data)
+            fds = ([self._listen_socket.fileno()]
+                   + [self._clients[c["id"]].socket.fileno() for c in clients])
+            step = self._HANDOVER_SOCKETS_PER_MESSAGE
+            for start in range(0, len(fds), step):
+                conn.sendmsg([b"S"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                      array("i", fds[start:start + step]))])
+
+            # wait for the new process to confirm it has everything
+            if conn.recv(1) != b"K":
+                raise socket.error("The new process didn't take over")
+
+        # if something went wrong, carry on as before, starting compression up
+        # again for the clients that were using it
+        except socket.error:
+            for clid in compressing:
+                self._start_compression(clid, self._clients[clid])
+            self._dirty.update(self._clients)
+            return False
+
+        # the new process has taken over, so forget about the clients and stop
+        # listening, but without disconnecting anyone - closing our copy of a
+        # socket doesn't close the new process's copy
+        for cl in self._clients.values():
+            if self._selector is not None:
+                self._selector.unregister(cl.socket)
+            cl.socket.close()
+        self._clients = {}
+        self._pending_new_players.clear()
+        self._pending_left_players.clear()
+        self._pending_commands.clear()
+        if self._selector is not None:
+            self._selector.unregister(self._listen_socket)
+        self._listen_socket.close()
+        return True
+
+    def _resume(self, path):
+
+        # connect to the server handing over to us, read its details, then
+        # receive its sockets until we have the listen socket plus one for
+        # each client. Then tell it we have everything
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(path)
+            length, = self._HANDOVER_LENGTH.unpack(
+                self._receive_exactly(conn, self._HANDOVER_LENGTH.size))
+            info = json.loads(self._receive_exactly(conn, length)
+                              .decode("utf-8"))
+            fds = array("i")
+            space = socket.CMSG_SPACE(
+                self._HANDOVER_SOCKETS_PER_MESSAGE * fds.itemsize)
+            while len(fds) < 1 + len(info["clients"]):
+                msg, ancdata, flags, addr = conn.recvmsg(1, space)
+                if not msg:
+                    raise socket.error("The handover ended early")
+                for level, kind, data in ancdata:
+                    if (level == socket.SOL_SOCKET
+                            and kind == socket.SCM_RIGHTS):
+                        fds.frombytes(data[:len(data) - len(data)
+                                           % fds.itemsize])
+            conn.sendall(b"K")
+        finally:
+            conn.close()
+
+        # take over the listen socket
+        self._listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                                            0, fds[0])
+        self._listen_socket.setblocking(False)
+        self._create_selector()
+
+        # take over each client, carrying on from where the other server left
+        # off
+        now = _monotonic()
+        self._nextid = info["nextid"]
+        for c, fd in zip(info["clients"], fds[1:]):
+            self._restore_client(c, fd, now)
+
+        # make the occurences the other server hadn't passed to its game yet
+        # available after the first update, along with the game's details
+        self._pending_new_players.extend(info["new_players"])
+        self._pending_left_players.extend(info["left_players"])
+        self._pending_commands.extend(tuple(c) for c in info["commands"])
+        self._handover_state = info["state"]
+
+    def _describe_client(self, clid, cl, now):
+
+        # gather up what we know about a client, so that another process can
+        # take it over. Compressed data can't be carried on by another process,
+        # so if the client is using compression we compress what's left to
+        # send and end the compressed stream, which tells the client to carry
+        # on without compression. The other process starts it up again
+        parts = [bytes(d) for d in cl.outqueue] if cl.outqueue else []
+        compressing = cl.compressor is not None
+        if compressing:
+            parts = (parts[:cl.prepared]
+                     + [cl.compressor.compress(d)
+                        for d in parts[cl.prepared:]]
+                     + [cl.compressor.flush(zlib.Z_FINISH)])
+            cl.compressor = None
+        output = b"".join(parts)
+        cl.outqueue = deque([output]) if output else None
+        cl.outbytes = len(output)
+        cl.prepared = 0
+
+        # text is passed as JSON strings, with each byte as a character
+        return {
+            "id": clid,
+            "address": cl.address,
+            "buffer": cl.buffer.decode("latin1"),
+            "read_state": cl.read_state,
+            "telnet_command": cl.telnet_command,
+            "overlong": cl.overlong,
+            "idle": now - cl.lastactive,
+            "dropped": cl.dropped,
+            "compressing": compressing,
+            "compress_in": cl.compress_in,
+            "compress_out": cl.compress_out,
+            "output": output.decode("latin1"),
+            "held": list(cl.held) if cl.held else None,
+        }
+
+    def _restore_client(self, c, fd, now):
+
+        # take over a client described by _describe_client in another process,
+        # whose socket we've been given as the file descriptor 'fd'
+        clid = c["id"]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0, fd)
+        sock.setblocking(False)
+        cl = MudServer._Client(sock, c["address"],
+                               bytearray(c["buffer"].encode("latin1")), now)
+        cl.read_state = c["read_state"]
+        cl.telnet_command = c["telnet_command"]
+        cl.overlong = c["overlong"]
+        cl.lastactive = now - c["idle"]
+        cl.dropped = c["dropped"]
+        cl.compress_in = c["compress_in"]
+        cl.compress_out = c["compress_out"]
+        cl.command_tokens = max(1, self._max_commands_per_second or 0)
+        cl.byte_tokens = self._max_bytes_per_second or 0
+        cl.interest = self._WANT_READ
+        self._clients[clid] = cl
+        if self._selector is not None:
+            self._selector.register(sock, cl.interest, clid)
+
+        # queue whatever the other process didn't manage to send, then start
+        # compression up again if the client was using it
+        output = c["output"].encode("latin1")
+        if output:
+            self._queue_data(clid, output)
+        if c["compressing"]:
+            self._start_compression(clid, cl)
+
+        # commands being held back by the rate limit are handed over as soon
+        # as the client is allowed
+        if c["held"]:
+            cl.held = deque(c["held"])
+            cl.throttled = True
+            self._update_interest(clid, cl)
+            self._call_at(now, self._unthrottle, clid)
+
+        # start checking that the client is still connected
+        self._check_client_alive(clid)
+
+    def _receive_exactly(self, conn, size):
+
+        # keep reading from the connection until we have 'size' bytes
+        data = b""
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise socket.error("The handover ended early")
+            data += chunk
+        return data
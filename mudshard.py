@@ -0,0 +1,726 @@
+"""Sharded MUD server module for spreading a text-based Multi-User
+Dungeon (MUD) game over several processes, so that it can make use of
+more than one processor core.
+
+Contains one class, ShardedMudServer, and one function, run_shards,
+which starts a number of processes ('shards') each running its own
+ShardedMudServer on the same port. The operating system shares newly
+connecting players out between the shards.
+
+The game world is split into zones, each run by one of the shards
+(see 'shard_for_zone'). Whichever shard a player happens to connect
+to, the game moves them to the shard running their zone with
+'move_to_zone', passing their connection over without disconnecting
+them, so that everyone in a zone is handled by the same shard.
+
+Player id numbers are unique across all of the shards, and messages
+can be sent to any player from any shard - messages for players
+connected to another shard are passed to it over a local message bus
+made of Unix sockets. Each shard only hears about the players connected
+to it, though, so game code which needs to know about the whole game
+(e.g. a 'who' listing) should use 'publish' and 'send_to_shard' to pass
+its own messages between the shards.
+
+Requires a system which supports Unix sockets and the SO_REUSEPORT
+socket option, such as Linux. Moving players between shards also
+requires Python 3.
+
+author: Mark Frimston - mfrimston@gmail.com
+"""
+
+
+import os
+import sys
+import json
+import zlib
+import socket
+import struct
+import errno
+import shutil
+import signal
+import tempfile
+import multiprocessing
+from array import array
+from collections import deque
+
+# import the MUD server class
+from mudserver import MudServer, _monotonic
+
+
+class ShardedMudServer(MudServer):
+    """A MudServer which runs as one of several shards sharing the same
+    port, usually each in its own process. See 'run_shards'.
+
+    It works just like MudServer, except that the 'send_message',
+    'send_to_many' and 'broadcast' methods reach players connected to
+    any of the shards, players can be moved to the shard running their
+    zone with 'move_to_zone', and shards can pass messages between each
+    other using 'publish' and 'send_to_shard'. Players moved to this
+    shard are available from 'get_arrived_players', and messages
+    received from other shards from 'get_bus_messages', after each
+    'update'.
+    """
+
+    # Types of record sent over the bus. See _send_bus_records function
+    _BUS_SEND = b"S"
+    _BUS_BROADCAST = b"B"
+    _BUS_PUBLISH = b"P"
+    _BUS_MOVE = b"M"
+    _BUS_LOCATION = b"L"
+    _BUS_GONE = b"G"
+
+    # Layout of the data sent over the bus. Each datagram starts with the
+    # number of the shard which sent it and whether more of the same data
+    # follows in the next datagram, followed by one or more records. Each
+    # record has a header giving its type, how many player ids follow and how
+    # long its data is, then the player ids, then the data
+    _BUS_HEADER = struct.Struct("!HB")
+    _BUS_RECORD = struct.Struct("!cII")
+    _BUS_ID = struct.Struct("!q")
+
+    # the largest datagram we'll send. Records too big for one datagram are
+    # split over several
+    _BUS_DATAGRAM_SIZE = 60000
+
+    # the most players' sockets passed over in a single datagram (Linux won't
+    # take more than 253)
+    _BUS_SOCKETS_PER_DATAGRAM = 200
+
+    # how long to wait before trying again to send datagrams that another
+    # shard had no room for
+    _BUS_RETRY_DELAY = 0.01
+
+    # the number of this shard, and how many shards there are
+    shard = 0
+    shard_count = 1
+    # the directory containing the Unix sockets of the shards
+    _bus_dir = None
+    # the Unix socket this shard receives bus messages on
+    _bus_socket = None
+    # records waiting to be sent to each other shard. Maps shard number to a
+    # list of (record, socket) tuples, where the socket is that of a player
+    # being moved to the shard, or None
+    _bus_records = {}
+    # datagrams waiting to be sent, as (shard number, datagram, sockets)
+    # tuples
+    _bus_outgoing = None
+    # whether a retry of sending the above has been scheduled
+    _bus_retry_scheduled = False
+    # the shards which we're throwing datagrams away for, because part of
+    # the data they carry couldn't be sent
+    _bus_dropping = None
+    # the start of data being received in pieces from each shard, mapping
+    # the shard number to a list of the pieces and a list of the sockets
+    # received along with them
+    _bus_partial = None
+    # counts of what has happened on the bus. See 'get_bus_stats'
+    _bus_stats = None
+    # the shard each player who has moved between shards is connected to, if
+    # it isn't this one. Players who haven't moved are connected to the shard
+    # given by their id number. See 'owner' method
+    _locations = None
+    # function which gives the shard running each zone. See 'set_zone_map'
+    _zone_map = None
+    # queues of messages received from other shards, as (shard number, data)
+    # tuples, like the event queues in MudServer
+    _bus_messages = None
+    _pending_bus_messages = None
+    # function to call with each message received, instead of queueing it
+    _bus_callback = None
+    # queues of players moved to this shard, as (id, state) tuples, and the
+    # function to call with each instead of queueing them
+    _arrivals = None
+    _pending_arrivals = None
+    _arrive_callback = None
+
+    def __init__(self, shard, shard_count, bus_dir, **kwargs):
+        """Constructs the ShardedMudServer object for shard number
+        'shard' of 'shard_count', and starts listening for new players
+        and for messages from the other shards. 'bus_dir' is a directory
+        shared by all of the shards where their Unix sockets are kept.
+        Any other arguments are passed on to MudServer.
+        """
+        kwargs["reuse_port"] = True
+        MudServer.__init__(self, **kwargs)
+
+        self.shard = shard
+        self.shard_count = shard_count
+        self._bus_dir = bus_dir
+        self._bus_records = {}
+        self._bus_outgoing = deque()
+        self._bus_dropping = set()
+        self._bus_partial = {}
+        self._bus_stats = {"datagrams_sent": 0, "datagrams_lost": 0,
+                           "players_moved_out": 0, "players_moved_in": 0,
+                           "players_lost": 0}
+        self._bus_messages = deque()
+        self._pending_bus_messages = deque()
+        self._locations = {}
+        self._arrivals = deque()
+        self._pending_arrivals = deque()
+
+        # make sure player ids are unique across all the shards by having each
+        # shard count up in steps of 'shard_count' from its own shard number.
+        # This also means every player starts out on shard id % shard_count
+        self._nextid = shard
+        self._id_step = shard_count
+
+        # create the Unix socket this shard receives bus messages on, and
+        # watch it for messages. Datagram sockets keep each message separate,
+        # so we don't need to work out where one ends and the next begins
+        path = self._bus_path(shard)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._bus_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._bus_socket.bind(path)
+        self._bus_socket.setblocking(False)
+        self._watch_socket(self._bus_socket, self._check_for_bus_messages)
+
+    def owner(self, id):
+        """Returns the number of the shard the player with the given id
+        number is connected to, as far as this shard knows. Players
+        start out on the shard given by their id number, and other
+        shards are told when they move.
+        """
+        if id in self._clients:
+            return self.shard
+        return self._locations.get(id, id % self.shard_count)
+
+    def set_zone_map(self, function):
+        """Registers a function which is given the name of a zone of the
+        game world and returns the number of the shard which runs it.
+        Every shard must use the same function. Without one, zones are
+        shared out between the shards by their names. Returns the
+        function, so this can be used as a decorator.
+        """
+        self._zone_map = function
+        return function
+
+    def shard_for_zone(self, zone):
+        """Returns the number of the shard which runs the zone with the
+        given name.
+        """
+        if self._zone_map is not None:
+            return self._zone_map(zone)
+        # the checksum of a name is the same in every process, unlike the
+        # value of 'hash', which changes each time Python starts
+        return (zlib.crc32(zone.encode("utf-8")) & 0xffffffff) \
+            % self.shard_count
+
+    def move_to_zone(self, id, zone, state=None):
+        """Makes sure the player with the given id number is connected to
+        the shard which runs the given zone. Returns True if that's this
+        shard. Otherwise the player is moved to that shard, along with
+        'state' (see 'move_to_shard'), and False is returned.
+        """
+        shard = self.shard_for_zone(zone)
+        if shard == self.shard:
+            return True
+        self.move_to_shard(id, shard, state)
+        return False
+
+    def move_to_shard(self, id, shard, state=None):
+        """Moves the player with the given id number, who must be
+        connected to this shard, to the given shard without
+        disconnecting them. Their id number stays the same, and messages
+        sent to them from any shard still reach them. 'state' can be any
+        data that can be stored as JSON, such as the player's details -
+        the other shard receives it from 'get_arrived_players'.
+
+        Once moved, the player no longer belongs to this shard, and no
+        'disconnected player' occurence is produced for them here, so
+        the game should forget about them. Any of their commands which
+        haven't been handed to the game yet go with them. If the player's
+        connection fails while their waiting messages are sent, they are
+        disconnected as normal instead of being moved.
+        """
+        # send the player as much of their waiting data as we can, so that
+        # there's less to pass on. This is done while they're still one of our
+        # players, as a connection problem disconnects them as normal, in
+        # which case there's nobody left to move
+        cl = self._clients[id]
+        self._send_client_data(id, cl)
+        if id not in self._clients:
+            return
+        del(self._clients[id])
+        self._dirty.discard(id)
+        if self._selector is not None:
+            self._selector.unregister(cl.socket)
+
+        # take the player's commands which haven't been handed to the game yet
+        commands = [c for c in self._pending_commands if c[0] == id]
+        if commands:
+            remaining = [c for c in self._pending_commands if c[0] != id]
+            self._pending_commands.clear()
+            self._pending_commands.extend(remaining)
+
+        # note where the player has gone, so that messages for them can be
+        # passed on, then pass the player's details and socket to the other
+        # shard. Our copy of the socket is closed once it's been sent
+        self._set_location(id, shard)
+        data = json.dumps({
+            "client": self._describe_client(id, cl, _monotonic()),
+            "state": state,
+            "commands": [list(c) for c in commands],
+        }).encode("utf-8")
+        self._add_bus_record(shard, self._BUS_MOVE, [id], data, cl.socket)
+        self._bus_stats["players_moved_out"] += 1
+
+    def send_to_many(self, ids, message):
+        """Sends the text in the 'message' parameter to every player
+        whose id number is in 'ids', whichever shard they're connected
+        to. Each other shard involved is sent a single copy of the
+        message along with the ids of its players.
+        """
+        data = self._encode(message+"\n\r")
+        remote = {}
+        for id in ids:
+            owner = self.owner(id)
+            if owner == self.shard:
+                MudServer._queue_data(self, id, data)
+            else:
+                remote.setdefault(owner, []).append(id)
+        for owner, owner_ids in remote.items():
+            self._add_bus_record(owner, self._BUS_SEND, owner_ids, data)
+
+    def broadcast(self, message, exclude=()):
+        """Sends the text in the 'message' parameter to every player
+        connected to any of the shards, apart from any whose id numbers
+        are in 'exclude'.
+        """
+        data = self._encode(message+"\n\r")
+        for id in self._clients:
+            if id not in exclude:
+                MudServer._queue_data(self, id, data)
+        exclude = list(exclude)
+        for owner in range(self.shard_count):
+            if owner != self.shard:
+                self._add_bus_record(owner, self._BUS_BROADCAST, exclude,
+                                     data)
+
+    def publish(self, data):
+        """Sends 'data', which should be bytes, to every other shard,
+        where it will appear in 'get_bus_messages'.
+        """
+        for owner in range(self.shard_count):
+            if owner != self.shard:
+                self._add_bus_record(owner, self._BUS_PUBLISH, [], data)
+
+    def send_to_shard(self, shard, data):
+        """Sends 'data', which should be bytes, to the given shard, where
+        it will appear in 'get_bus_messages'.
+        """
+        self._add_bus_record(shard, self._BUS_PUBLISH, [], data)
+
+    def get_arrived_players(self):
+        """Returns a sequence containing any players moved to this shard
+        by other shards since the last call to 'update'. Each item is a
+        2-tuple containing the player's id number and the 'state' passed
+        to 'move_to_shard'. The sequence is only valid until the next
+        call to 'update'.
+        """
+        return self._arrivals
+
+    def on_player_arrived(self, callback):
+        """Registers a function to be called with the id number and state
+        of each player moved to this shard as soon as they arrive,
+        instead of them appearing in 'get_arrived_players'. Returns the
+        function, so this can be used as a decorator.
+        """
+        self._arrive_callback = callback
+        return callback
+
+    def get_bus_stats(self):
+        """Returns a dictionary of counts of what has happened on the bus
+        since the shard started:
+
+            datagrams_sent    - datagrams sent to other shards
+            datagrams_lost    - datagrams which couldn't be sent, e.g.
+                                because the other shard wasn't running
+            players_moved_out - players moved to other shards
+            players_moved_in  - players moved here from other shards
+            players_lost      - players disconnected because they
+                                couldn't be moved to or from another
+                                shard
+        """
+        return dict(self._bus_stats)
+
+    def get_bus_messages(self):
+        """Returns a sequence containing any messages sent by other shards
+        using 'publish' or 'send_to_shard' since the last call to
+        'update'. Each item is a 2-tuple containing the number of the
+        shard which sent it and the data. The sequence is only valid
+        until the next call to 'update'.
+        """
+        return self._bus_messages
+
+    def on_bus_message(self, callback):
+        """Registers a function to be called with the shard number and
+        data of each message from another shard as soon as it arrives,
+        instead of it appearing in 'get_bus_messages'. Returns the
+        function, so this can be used as a decorator.
+        """
+        self._bus_callback = callback
+        return callback
+
+    def flush(self):
+        """Sends all queued messages, both to players connected to this
+        shard and to the other shards.
+        """
+        MudServer.flush(self)
+        self._send_bus_records()
+
+    def shutdown(self):
+        """Closes down the server, disconnecting this shard's clients and
+        closing its sockets.
+        """
+        MudServer.shutdown(self)
+        # players still waiting to be moved to a shard which has no room for
+        # them are disconnected
+        for shard, datagram, socks in self._bus_outgoing:
+            for sock in socks:
+                sock.close()
+        self._bus_socket.close()
+        try:
+            os.unlink(self._bus_path(self.shard))
+        except OSError:
+            pass
+
+    def _bus_path(self, shard):
+
+        # the file name of the Unix socket for the given shard
+        return os.path.join(self._bus_dir, "shard-{}.sock".format(shard))
+
+    def _queue_data(self, clid, data):
+
+        # queue data for players connected to this shard as usual, or pass it
+        # to the shard the player is connected to
+        owner = self.owner(clid)
+        if owner == self.shard:
+            MudServer._queue_data(self, clid, data)
+        else:
+            self._add_bus_record(owner, self._BUS_SEND, [clid], data)
+
+    def _handle_disconnect(self, clid, reason="closed"):
+
+        # if a player who moved here from another shard leaves, tell the other
+        # shards to forget where they were
+        if clid in self._clients and clid % self.shard_count != self.shard:
+            for owner in range(self.shard_count):
+                if owner != self.shard:
+                    self._add_bus_record(owner, self._BUS_GONE, [clid], b"")
+        MudServer._handle_disconnect(self, clid, reason)
+
+    def _set_location(self, id, shard):
+
+        # note which shard a player is connected to. Only players who aren't
+        # on the shard given by their id number need to be noted
+        if shard == id % self.shard_count:
+            self._locations.pop(id, None)
+        else:
+            self._locations[id] = shard
+
+    def _add_bus_record(self, shard, kind, ids, data, sock=None):
+
+        # build the record and add it to those waiting to be sent to the shard.
+        # They're all sent together when we next flush
+        record = b"".join([self._BUS_RECORD.pack(kind, len(ids), len(data))]
+                          + [self._BUS_ID.pack(id) for id in ids] + [data])
+        self._bus_records.setdefault(shard, []).append((record, sock))
+
+    def _send_bus_records(self):
+
+        # pack the waiting records for each shard into as few datagrams as we
+        # can, keeping each one under the size limit. A record bigger than the
+        # limit is split over several datagrams, each marked to say that more
+        # of it follows, and put back together by the other shard. The sockets
+        # of players being moved go with the datagram their record starts in
+        size_limit = self._BUS_DATAGRAM_SIZE - self._BUS_HEADER.size
+        for shard, records in self._bus_records.items():
+            body = []
+            size = 0
+            socks = []
+            for record, sock in records:
+                if body and (size + len(record) > size_limit
+                             or (sock is not None and len(socks)
+                                 >= self._BUS_SOCKETS_PER_DATAGRAM)):
+                    self._add_datagram(shard, body, False, socks)
+                    body = []
+                    size = 0
+                    socks = []
+                if sock is not None:
+                    socks.append(sock)
+                while size + len(record) > size_limit:
+                    cut = size_limit - size
+                    body.append(record[:cut])
+                    self._add_datagram(shard, body, True, socks)
+                    record = record[cut:]
+                    body = []
+                    size = 0
+                    socks = []
+                body.append(record)
+                size += len(record)
+            self._add_datagram(shard, body, False, socks)
+        self._bus_records = {}
+
+        # send the datagrams in order
+        while self._bus_outgoing:
+            shard, datagram, socks = self._bus_outgoing[0]
+
+            # once part of some data has been lost, the rest of it is no use to
+            # the other shard, so it's thrown away too
+            if shard in self._bus_dropping:
+                self._lose_datagram(shard, datagram, socks)
+                continue
+
+            try:
+                if socks:
+                    self._bus_socket.sendmsg(
+                        [datagram],
+                        [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                          array("i", [s.fileno() for s in socks]))],
+                        0, self._bus_path(shard))
+                else:
+                    self._bus_socket.sendto(datagram, self._bus_path(shard))
+            except socket.error as e:
+                # if the other shard has no room for the datagram right now,
+                # try again shortly
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.ENOBUFS):
+                    if not self._bus_retry_scheduled:
+                        self._bus_retry_scheduled = True
+                        self._call_at(_monotonic() + self._BUS_RETRY_DELAY,
+                                      self._retry_bus_send)
+                    return
+                # otherwise the other shard isn't running, so the datagram is
+                # lost
+                self._lose_datagram(shard, datagram, socks)
+                continue
+
+            # the other shard has its own copy of the sockets now, so we can
+            # close ours
+            self._bus_stats["datagrams_sent"] += 1
+            for sock in socks:
+                sock.close()
+            self._bus_outgoing.popleft()
+
+    def _add_datagram(self, shard, body, more, socks):
+
+        # put together a datagram from pieces of records, and add it to those
+        # waiting to be sent
+        if body:
+            header = self._BUS_HEADER.pack(self.shard, more)
+            self._bus_outgoing.append((shard, header + b"".join(body), socks))
+
+    def _lose_datagram(self, shard, datagram, socks):
+
+        # count a datagram which couldn't be sent. If it was part of some data
+        # split over several datagrams, throw away the rest of the data too.
+        # Players whose sockets it carried are disconnected - they were already
+        # gone from this shard, and never got to the other one
+        self._bus_outgoing.popleft()
+        self._bus_stats["datagrams_lost"] += 1
+        sender, more = self._BUS_HEADER.unpack_from(datagram, 0)
+        if more:
+            self._bus_dropping.add(shard)
+        else:
+            self._bus_dropping.discard(shard)
+        for sock in socks:
+            sock.close()
+            self._bus_stats["players_lost"] += 1
+
+    def _retry_bus_send(self):
+
+        # called by a timer to try sending waiting datagrams again
+        self._bus_retry_scheduled = False
+        self._send_bus_records()
+
+    def _check_for_bus_messages(self):
+
+        # read datagrams from the bus until there are none left, along with
+        # the sockets of any players being moved here
+        fds_space = socket.CMSG_SPACE(
+            self._BUS_SOCKETS_PER_DATAGRAM * array("i").itemsize) \
+            if hasattr(socket, "CMSG_SPACE") else 0
+        while True:
+            fds = array("i")
+            try:
+                if fds_space:
+                    datagram, ancdata, flags, addr = \
+                        self._bus_socket.recvmsg(65536, fds_space)
+                    for level, kind, data in ancdata:
+                        if (level == socket.SOL_SOCKET
+                                and kind == socket.SCM_RIGHTS):
+                            fds.frombytes(data[:len(data) - len(data)
+                                               % fds.itemsize])
+                    # if there wasn't room for all the players' sockets, the
+                    # ones which arrived are the first ones, so they still go
+                    # with the right players. The players whose sockets are
+                    # missing are dealt with in _handle_bus_records
+                    if flags & getattr(socket, "MSG_CTRUNC", 0):
+                        sys.stderr.write("Some players' connections were "
+                                         "lost on the way to this shard\n")
+                else:
+                    datagram = self._bus_socket.recv(65536)
+            except socket.error:
+                return
+
+            # if this is part of some data split over several datagrams, keep
+            # it until we have the rest
+            sender, more = self._BUS_HEADER.unpack_from(datagram, 0)
+            datagram = datagram[self._BUS_HEADER.size:]
+            if more or sender in self._bus_partial:
+                pieces, partial_fds = self._bus_partial.setdefault(
+                    sender, ([], []))
+                pieces.append(datagram)
+                partial_fds.extend(fds)
+                if more:
+                    continue
+                del(self._bus_partial[sender])
+                datagram = b"".join(pieces)
+                fds = partial_fds
+            self._handle_bus_records(sender, datagram, list(fds))
+
+    def _handle_bus_records(self, sender, datagram, fds):
+
+        # go through each record in the data from another shard
+        pos = 0
+        while pos < len(datagram):
+            kind, count, length = self._BUS_RECORD.unpack_from(datagram,
+                                                               pos)
+            pos += self._BUS_RECORD.size
+            ids = [self._BUS_ID.unpack_from(datagram,
+                                            pos + i * self._BUS_ID.size)[0]
+                   for i in range(count)]
+            pos += count * self._BUS_ID.size
+            data = datagram[pos:pos + length]
+            pos += length
+
+            # data to be sent to some of our players. Players who have moved
+            # to another shard have it passed on to them, unless the other
+            # shard is the one that sent it, which happens if a player moves
+            # again before the other shards hear that they had moved
+            if kind == self._BUS_SEND:
+                for id in ids:
+                    if self.owner(id) == sender:
+                        MudServer._queue_data(self, id, data)
+                    else:
+                        self._queue_data(id, data)
+
+            # data to be sent to all of our players, except some
+            elif kind == self._BUS_BROADCAST:
+                exclude = set(ids)
+                for id in self._clients:
+                    if id not in exclude:
+                        MudServer._queue_data(self, id, data)
+
+            # a message for the game code
+            elif kind == self._BUS_PUBLISH:
+                if self._bus_callback is not None:
+                    self._bus_callback(sender, data)
+                else:
+                    self._pending_bus_messages.append((sender, data))
+
+            # a player moved here from another shard. If their socket didn't
+            # make it, the player can't be brought back
+            elif kind == self._BUS_MOVE:
+                if fds:
+                    self._player_arrived(ids[0], data, fds.pop(0))
+                else:
+                    self._player_lost(ids[0], sender)
+
+            # a player has moved to another shard, or left the game
+            elif kind == self._BUS_LOCATION:
+                self._set_location(ids[0], sender)
+            elif kind == self._BUS_GONE:
+                self._locations.pop(ids[0], None)
+
+    def _player_lost(self, id, sender):
+
+        # a player was moved here, but their connection didn't arrive with
+        # them. Count them as lost, and tell the other shards to forget them,
+        # as they'll have been told the player was coming here
+        sys.stderr.write("Player {} couldn't be moved here from shard {}\n"
+                         .format(id, sender))
+        self._bus_stats["players_lost"] += 1
+        self._locations.pop(id, None)
+        for owner in range(self.shard_count):
+            if owner != self.shard:
+                self._add_bus_record(owner, self._BUS_GONE, [id], b"")
+
+    def _player_arrived(self, id, data, fd):
+
+        # take over the player's connection from where the other shard left
+        # off, and tell the other shards where the player is now
+        info = json.loads(data.decode("utf-8"))
+        self._restore_client(info["client"], fd, _monotonic())
+        self._locations.pop(id, None)
+        for owner in range(self.shard_count):
+            if owner != self.shard:
+                self._add_bus_record(owner, self._BUS_LOCATION, [id], b"")
+        self._bus_stats["players_moved_in"] += 1
+
+        # let the game know the player has arrived, then hand over the
+        # commands they sent which the other shard's game hadn't seen yet
+        if self._arrive_callback is not None:
+            self._arrive_callback(id, info["state"])
+        else:
+            self._pending_arrivals.append((id, info["state"]))
+        for id, command, params in info["commands"]:
+            self._add_command(id, command, params)
+
+    def _move_pending_events(self):
+
+        # make the new bus messages available along with the other events
+        MudServer._move_pending_events(self)
+        self._bus_messages, self._pending_bus_messages = \
+            self._pending_bus_messages, self._bus_messages
+        self._pending_bus_messages.clear()
+        self._arrivals, self._pending_arrivals = \
+            self._pending_arrivals, self._arrivals
+        self._pending_arrivals.clear()
+
+
+def run_shards(game, shard_count=None, **kwargs):
+    """Starts 'shard_count' processes (by default one for each processor
+    core), and in each calls the function 'game' with a new
+    ShardedMudServer as its only argument. Any other arguments are
+    passed on to ShardedMudServer. Returns once all of the processes
+    have finished.
+    """
+    if shard_count is None:
+        shard_count = multiprocessing.cpu_count()
+
+    # create a temporary directory for the shards' Unix sockets
+    bus_dir = tempfile.mkdtemp(prefix="mudshard-")
+    processes = [multiprocessing.Process(
+                    target=_run_shard,
+                    args=(game, shard, shard_count, bus_dir, kwargs))
+                 for shard in range(shard_count)]
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    finally:
+        # if we were stopped early, e.g. by Ctrl+C or the 'kill' command, make
+        # sure the shards stop too. Pressing Ctrl+C stops them all anyway, so
+        # give them a moment first. They're stopped as if Ctrl+C had been
+        # pressed, so that they shut down cleanly
+        for process in processes:
+            if process.pid is not None:
+                process.join(1.0)
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGINT)
+                    process.join()
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+
+def _run_shard(game, shard, shard_count, bus_dir, kwargs):
+
+    # this runs in each shard's process
+    mud = ShardedMudServer(shard, shard_count, bus_dir, **kwargs)
+    try:
+        game(mud)
+    finally:
+        mud.shutdown()
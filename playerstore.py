@@ -0,0 +1,169 @@
+"""Player store module for saving players' details between sessions of
+a text-based Multi-User Dungeon (MUD) game.
+
+Contains one class, PlayerStore, which keeps a record for each player
+name in an SQLite database file. Records are saved by a background
+thread, so the game never has to wait for the disk.
+
+author: Mark Frimston - mfrimston@gmail.com
+"""
+
+
+import sys
+import json
+import sqlite3
+import threading
+
+
+class PlayerStore(object):
+    """Saves and loads player records, each of which is a dictionary of
+    values that can be stored as JSON (strings, numbers, lists etc).
+
+    'save' only notes the record as changed - a background thread
+    writes all the changed records to the database together, at most
+    once every 'flush_interval' seconds, so that saving never holds up
+    the game. 'load' looks a player up by name using the database's
+    index, so it stays quick however many players have been saved.
+
+    'close' must be called when the game ends to make sure everything
+    has been written. Passing it to MudServer's 'on_shutdown' method
+    does this automatically when the server is shut down.
+    """
+
+    def __init__(self, path="players.db", flush_interval=1.0):
+        """Opens the database file at 'path', creating it if it doesn't
+        exist, and starts the background thread which writes to it.
+        """
+        self._path = path
+        self._flush_interval = flush_interval
+
+        # records which have been saved but not yet written, mapping each name
+        # to its record as JSON text, and those being written right now
+        self._pending = {}
+        self._writing = {}
+        # used to pass the above between the game and the background thread
+        # safely, and for each to wake the other up
+        self._condition = threading.Condition()
+        # whether the game is waiting for everything to be written, whether
+        # writing has failed since it started waiting, and whether the store
+        # is being closed
+        self._flush_requested = False
+        self._write_failed = False
+        self._closing = False
+
+        # open the database for reading, creating the table if needed. The
+        # name is the table's primary key, which means the database keeps an
+        # index of the names so that looking one up doesn't mean searching
+        # through every record. Write-ahead logging (WAL) lets us read from the
+        # database while the background thread is writing to it
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS players "
+                         "(name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._db.commit()
+
+        # start the background thread. It's a 'daemon' thread so that it
+        # doesn't keep the program running if the game forgets to close us
+        self._thread = threading.Thread(target=self._run_writer)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def load(self, name):
+        """Returns the record saved for the player with the given name, or
+        None if there isn't one.
+        """
+        # a record which hasn't been written yet is newer than the one in the
+        # database, so look for it first
+        with self._condition:
+            data = self._pending.get(name, self._writing.get(name))
+        if data is None:
+            row = self._db.execute("SELECT data FROM players WHERE name = ?",
+                                   (name,)).fetchone()
+            if row is None:
+                return None
+            data = row[0]
+        return json.loads(data)
+
+    def save(self, name, record):
+        """Saves the record for the player with the given name, replacing
+        any existing one. It is written to the database in the background
+        shortly afterwards.
+        """
+        # convert the record to JSON now, so that later changes to it by the
+        # game don't affect what gets written. If the same player is saved
+        # again before it's written, only the latest record is written
+        data = json.dumps(record)
+        with self._condition:
+            self._pending[name] = data
+
+    def flush(self):
+        """Waits until every record saved so far has been written to the
+        database. Returns True once they have, or False as soon as writing
+        fails (e.g. because the disk is full), in which case the records
+        are tried again later.
+        """
+        with self._condition:
+            self._flush_requested = True
+            self._write_failed = False
+            self._condition.notify_all()
+            while ((self._pending or self._writing)
+                   and not self._write_failed and self._thread.is_alive()):
+                self._condition.wait(1.0)
+            return not (self._pending or self._writing)
+
+    def close(self):
+        """Writes any records which haven't been written yet, then closes
+        the database. The store can't be used once closed.
+        """
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._db.close()
+
+    def _run_writer(self):
+
+        # this runs in the background thread. SQLite connections can only be
+        # used by the thread which created them, so it has its own
+        db = sqlite3.connect(self._path)
+        db.execute("PRAGMA synchronous=NORMAL")
+        while True:
+
+            # wait until it's time to write, then take all the pending records.
+            # Waiting lets lots of changes build up to be written together in a
+            # single transaction, which is much quicker than writing each one
+            # separately
+            with self._condition:
+                if not self._closing and not self._flush_requested:
+                    self._condition.wait(self._flush_interval)
+                self._flush_requested = False
+                closing = self._closing
+                self._writing, self._pending = self._pending, {}
+                batch = self._writing
+
+            # write the records. If this fails (e.g. the disk is full), put
+            # them back to try again next time, unless they've been saved again
+            # since
+            if batch:
+                try:
+                    with db:
+                        db.executemany("INSERT OR REPLACE INTO players "
+                                       "(name, data) VALUES (?, ?)",
+                                       list(batch.items()))
+                except sqlite3.Error as e:
+                    sys.stderr.write("Failed to save players: {}\n".format(e))
+                    with self._condition:
+                        self._write_failed = True
+                        if not closing:
+                            for name, data in batch.items():
+                                self._pending.setdefault(name, data)
+
+            # let anything waiting in 'flush' know the records are written, or
+            # that writing them failed
+            with self._condition:
+                self._writing = {}
+                self._condition.notify_all()
+
+            if closing:
+                break
+        db.close()
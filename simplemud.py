@@ -14,213 +14,592 @@ Some ideas for things to try adding:
     * Items to pick up e.g. 'take rock' -> 'You pick up the rock'
     * Monsters to fight
     * Loot to collect
-    * Saving players accounts between sessions
     * A password login
     * A shop from which to buy items
 
 author: Mark Frimston - mfrimston@gmail.com
 """
 
+import os
+import sys
 import time
+import signal
+import socket
+import argparse
 
 # import the MUD server class
 from mudserver import MudServer
 
-
-# structure defining the rooms in the game. Try adding more rooms to the game!
-rooms = {
-    "Tavern": {
-        "description": "You're in a cozy tavern warmed by an open fire.",
-        "exits": {"outside": "Outside"},
-    },
-    "Outside": {
-        "description": "You're standing outside a tavern. It's raining.",
-        "exits": {"inside": "Tavern"},
-    }
-}
-
-# stores the players in the game
+# import the class used to save players' details between sessions
+from playerstore import PlayerStore
+
+# import the class used to read the rooms of the game from a file
+from world import World
+
+# the clock used to time command cooldowns. A monotonic clock only ever goes
+# forwards, so cooldowns aren't upset if the computer's clock is changed.
+# Python 2 doesn't have one, so there we make do with the normal clock
+try:
+    clock = time.monotonic
+except AttributeError:
+    clock = time.time
+
+
+# the rooms in the game, read from the file 'world.txt' next to this script.
+# Each line of the file is a room's name, a tab, then the room's description
+# and exits. Rooms are only read from the file when they're needed, so the
+# world can be as big as you like. Try adding more rooms to the game - just
+# run 'python world.py world.txt' afterwards to put the rooms back in order!
+rooms = World(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "world.txt"))
+
+
+class Player(object):
+    """Holds the details of a player in the game"""
+
+    # the names of the details we store. Listing them in '__slots__' means
+    # each Player object keeps them in a small fixed-size table instead of a
+    # dictionary, which saves memory when lots of players are connected. Try
+    # adding more player stats - level, gold, inventory, etc
+    __slots__ = ("name", "room", "state", "cooldowns")
+
+    def __init__(self):
+        # the player's name and the name of the room they're in. Both are None
+        # until the player has entered their name
+        self.name = None
+        self.room = None
+        # what the player is doing: "naming" until they've entered their name,
+        # then "playing"
+        self.state = "naming"
+        # maps each command the player has used which has a cooldown to the
+        # time they can next use it. None until they've used one
+        self.cooldowns = None
+
+
+# stores the players in the game, mapping each player's id number to their
+# Player object
 players = {}
 
-# start the server
-mud = MudServer()
-
-# main game loop. We loop forever (i.e. until the program is terminated)
-while True:
-
-    # pause for 1/5 of a second on each loop, so that we don't constantly
-    # use 100% CPU time
-    time.sleep(0.2)
-
-    # 'update' must be called in the loop to keep the game running and give
-    # us up-to-date information
-    mud.update()
-
-    # go through any newly connected players
-    for id in mud.get_new_players():
-
-        # add the new player to the dictionary, noting that they've not been
-        # named yet.
-        # The dictionary key is the player's id number. We set their room to
-        # None initially until they have entered a name
-        # Try adding more player stats - level, gold, inventory, etc
-        players[id] = {
-            "name": None,
-            "room": None,
+# stores the id numbers of the players in each room, so that we can find
+# everyone in a room without going through every player in the game
+occupants = {}
+
+# maps each room name to a single copy of it which all players in the room
+# share, rather than each player having their own copy of the same text
+room_names = {}
+
+# stores the commands players can use. Maps each command name to a dictionary
+# holding the function which carries out the command, plus info about it. See
+# the 'register_command' function below
+commands = {}
+
+# maps every abbreviation of a command name which is unambiguous (e.g. 'l' for
+# 'look') to the full command name, so that looking up what a player typed
+# takes the same time no matter how many commands there are
+abbreviations = {}
+
+# text which is sent over and over but rarely changes is converted into the
+# bytes sent to players once, and kept here to be reused. Maps each room name
+# to its description and list of exits. See the 'get_room_text' function below
+room_text = {}
+
+# the list of commands sent by the 'help' command, once it's been worked out
+help_text = None
+
+
+def register_command(name, usage="", help="", cooldown=0,
+                     states=("playing",)):
+    """Adds a command to the game. Use it on the function which carries
+    out the command, e.g:
+
+        @register_command("wave", usage="wave", help="Waves")
+        def wave(id, params):
+            ...
+
+    The function is called with the id number of the player using the
+    command and the text they typed after it. 'usage' and 'help' are
+    shown by the 'help' command. 'cooldown' is how many seconds a
+    player must wait between uses of the command, and 'states' lists
+    the player states (see the 'players' dictionary) in which the
+    command can be used.
+    """
+    def register(function):
+        global help_text
+        commands[name] = {
+            "function": function,
+            "usage": usage,
+            "help": help,
+            "cooldown": cooldown,
+            "states": states,
         }
-
-        # send the new player a prompt for their name
-        mud.send_message(id, "What is your name?")
-
-    # go through any recently disconnected players
-    for id in mud.get_disconnected_players():
-
-        # if for any reason the player isn't in the player map, skip them and
-        # move on to the next one
-        if id not in players:
-            continue
-
-        # go through all the players in the game
-        for pid, pl in players.items():
-            # send each player a message to tell them about the diconnected
+        update_abbreviations()
+        # the list of commands has changed, so 'help' must work it out again
+        help_text = None
+        return function
+    return register
+
+
+def update_abbreviations():
+    """Rebuilds the table of command abbreviations. An abbreviation
+    which is the start of more than one command name is left out,
+    unless it's a complete command name itself.
+    """
+    # count how many command names start with each possible abbreviation
+    starts = {}
+    for name in commands:
+        for length in range(1, len(name) + 1):
+            starts.setdefault(name[:length], []).append(name)
+
+    # keep the ones which only match one command, plus the full names
+    abbreviations.clear()
+    for abbreviation, names in starts.items():
+        if len(names) == 1:
+            abbreviations[abbreviation] = names[0]
+    for name in commands:
+        abbreviations[name] = name
+
+
+def move_player(id, room):
+    """Moves the player with the given id number into the given room,
+    keeping track of who is in each room. Moving a player to None
+    takes them out of the world altogether.
+    """
+    # take the player out of the room they're in, forgetting about the room
+    # altogether if it's now empty
+    oldroom = players[id].room
+    if oldroom is not None:
+        occupants[oldroom].discard(id)
+        if not occupants[oldroom]:
+            del(occupants[oldroom])
+
+    # put the player into the new room, using the shared copy of its name
+    if room is not None:
+        room = room_names.setdefault(room, room)
+        occupants.setdefault(room, set()).add(id)
+    players[id].room = room
+
+
+def get_room_text(room):
+    """Returns the description and the list of exits of the room with
+    the given name, as bytes ready to be sent with 'mud.send_encoded'.
+    They're only worked out the first time they're needed.
+    """
+    text = room_text.get(room)
+    if text is None:
+        # if lots of rooms have been visited, forget them all and start
+        # again, so that a huge world doesn't fill up memory
+        if len(room_text) >= 4096:
+            room_text.clear()
+        rm = rooms[room]
+        text = room_text[room] = (
+            mud.encode_message(rm["description"]),
+            mud.encode_message("Exits are: {}".format(", ".join(rm["exits"]))))
+    return text
+
+
+def forget_room_text(room):
+    """Throws away the saved text of the room with the given name. This
+    must be called if the game changes a room's description or exits,
+    so that players are shown the new ones.
+    """
+    room_text.pop(room, None)
+
+
+def handle_command(id, typed, params):
+    """Carries out a command typed by the player with the given id
+    number.
+    """
+    # players who haven't given their name yet use their first command as
+    # their name
+    if players[id].state == "naming":
+        enter_name(id, typed)
+        return
+
+    # look up the command from what the player typed, which may be an
+    # abbreviation. If it's not a command the player can use right now,
+    # send back an 'unknown command' message
+    name = abbreviations.get(typed)
+    cmd = commands.get(name)
+    if cmd is None or players[id].state not in cmd["states"]:
+        mud.send_message(id, "Unknown command '{}'".format(typed))
+        return
+
+    # if the command has a cooldown, check that the player has waited long
+    # enough since they last used it, and note when they can use it next
+    if cmd["cooldown"]:
+        if players[id].cooldowns is None:
+            players[id].cooldowns = {}
+        now = clock()
+        ready = players[id].cooldowns.get(name, 0)
+        if now < ready:
+            mud.send_message(id, "You must wait {:.0f} more seconds before "
+                                 "using '{}' again".format(ready - now, name))
+            return
+        players[id].cooldowns[name] = now + cmd["cooldown"]
+
+    # carry out the command
+    cmd["function"](id, params)
+
+
+def save_player(id, room):
+    """Saves the details of the player with the given id number, who is
+    in (or on their way to) the given room, so that they're remembered
+    the next time the player joins the game.
+    """
+    store.save(players[id].name, {"room": room})
+
+
+def get_player_details(id):
+    """Returns the details of the player with the given id number as a
+    dictionary, so that they can be passed to another copy of the game.
+    """
+    player = players[id]
+    return {"id": id, "name": player.name, "room": player.room,
+            "state": player.state, "cooldowns": player.cooldowns}
+
+
+def add_player(details):
+    """Adds a player passed over from another copy of the game, using
+    the details from 'get_player_details'.
+    """
+    player = Player()
+    player.name = details["name"]
+    player.state = details["state"]
+    player.cooldowns = details["cooldowns"]
+    players[details["id"]] = player
+    move_player(details["id"], details["room"])
+
+
+def zone_of(room):
+    """Returns the name of the zone the room with the given name is in.
+    When the game is split into shards (see '--shards' below), each
+    zone is run by one of them. Rooms can be grouped into zones by
+    giving them a "zone" in the world file - otherwise each room is a
+    zone of its own.
+    """
+    return rooms[room].get("zone", room)
+
+
+def place_player(id, room, arrival):
+    """Puts the player with the given id number into the given room and
+    tells the players there about it. 'arrival' is None if the player
+    has just joined the game, or the exit they arrived through. When
+    the game is split into shards, a player going into a zone run by
+    another shard is moved there, and the other shard does this
+    instead.
+    """
+    if sharded:
+        details = get_player_details(id)
+        details["room"] = room
+        details["arrival"] = arrival
+        if not mud.move_to_zone(id, zone_of(room), details):
+            move_player(id, None)
+            del(players[id])
+            return
+    move_player(id, room)
+    arrive(id, arrival)
+
+
+def arrive(id, arrival):
+    """Tells the player with the given id number, and the players in the
+    room they've just been put in, that they've arrived. 'arrival' is as
+    for 'place_player'.
+    """
+    # a player who has just joined is sent a welcome message and the
+    # description of their current room
+    if arrival is None:
+        mud.send_message(id, "Welcome to the game, {}. ".format(
+                                                           players[id].name)
+                         + "Type 'help' for a list of commands. Have fun!")
+        mud.send_encoded(id, get_room_text(players[id].room)[0])
+        return
+
+    # send all the other players in the same room a message telling them that
+    # the player entered the room
+    mud.send_to_many((pid for pid in occupants[players[id].room] if pid != id),
+                     "{} arrived via exit '{}'".format(players[id].name,
+                                                       arrival))
+
+    # send the player a message telling them where they are now
+    mud.send_message(id, "You arrive at '{}'".format(players[id].room))
+
+
+def enter_name(id, name):
+    """Uses what the player typed as their name, and moves them into
+    the room they were in when they last played, or the starting room
+    if they're new.
+    """
+    players[id].name = name
+    players[id].state = "playing"
+
+    # look up the player's saved details, if they have played before
+    saved = store.load(name)
+    if saved is not None and saved["room"] in rooms:
+        room = saved["room"]
+    else:
+        room = "Tavern"
+        save_player(id, room)
+
+    # send every player a message to tell them about the new player
+    mud.broadcast("{} entered the game".format(players[id].name))
+
+    # put the new player in their room and welcome them
+    place_player(id, room, None)
+
+
+# each of the possible commands is defined below. Try adding new commands to
+# the game!
+
+@register_command("help", usage="help",
+                  help="Lists the commands, e.g. 'help'")
+def help_command(id, params):
+    global help_text
+
+    # work out the list of possible commands, if we haven't already, then
+    # send it to the player
+    if help_text is None:
+        help_text = mud.encode_message("Commands:") + b"".join(
+            mud.encode_message("  {:<15}- {}".format(commands[name]["usage"],
+                                                     commands[name]["help"]))
+            for name in sorted(commands))
+    mud.send_encoded(id, help_text)
+
+
+@register_command("say", usage="say <message>",
+                  help="Says something out loud, e.g. 'say Hello'")
+def say_command(id, params):
+
+    # send every player in the same room as the player a message telling them
+    # what the player said
+    mud.send_to_many(occupants[players[id].room],
+                     "{} says: {}".format(players[id].name, params))
+
+
+@register_command("look", usage="look",
+                  help="Examines the surroundings, e.g. 'look'")
+def look_command(id, params):
+
+    # get the description and exits of the player's current room
+    description, exits = get_room_text(players[id].room)
+
+    # send the player back the description of their current room
+    mud.send_encoded(id, description)
+
+    # make a list of the names of every player in the same room as the player.
+    # Players are only put in a room once they've given a name
+    playershere = [players[pid].name
+                   for pid in occupants[players[id].room]]
+
+    # send player a message containing the list of players in the room
+    mud.send_message(id, "Players here: {}".format(", ".join(playershere)))
+
+    # send player a message containing the list of exits from this room
+    mud.send_encoded(id, exits)
+
+
+@register_command("go", usage="go <exit>",
+                  help="Moves through the exit specified, e.g. 'go outside'")
+def go_command(id, params):
+
+    # store the exit name
+    ex = params.lower()
+
+    # store the player's current room
+    rm = rooms[players[id].room]
+
+    # if the specified exit is found in the room's exits list
+    if ex in rm["exits"]:
+
+        # send all the other players in the same room a message telling them
+        # that the player left the room
+        mud.send_to_many((pid for pid in occupants[players[id].room]
+                          if pid != id),
+                         "{} left via exit '{}'".format(players[id].name,
+                                                        ex))
+
+        # move the player to the room the exit leads to, save where they are
+        # now, and tell them and the players there that they've arrived
+        save_player(id, rm["exits"][ex])
+        place_player(id, rm["exits"][ex], ex)
+
+    # the specified exit wasn't found in the current room
+    else:
+        # send back an 'unknown exit' message
+        mud.send_message(id, "Unknown exit '{}'".format(ex))
+
+
+# read the command line options
+parser = argparse.ArgumentParser(description="Runs the MUD Pi game.")
+parser.add_argument("--record", metavar="FILE",
+                    help="record everything players send to FILE, so that it "
+                         "can be played back with mudreplay.py")
+parser.add_argument("--resume", metavar="PATH",
+                    help="take over from a running game which is restarting. "
+                         "Used by the game itself - see 'restart' below")
+parser.add_argument("--players", metavar="FILE",
+                    default=os.path.join(os.path.dirname(
+                        os.path.abspath(__file__)), "players.db"),
+                    help="the file players are saved in (default: "
+                         "players.db next to this script)")
+parser.add_argument("--shards", type=int, metavar="N",
+                    help="split the game into N processes ('shards'), to "
+                         "make use of more than one processor core")
+args = parser.parse_args()
+if args.shards is not None and (args.record or args.resume):
+    parser.error("--shards can't be used with --record or --resume")
+
+# whether the game is split into shards. See 'place_player'
+sharded = args.shards is not None
+
+# the server the game is running on, and the store of saved players. Both are
+# set up by 'play'
+mud = None
+store = None
+
+# set when the game has been asked to restart. See below
+restart_requested = False
+
+
+def request_restart():
+    """Asks the game to restart once it's finished handling the latest
+    occurences. Called when the program receives the 'hang up' signal.
+    """
+    global restart_requested
+    restart_requested = True
+
+
+def play(server):
+    """Runs the game on the given server until the program is stopped,
+    or until the game restarts.
+    """
+    global mud, store, restart_requested
+    mud = server
+
+    # if we're taking over from a running game, the server takes over its
+    # players' connections, and we take over its players
+    if args.resume:
+        for details in mud.get_handover_state()["players"]:
+            add_player(details)
+
+    # the game can be restarted, e.g. to pick up changes to its code, without
+    # disconnecting anyone, by running 'kill -HUP <process id>'. The running
+    # game starts a new copy of itself and hands over its players' connections
+    # and details. Signals like this aren't available on Windows, handing
+    # over connections needs Python 3 ('socket.sendmsg'), and restarting
+    # isn't possible when the game is split into shards
+    if (hasattr(signal, "SIGHUP") and hasattr(socket.socket, "sendmsg")
+            and not sharded):
+        mud.on_signal(signal.SIGHUP, request_restart)
+
+    # if asked to, record everything players send, e.g. to measure how quickly
+    # the game handles it later on with 'python mudreplay.py FILE'. If we've
+    # taken over from a running game, we carry on with its recording
+    if args.record:
+        mud.start_recording(args.record, append=bool(args.resume))
+
+    # open the store of saved players, and make sure everything in it is saved
+    # when the server is shut down. It's kept next to this script by default,
+    # like the world file, so that the same players are found wherever the
+    # game is started from
+    store = PlayerStore(args.players)
+    mud.on_shutdown(store.close)
+
+    # main game loop. We loop forever (i.e. until the program is terminated)
+    while True:
+
+        # 'update' must be called in the loop to keep the game running and
+        # give us up-to-date information. It waits until a player connects or
+        # sends something, so we respond straight away without constantly
+        # using 100% CPU time. Passing None means there's no time limit on the
+        # wait - the server wakes itself up whenever it needs to check for
+        # disconnected players, or to make calls arranged with
+        # 'mud.call_later' and 'mud.call_every' (e.g. to make monsters move
+        # around every few seconds). If you'd rather the game ran in steady
+        # ticks, handling everything that happened during each one together,
+        # use 'mud.tick(0.1)' instead
+        mud.update(None)
+
+        # go through any newly connected players
+        for id in mud.get_new_players():
+
+            # add the new player to the dictionary. New players haven't been
+            # named yet, and aren't in a room until they have.
+            # The dictionary key is the player's id number
+            players[id] = Player()
+
+            # send the new player a prompt for their name
+            mud.send_message(id, "What is your name?")
+
+        # when the game is split into shards, go through any players moved
+        # here by another shard, and put them in the room they're going to
+        if sharded:
+            for id, details in mud.get_arrived_players():
+                add_player(details)
+                arrive(id, details["arrival"])
+
+        # go through any recently disconnected players
+        for id in mud.get_disconnected_players():
+
+            # if for any reason the player isn't in the player map, skip them
+            # and move on to the next one
+            if id not in players:
+                continue
+
+            # send every player a message to tell them about the disconnected
             # player
-            mud.send_message(pid, "{} quit the game".format(
-                                                        players[id]["name"]))
-
-        # remove the player's entry in the player dictionary
-        del(players[id])
-
-    # go through any new commands sent from players
-    for id, command, params in mud.get_commands():
-
-        # if for any reason the player isn't in the player map, skip them and
-        # move on to the next one
-        if id not in players:
-            continue
-
-        # if the player hasn't given their name yet, use this first command as
-        # their name and move them to the starting room.
-        if players[id]["name"] is None:
-
-            players[id]["name"] = command
-            players[id]["room"] = "Tavern"
-
-            # go through all the players in the game
-            for pid, pl in players.items():
-                # send each player a message to tell them about the new player
-                mud.send_message(pid, "{} entered the game".format(
-                                                        players[id]["name"]))
-
-            # send the new player a welcome message
-            mud.send_message(id, "Welcome to the game, {}. ".format(
-                                                           players[id]["name"])
-                             + "Type 'help' for a list of commands. Have fun!")
-
-            # send the new player the description of their current room
-            mud.send_message(id, rooms[players[id]["room"]]["description"])
-
-        # each of the possible commands is handled below. Try adding new
-        # commands to the game!
-
-        # 'help' command
-        elif command == "help":
-
-            # send the player back the list of possible commands
-            mud.send_message(id, "Commands:")
-            mud.send_message(id, "  say <message>  - Says something out loud, "
-                                 + "e.g. 'say Hello'")
-            mud.send_message(id, "  look           - Examines the "
-                                 + "surroundings, e.g. 'look'")
-            mud.send_message(id, "  go <exit>      - Moves through the exit "
-                                 + "specified, e.g. 'go outside'")
-
-        # 'say' command
-        elif command == "say":
-
-            # go through every player in the game
-            for pid, pl in players.items():
-                # if they're in the same room as the player
-                if players[pid]["room"] == players[id]["room"]:
-                    # send them a message telling them what the player said
-                    mud.send_message(pid, "{} says: {}".format(
-                                                players[id]["name"], params))
-
-        # 'look' command
-        elif command == "look":
-
-            # store the player's current room
-            rm = rooms[players[id]["room"]]
-
-            # send the player back the description of their current room
-            mud.send_message(id, rm["description"])
-
-            playershere = []
-            # go through every player in the game
-            for pid, pl in players.items():
-                # if they're in the same room as the player
-                if players[pid]["room"] == players[id]["room"]:
-                    # ... and they have a name to be shown
-                    if players[pid]["name"] is not None:
-                        # add their name to the list
-                        playershere.append(players[pid]["name"])
-
-            # send player a message containing the list of players in the room
-            mud.send_message(id, "Players here: {}".format(
-                                                    ", ".join(playershere)))
-
-            # send player a message containing the list of exits from this room
-            mud.send_message(id, "Exits are: {}".format(
-                                                    ", ".join(rm["exits"])))
-
-        # 'go' command
-        elif command == "go":
-
-            # store the exit name
-            ex = params.lower()
-
-            # store the player's current room
-            rm = rooms[players[id]["room"]]
-
-            # if the specified exit is found in the room's exits list
-            if ex in rm["exits"]:
-
-                # go through all the players in the game
-                for pid, pl in players.items():
-                    # if player is in the same room and isn't the player
-                    # sending the command
-                    if players[pid]["room"] == players[id]["room"] \
-                            and pid != id:
-                        # send them a message telling them that the player
-                        # left the room
-                        mud.send_message(pid, "{} left via exit '{}'".format(
-                                                      players[id]["name"], ex))
-
-                # update the player's current room to the one the exit leads to
-                players[id]["room"] = rm["exits"][ex]
-                rm = rooms[players[id]["room"]]
-
-                # go through all the players in the game
-                for pid, pl in players.items():
-                    # if player is in the same (new) room and isn't the player
-                    # sending the command
-                    if players[pid]["room"] == players[id]["room"] \
-                            and pid != id:
-                        # send them a message telling them that the player
-                        # entered the room
-                        mud.send_message(pid,
-                                         "{} arrived via exit '{}'".format(
-                                                      players[id]["name"], ex))
-
-                # send the player a message telling them where they are now
-                mud.send_message(id, "You arrive at '{}'".format(
-                                                          players[id]["room"]))
-
-            # the specified exit wasn't found in the current room
-            else:
-                # send back an 'unknown exit' message
-                mud.send_message(id, "Unknown exit '{}'".format(ex))
-
-        # some other, unrecognised command
-        else:
-            # send back an 'unknown command' message
-            mud.send_message(id, "Unknown command '{}'".format(command))
+            mud.broadcast("{} quit the game".format(players[id].name))
+
+            # take the player out of their room and remove their entry in the
+            # player dictionary
+            move_player(id, None)
+            del(players[id])
+
+        # go through any new commands sent from players
+        for id, command, params in mud.get_commands():
+
+            # if for any reason the player isn't in the player map (e.g. an
+            # earlier command moved them to another shard), skip them and move
+            # on to the next one
+            if id not in players:
+                continue
+
+            # carry out the command
+            handle_command(id, command, params)
+
+        # if the game has been asked to restart, save everything, then start
+        # a new copy of the game, with the same options as this one, and hand
+        # everything over to it. If that works, this copy's job is done. If
+        # the players can't be saved, we don't restart, as this copy would
+        # finish with their records still unwritten
+        if restart_requested:
+            restart_requested = False
+            if not store.flush():
+                sys.stderr.write("Restart cancelled - couldn't save players\n")
+                continue
+            state = {"players": [get_player_details(id) for id in players]}
+            command = [sys.executable, os.path.abspath(__file__),
+                       "--players", os.path.abspath(args.players)]
+            if args.record:
+                command += ["--record", os.path.abspath(args.record)]
+            # the server adds the path to resume from after '--resume'
+            command.append("--resume")
+            if mud.hand_over(command, state):
+                return
+            sys.stderr.write("Restart failed - carrying on as before\n")
+
+
+# start the game. To make use of more than one processor core, the game can be
+# split into shards, each running in its own process with its own server and
+# looking after some of the zones of the world. Otherwise there's just the one
+# server, offering to compress the data we send to players whose MUD clients
+# support it. The game runs until the program is stopped, e.g. by pressing
+# Ctrl+C. Either way, the server is shut down cleanly afterwards
+if sharded:
+    from mudshard import run_shards
+    run_shards(play, args.shards, compression=True)
+else:
+    server = MudServer(compression=True, resume_from=args.resume)
+    try:
+        play(server)
+    finally:
+        server.shutdown()
@@ -0,0 +1,58 @@
+"""Tests for asyncmudserver.py. Run with 'python -m unittest' (or pytest).
+
+Requires Python 3.7 or later.
+"""
+
+import asyncio
+import unittest
+
+from asyncmudserver import AsyncMudServer
+
+
+class UpdateTest(unittest.TestCase):
+
+    def test_update_without_timeout_lets_players_connect(self):
+
+        # a game which calls 'update' in a loop without waiting must still
+        # let the event loop accept new players and read what they send
+        async def play():
+            mud = AsyncMudServer("127.0.0.1", 0)
+            await mud.start()
+            port = mud._server.sockets[0].getsockname()[1]
+
+            async def player():
+                reader, writer = await asyncio.open_connection("127.0.0.1",
+                                                               port)
+                writer.write(b"say hello\r\n")
+                await writer.drain()
+                return writer
+
+            connecting = asyncio.ensure_future(player())
+            new_players = []
+            commands = []
+            try:
+                # give up after plenty of updates, rather than forever, so
+                # that a game loop which never lets the player in fails
+                for i in range(10000):
+                    if commands:
+                        break
+                    await mud.update()
+                    new_players.extend(mud.get_new_players())
+                    commands.extend(mud.get_commands())
+            finally:
+                (await connecting).close()
+                await mud.shutdown()
+            return new_players, commands
+
+        loop = asyncio.new_event_loop()
+        try:
+            new_players, commands = loop.run_until_complete(
+                asyncio.wait_for(play(), 5))
+        finally:
+            loop.close()
+        self.assertEqual(new_players, [0])
+        self.assertEqual(commands, [(0, "say", "hello")])
+
+
+if __name__ == "__main__":
+    unittest.main()
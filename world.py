@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""World module for loading the rooms of a text-based Multi-User
+Dungeon (MUD) game from a file, so that worlds with many thousands of
+rooms don't have to be held in memory all at once.
+
+Contains one class, World, which opens a world file and can then be
+used like a dictionary mapping room names to rooms, and one function,
+write_world, which creates a world file from such a dictionary.
+
+A world file has one room per line, made up of the room's name, a tab,
+and the room as a JSON object, e.g:
+
+    Tavern<tab>{"description": "You're in a tavern.", "exits": {...}}
+
+The lines must be sorted by room name, which is what lets a room be
+found quickly without reading the whole file. Running this module on a
+world file, e.g. 'python world.py world.txt', sorts it.
+
+author: Mark Frimston - mfrimston@gmail.com
+"""
+
+
+import sys
+import json
+import mmap
+from collections import OrderedDict
+
+# the abstract class for dictionary-like objects lives in a different place in
+# newer versions of Python
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# interning a string makes every copy of it share the same object, saving
+# memory and making comparisons quicker. Python 2 can't intern unicode strings,
+# so there we do without
+try:
+    _intern = sys.intern
+except AttributeError:
+    def _intern(text):
+        return text
+
+
+class World(Mapping):
+    """The rooms of a game, read from a world file as they're needed.
+
+    Works like a read-only dictionary mapping each room name to the
+    room, which is a dictionary with a "description" and "exits" (a
+    dictionary mapping each exit name to the name of the room it leads
+    to). Opening a world takes the same time however big it is, as no
+    rooms are read until they're used. The 'cache_size' most recently
+    used rooms are kept in memory.
+
+    Rooms should not be changed by the game, as a changed room may be
+    thrown out of memory and read again from the file at any time.
+    """
+
+    def __init__(self, path, cache_size=4096):
+        """Opens the world file at 'path'."""
+        self._cache_size = cache_size
+        # recently used rooms, in order of when they were last used
+        self._cache = OrderedDict()
+        # the number of rooms, worked out when first needed
+        self._length = None
+
+        # map the file into memory. This doesn't read any of it - the
+        # operating system reads the parts we look at when we look at them,
+        # and can share them between programs or drop them again if memory
+        # runs low. An empty file can't be mapped, but it has no rooms anyway
+        with open(path, "rb") as f:
+            try:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                self._data = b""
+
+    def __getitem__(self, name):
+
+        # look for the room in the cache first. If it's there, move it to the
+        # end, so that the rooms used longest ago are at the front
+        room = self._cache.pop(name, None)
+        if room is None:
+            room = self._load_room(name)
+        self._cache[name] = room
+
+        # if there are now too many rooms in the cache, forget about the one
+        # that was used longest ago
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return room
+
+    def __contains__(self, name):
+
+        # check whether the room exists without reading it
+        return name in self._cache or self._find(name) is not None
+
+    def __iter__(self):
+
+        # go through the names of the rooms by going through the lines of the
+        # file
+        data = self._data
+        start = 0
+        while start < len(data):
+            end = data.find(b"\n", start)
+            if end == -1:
+                end = len(data)
+            tab = data.find(b"\t", start, end)
+            if tab != -1:
+                yield _intern(data[start:tab].decode("utf-8"))
+            start = end + 1
+
+    def __len__(self):
+        if self._length is None:
+            self._length = sum(1 for name in self)
+        return self._length
+
+    def close(self):
+        """Closes the world file. The world can't be used once closed."""
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def _load_room(self, name):
+
+        # find the room's line in the file and turn its JSON into a room
+        found = self._find(name)
+        if found is None:
+            raise KeyError(name)
+        room = json.loads(self._data[found[0]:found[1]].decode("utf-8"))
+
+        # intern the names of the exits and the rooms they lead to, as the same
+        # names crop up again and again
+        room["exits"] = dict((_intern(exit), _intern(to))
+                             for exit, to in room.get("exits", {}).items())
+        return room
+
+    def _find(self, name):
+
+        # search for the line of the room with the given name, returning the
+        # start and end position of its JSON, or None if there's no such room.
+        # The lines are sorted by name, so we can use a 'binary search': look
+        # at the line in the middle of the part of the file the room could be
+        # in, then carry on looking in either the first or second half of that
+        # part depending on whether the room's name comes before or after the
+        # name on the line. Each step halves the part left to search, so even
+        # in a file of a million rooms only about 20 lines need to be looked
+        # at. 'low' and 'high' are always at the start of a line
+        key = name.encode("utf-8")
+        data = self._data
+        low = 0
+        high = len(data)
+        while low < high:
+
+            # find the line containing the middle position
+            middle = (low + high) // 2
+            start = data.rfind(b"\n", low, middle) + 1
+            if start == 0:
+                start = low
+            end = data.find(b"\n", start, high)
+            if end == -1:
+                end = high
+            tab = data.find(b"\t", start, end)
+            if tab == -1:
+                tab = end
+
+            # compare the name on the line with the one we're looking for
+            linekey = data[start:tab]
+            if linekey == key:
+                return tab + 1, end
+            elif linekey < key:
+                low = end + 1
+            else:
+                high = start
+        return None
+
+
+def write_world(path, rooms):
+    """Writes the rooms in the dictionary 'rooms', which maps room names
+    to rooms, to a world file at 'path', sorted by name.
+    """
+    # names are sorted by their bytes, which is the order 'World' compares
+    # them in
+    with open(path, "wb") as f:
+        for name in sorted(rooms, key=lambda name: name.encode("utf-8")):
+            f.write(name.encode("utf-8") + b"\t"
+                    + json.dumps(rooms[name], sort_keys=True).encode("utf-8")
+                    + b"\n")
+
+
+if __name__ == "__main__":
+
+    # sort the world file given on the command line, e.g. after adding rooms
+    # to it by hand
+    if len(sys.argv) != 2:
+        sys.exit("Usage: python world.py <world file>")
+    rooms = {}
+    with open(sys.argv[1], "rb") as f:
+        for line in f:
+            if line.strip():
+                name, room = line.rstrip(b"\r\n").split(b"\t", 1)
+                rooms[name.decode("utf-8")] = json.loads(room.decode("utf-8"))
+    write_world(sys.argv[1], rooms)